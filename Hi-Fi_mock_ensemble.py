@@ -0,0 +1,178 @@
+# import all that's needed
+from lib.tng_lib import *
+import numpy as np
+from nbodykit.lab import *
+import time
+from argparse import ArgumentParser
+start = time.time()
+
+comm = CurrentMPIComm.get()
+print ('comm', comm, 'comm.rank', comm.rank, 'comm.size', comm.size)
+rank = comm.rank
+
+ap = ArgumentParser()
+ap.add_argument('--seeds',
+                type=int,
+                nargs='+',
+                default=[2695896],
+                help='IC seed numbers (default TNG300-1).')
+
+ap.add_argument('--output_redshifts',
+                type=float,
+                nargs='+',
+                default=[1],
+                help="Output redshifts z=0-5 (default 1)")
+
+ap.add_argument('--spaces',
+                type=str,
+                nargs='+',
+                default=['real'],
+                choices=['real', 'rsd'],
+                help="real and/or redshift (rsd) space mocks (default real)")
+
+ap.add_argument('--los_axes',
+                type=int,
+                nargs='+',
+                default=[2],
+                choices=[0, 1, 2],
+                help="lines of sight of the rsd mocks; with several, their multipoles are also averaged (default 2)")
+
+ap.add_argument('--split_redshifts',
+                action='store_true',
+                help="one task per (seed, zout) instead of per seed, to spread few seeds over many groups (each task then redoes the Lagrangian stage)")
+
+ap.add_argument('--nmesh',
+                type=int,
+                default=256,
+                help="Number of grid cells per side (default 256)")
+
+ap.add_argument('--boxsize',
+                type=float,
+                default=205.,
+                help="Box size [Mpc/h] (default 205)")
+
+ap.add_argument('--ngroups',
+                type=int,
+                default=1,
+                help="Number of groups of ranks running mocks at the same time (default 1)")
+
+ap.add_argument('--output_folder',
+                type=str,
+                default='./output_folder',
+                help="name for output folder")
+
+ap.add_argument('--cache_folder',
+                type=str,
+                default=None,
+                help="folder caching dlin, shifted and orthogonalized fields between runs (default: no cache)")
+
+ap.add_argument('--cache_size',
+                type=float,
+                default=50.,
+                help="size limit of the cache folder in GB (default 50)")
+
+ap.add_argument('--dtype',
+                type=str,
+                default='f8',
+                choices=['f8', 'f4'],
+                help="precision of the initial field and Lagrangian operators, f4 halves the memory (default f8)")
+
+ap.add_argument('--memory_budget',
+                type=float,
+                default=None,
+                help="memory in GB per process for the particles of the shifted fields, painted slab by slab (default: all at once)")
+
+ap.add_argument('--nthreads',
+                type=int,
+                default=None,
+                help="threads for the FFTs and painting (default: all cores on a single process, 1 with MPI)")
+
+cmd_args = ap.parse_args()
+set_threads(cmd_args.nthreads if cmd_args.nthreads or comm.size == 1 else 1)
+memory_budget = cmd_args.memory_budget*1024**3 if cmd_args.memory_budget else None
+
+Nmesh = cmd_args.nmesh
+BoxSize = cmd_args.boxsize
+output_folder = cmd_args.output_folder + '/'
+if rank == 0 and not os.path.exists(output_folder):
+    os.makedirs(output_folder)
+
+##########################
+### General parameters ###
+##########################
+
+zic = 127 # TNG initial redshift
+kmin=2*np.pi/BoxSize/2 # kmin used in Pk measurements [h/Mpc]
+Nmufid = 6 # number of mu bins for nbodykit FFTPower, this is actually 2x the number of (positive) mu bins
+
+# Cosmology
+# (tabulated once per parameter set, in the cache folder if there is one)
+cosmo_cache = os.path.join(cmd_args.cache_folder, 'cosmology') if cmd_args.cache_folder else None
+c = TabulatedCosmology(cosmo_cache, comm, h=0.6774, T0_cmb=2.725, Omega0_b=0.0486, Omega0_cdm=0.2603, m_ncdm=[], n_s=0.9667, k_pivot=0.05, A_s=2.055e-9, YHe=0.24)
+
+# one task per seed: the mocks at all redshifts, in real space and in redshift space along all lines of sight, share the
+# initial field and the Lagrangian stage (see hifi_mock_zouts); output names as in Hi-Fi_mock_real_space.py and
+# Hi-Fi_mock_redshift_space.py, with the line of sight appended for axes other than 2
+if cmd_args.split_redshifts:
+    tasks = [(seed, (zout,)) for seed in cmd_args.seeds for zout in cmd_args.output_redshifts]
+else:
+    tasks = [(seed, tuple(cmd_args.output_redshifts)) for seed in cmd_args.seeds]
+los_axes = cmd_args.los_axes if 'rsd' in cmd_args.spaces else []
+keys = (['real'] if 'real' in cmd_args.spaces else []) + los_axes
+
+def output_names(seed, zout, key):
+    prefix = '' if key == 'real' else 'rsd_'
+    suffix = '' if key in ('real', 2) else '_los_%i' % key
+    field_fname = output_folder+prefix+"HI_field_poly_L_%.1f_Nmesh_%.1f_zout_%.1f_seed_%i"%(BoxSize,Nmesh,zout,seed)+suffix
+    pk_fname = output_folder+("pHI" if key == 'real' else "pHIrsd")+"_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i"%(BoxSize,Nmesh,zout,seed)+suffix
+    return field_fname, pk_fname
+
+def done(task):
+    # the power spectra are saved last
+    seed, zouts = task
+    return all(os.path.exists(output_names(seed, zout, key)[1]) for zout in zouts for key in keys)
+
+def save_los_average(seed, zout, poles):
+    # multipoles averaged over the lines of sight
+    k = poles[max(poles)]['k']
+    P0 = np.mean([poles[axis]['power_0'].real for axis in poles], axis=0)
+    P2 = np.mean([poles[axis]['power_2'].real for axis in poles], axis=0)
+    np.savetxt(output_folder+"pHIrsd_poles_los_averaged_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i.txt"%(BoxSize,Nmesh,zout,seed),
+               np.array([k, P0, P2]).T, header='k P0 P2 (averaged over the lines of sight %s)' % str(sorted(poles)))
+
+def run_task(task, comm):
+    seed, zouts = task
+    cache = StageCache(cmd_args.cache_folder, comm, max_bytes=cmd_args.cache_size*1024**3)
+    poles = {zout: {} for zout in zouts}
+    def save(zout, key, HI_field_poly, p1):
+        field_fname, pk_fname = output_names(seed, zout, key)
+        with profile_stage('save'):
+            FieldMesh(HI_field_poly).save(field_fname)
+        with profile_stage('pk'):
+            if key == 'real':
+                pHI = FFTPower(HI_field_poly, mode='1d', kmin=kmin)
+            else:
+                pHI = FFTPower(HI_field_poly, mode='2d', kmin=kmin, Nmu=Nmufid, poles=[0,2], los=p1.attrs['los'])
+                poles[zout][key] = pHI.poles
+        pHI.save(pk_fname)
+        if len(los_axes) > 1 and len(poles[zout]) == len(los_axes) and comm.rank == 0:
+            save_los_average(seed, zout, poles.pop(zout))
+
+    profile = Profiler(comm, verbose=False)
+    with profile:
+        hifi_mock_zouts(seed, Nmesh, BoxSize, zouts, c, comm, axes=los_axes, real='real' in keys,
+                        zic=zic, Nmu=Nmufid, cache=cache, dtype=cmd_args.dtype, memory_budget=memory_budget, callback=save)
+    if len(zouts) == 1:
+        profile.save(output_folder+"profile_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i.json"%(BoxSize,Nmesh,zouts[0],seed))
+    else:
+        profile.save(output_folder+"profile_L_%.1f_Nmesh_%i_seed_%i.json"%(BoxSize,Nmesh,seed))
+    print ('task %s done (elapsed time: %1.f sec.)'%(str(task), time.time()-start))
+
+#################
+### Main part ###
+#################
+
+print ("Generating %i HI mocks in a BoxSize L=%.1f on a Nmesh=%i^3 grid with %i groups of ranks..."\
+       %(len(cmd_args.seeds)*len(cmd_args.output_redshifts)*len(keys), BoxSize, Nmesh, cmd_args.ngroups))
+run_ensemble(tasks, run_task, cmd_args.ngroups, comm=comm, done=done)
+print ("Total time taken: %.1f sec."%(time.time()-start))
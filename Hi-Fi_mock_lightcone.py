@@ -0,0 +1,129 @@
+# import all that's needed
+from lib.tng_lib import *
+import numpy as np
+from nbodykit.lab import *
+import time
+from argparse import ArgumentParser
+start = time.time()
+
+comm = CurrentMPIComm.get()
+print ('comm', comm, 'comm.rank', comm.rank, 'comm.size', comm.size)
+rank = comm.rank
+
+ap = ArgumentParser()
+ap.add_argument('--seed',
+                type=int,
+                default=2695896,
+                help='IC seed number (default TNG300-1).')
+
+ap.add_argument('--nmesh',
+                type=int,
+                default=256,
+                help="Number of grid cells per side (default 256)")
+
+ap.add_argument('--boxsize',
+                type=float,
+                default=205.,
+                help="Box size [Mpc/h] (default 205)")
+
+ap.add_argument('--zmin',
+                type=float,
+                default=0.,
+                help="Redshift of the inner edge of the lightcone (default 0)")
+
+ap.add_argument('--zmax',
+                type=float,
+                default=1.,
+                help="Redshift of the outer edge of the lightcone, at most 5 (default 1)")
+
+ap.add_argument('--nshells',
+                type=int,
+                default=10,
+                help="Number of comoving shells of equal width (default 10)")
+
+ap.add_argument('--observer',
+                type=float,
+                nargs=3,
+                default=None,
+                help="Position of the observer in the box [Mpc/h] (default: the centre of the box)")
+
+ap.add_argument('--space',
+                type=str,
+                default='real',
+                choices=['real', 'rsd'],
+                help="real or redshift (rsd) space, with the line of sight along the z axis (default real)")
+
+ap.add_argument('--output_folder',
+                type=str,
+                default='./output_folder',
+                help="name for output folder")
+
+ap.add_argument('--cache_folder',
+                type=str,
+                default=None,
+                help="folder caching dlin, shifted and orthogonalized fields between runs (default: no cache)")
+
+ap.add_argument('--cache_size',
+                type=float,
+                default=50.,
+                help="size limit of the cache folder in GB (default 50)")
+
+ap.add_argument('--dtype',
+                type=str,
+                default='f8',
+                choices=['f8', 'f4'],
+                help="precision of the initial field and Lagrangian operators, f4 halves the memory (default f8)")
+
+ap.add_argument('--memory_budget',
+                type=float,
+                default=None,
+                help="memory in GB per process for the particles of the shifted fields, painted slab by slab (default: all at once)")
+
+ap.add_argument('--nthreads',
+                type=int,
+                default=None,
+                help="threads for the FFTs and painting (default: all cores on a single process, 1 with MPI)")
+
+cmd_args = ap.parse_args()
+set_threads(cmd_args.nthreads if cmd_args.nthreads or comm.size == 1 else 1)
+memory_budget = cmd_args.memory_budget*1024**3 if cmd_args.memory_budget else None
+
+seed = cmd_args.seed
+Nmesh = cmd_args.nmesh
+BoxSize = cmd_args.boxsize
+lightcone_folder = cmd_args.output_folder + "/%slightcone_L_%.1f_Nmesh_%i_seed_%i" % ('' if cmd_args.space == 'real' else 'rsd_',
+                                                                                     BoxSize, Nmesh, seed)
+cache = StageCache(cmd_args.cache_folder, comm, max_bytes=cmd_args.cache_size*1024**3)
+
+##########################
+### General parameters ###
+##########################
+
+zic = 127 # TNG initial redshift
+axis = 2 # coordinate axis along which RSDs are applied (distant observer)
+Nmufid = 6 # number of mu bins for nbodykit FFTPower, this is actually 2x the number of (positive) mu bins
+
+print ("Generating HI lightcone between z=%.2f and z=%.2f in %i shells, in a BoxSize L=%.1f on a Nmesh=%i^3 grid with IC seed %i..."\
+       %(cmd_args.zmin, cmd_args.zmax, cmd_args.nshells, BoxSize, Nmesh, seed))
+
+# Cosmology
+# (tabulated once per parameter set, in the cache folder if there is one)
+cosmo_cache = os.path.join(cmd_args.cache_folder, 'cosmology') if cmd_args.cache_folder else None
+c = TabulatedCosmology(cosmo_cache, comm, h=0.6774, T0_cmb=2.725, Omega0_b=0.0486, Omega0_cdm=0.2603, m_ncdm=[], n_s=0.9667, k_pivot=0.05, A_s=2.055e-9, YHe=0.24)
+
+#################
+### Main part ###
+#################
+
+# one shell at a time, each written to lightcone_folder/shell_%03d (see hifi_lightcone)
+profile = Profiler(comm)
+with profile:
+    zedges = hifi_lightcone(seed, Nmesh, BoxSize, c, comm, lightcone_folder, zmin=cmd_args.zmin, zmax=cmd_args.zmax,
+                            nshells=cmd_args.nshells, observer=cmd_args.observer, space=cmd_args.space, axis=axis, zic=zic,
+                            Nmu=Nmufid, cache=cache, dtype=cmd_args.dtype, memory_budget=memory_budget)
+if rank == 0:
+    np.savetxt(lightcone_folder + "/shell_redshift_edges.txt", zedges, header='redshift edges of the shells')
+
+# per-stage timings of all ranks (JSON + Chrome trace)
+profile.save(lightcone_folder + "/profile.json")
+print ("Total time taken: %.1f sec."%(time.time()-start))
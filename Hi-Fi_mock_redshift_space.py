@@ -37,13 +37,46 @@ ap.add_argument('--output_folder',
                 default='./output_folder',
                 help="name for output folder")
 
+ap.add_argument('--cache_folder',
+                type=str,
+                default=None,
+                help="folder caching dlin, shifted and orthogonalized fields between runs (default: no cache)")
+
+ap.add_argument('--cache_size',
+                type=float,
+                default=50.,
+                help="size limit of the cache folder in GB (default 50)")
+
+ap.add_argument('--dtype',
+                type=str,
+                default='f8',
+                choices=['f8', 'f4'],
+                help="precision of the initial field and Lagrangian operators, f4 halves the memory (default f8)")
+
+ap.add_argument('--validate_dtype',
+                action='store_true',
+                help="also run the mock in f8 and f4 and save the deviation of their power spectra")
+
+ap.add_argument('--memory_budget',
+                type=float,
+                default=None,
+                help="memory in GB per process for the particles of the shifted fields, painted slab by slab (default: all at once)")
+
+ap.add_argument('--nthreads',
+                type=int,
+                default=None,
+                help="threads for the FFTs and painting (default: all cores on a single process, 1 with MPI)")
+
 cmd_args = ap.parse_args()
+set_threads(cmd_args.nthreads if cmd_args.nthreads or comm.size == 1 else 1)
+memory_budget = cmd_args.memory_budget*1024**3 if cmd_args.memory_budget else None
 
 seed = cmd_args.seed
 Nmesh = cmd_args.nmesh
 BoxSize = cmd_args.boxsize
 zout = cmd_args.output_redshift
 output_folder = cmd_args.output_folder + '/'
+cache = StageCache(cmd_args.cache_folder, comm, max_bytes=cmd_args.cache_size*1024**3)
 
 ##########################
 ### General parameters ###
@@ -58,9 +91,11 @@ print ("Generating HI mock in redshift-space at output redshift z=%.1f, in a Box
        %(zout, BoxSize, Nmesh, seed))
 
 # Cosmology and parameters
-c = cosmology.Cosmology(h=0.6774, T0_cmb=2.725, Omega0_b=0.0486, Omega0_cdm=0.2603, m_ncdm=[], n_s=0.9667, k_pivot=0.05, A_s=2.055e-9, YHe=0.24)
-Plin_zout = cosmology.LinearPower(c, zout)
-Plin_z0 = cosmology.LinearPower(c, 0)
+# (tabulated once per parameter set, in the cache folder if there is one)
+cosmo_cache = os.path.join(cmd_args.cache_folder, 'cosmology') if cmd_args.cache_folder else None
+c = TabulatedCosmology(cosmo_cache, comm, h=0.6774, T0_cmb=2.725, Omega0_b=0.0486, Omega0_cdm=0.2603, m_ncdm=[], n_s=0.9667, k_pivot=0.05, A_s=2.055e-9, YHe=0.24)
+Plin_zout = c.LinearPower(zout)
+Plin_z0 = c.LinearPower(0)
 Dic  = c.scale_independent_growth_factor(zic)
 Dout = c.scale_independent_growth_factor(zout)
 fout = c.scale_independent_growth_rate(zout)
@@ -77,43 +112,34 @@ plot = True
 ### Main part ###
 #################
 
-# Generate linear overdensity field at zic
-print ('Generating initial density field... ')
-dlin = get_dlin(seed, Nmesh, BoxSize, Plin_z0, comm)
-dlin *= Dic
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-
-# Compute shifted fields
-print ('Computing shifted fields... ')
-dz, d1, d2, dG2, dG2par, d3 = generate_fields_rsd_new(dlin, c, zic, zout, comm=comm)
-p1 = FFTPower(d1, mode='2d', kmin=kmin, Nmu=Nmufid, poles=[0,2])
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-
-# Orthogonalize shifted fields
-print ('Orthogonalizing shifted fields... ')
-d2, dG2, d3 = orthogonalize_rsd(d1, d2, dG2, d3, Nmufid)
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-
-# Generate 3D HI fields
-print ('Generating polynomial field... ')
-HI_field_poly = rsd_polynomial_field_zout(dz, d1, d2, dG2, dG2par, d3, params_path, zout, p1, fout)
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-
-# Add Perr(k,mu) noise:
-print ('Adding noise... ')
-HI_field_poly += noise_kmu_zout(zout, Nmesh, BoxSize, axis, fout, params_path)
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-
-print ('Saving HI field... ')
-out_fname = output_folder+"rsd_HI_field_poly_L_%.1f_Nmesh_%.1f_zout_%.1f_seed_%i"%(BoxSize,Nmesh,zout,seed)
-if save_outputs: FieldMesh(HI_field_poly).save(out_fname)
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-
-# compute Pks
-pHI = FFTPower(HI_field_poly, mode='2d', kmin=kmin, Nmu=Nmufid, poles=[0,2])
-pHI_fname = output_folder+"pHIrsd_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i"%(BoxSize,Nmesh,zout,seed)
-pHI.save(pHI_fname)
-print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
+# Generate linear overdensity field at zic, shifted fields, orthogonalized shifted fields and the
+# 3D HI field with Perr(k,mu) noise (see hifi_mock)
+profile = Profiler(comm)
+with profile:
+    HI_field_poly, p1 = hifi_mock(seed, Nmesh, BoxSize, zout, c, comm, space='rsd', zic=zic, axis=axis, Nmu=Nmufid, cache=cache,
+                                  params_path=params_path, dtype=cmd_args.dtype, memory_budget=memory_budget)
+
+    with profile_stage('save'):
+        out_fname = output_folder+"rsd_HI_field_poly_L_%.1f_Nmesh_%.1f_zout_%.1f_seed_%i"%(BoxSize,Nmesh,zout,seed)
+        if save_outputs: FieldMesh(HI_field_poly).save(out_fname)
+
+    # compute Pks
+    with profile_stage('pk'):
+        pHI = FFTPower(HI_field_poly, mode='2d', kmin=kmin, Nmu=Nmufid, poles=[0,2])
+        pHI_fname = output_folder+"pHIrsd_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i"%(BoxSize,Nmesh,zout,seed)
+        pHI.save(pHI_fname)
+
+if cmd_args.validate_dtype:
+    # P(k) deviation of the single precision mock from the double precision one
+    report = precision_report(seed, Nmesh, BoxSize, zout, c, comm, space='rsd', zic=zic, axis=axis, Nmu=Nmufid, cache=cache,
+                              params_path=params_path)
+    if rank == 0:
+        np.savetxt(output_folder+"rsd_dtype_validation_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i.txt"%(BoxSize,Nmesh,zout,seed),
+                   np.array([report['k'], report['dev'], report['one_minus_r'], report['dev_quadrupole']]).T,
+                   header='k P_f4/P_f8-1 1-r (P2_f4-P2_f8)/P0_f8')
+
+# per-stage timings of all ranks (JSON + Chrome trace)
+profile.save(output_folder+"profile_rsd_L_%.1f_Nmesh_%i_zout_%.1f_seed_%i.json"%(BoxSize,Nmesh,zout,seed))
 
 ################
 ### Plotting ###
@@ -0,0 +1,206 @@
+# Benchmarks of the pipeline stages in lib/tng_lib.py and of the drivers, for a few grid sizes and
+# numbers of MPI ranks, with a numerical fingerprint of the outputs.
+#
+#   python benchmarks/benchmark.py --nmesh 64 128 256 --ranks 1 2 4
+#
+# runs every (Nmesh, ranks) case with mpirun, appends the timings to benchmarks/history.json and
+# compares them with benchmarks/baseline.json (written by --update_baseline). The exit status is 1
+# if a stage got slower than threshold x baseline or if a power spectrum of the outputs moved by
+# more than rtol, so speedups can't silently change the mocks.
+import sys, os
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import json, time, shlex, socket, hashlib, subprocess, tempfile
+import numpy as np
+from argparse import ArgumentParser
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+ap = ArgumentParser()
+ap.add_argument('--nmesh', type=int, nargs='+', default=[64, 128, 256], help="grid sizes (default 64 128 256)")
+ap.add_argument('--ranks', type=int, nargs='+', default=[1, 2, 4], help="numbers of MPI ranks (default 1 2 4)")
+ap.add_argument('--repeat', type=int, default=3, help="runs of each stage, the fastest is kept (default 3)")
+ap.add_argument('--drivers', action='store_true', help="also time Hi-Fi_mock_real_space.py and Hi-Fi_mock_redshift_space.py end to end")
+ap.add_argument('--mpirun', type=str, default='mpirun -n {n}', help="MPI launcher, {n} is the number of ranks (default 'mpirun -n {n}')")
+ap.add_argument('--history', type=str, default=os.path.join(root, 'benchmarks', 'history.json'), help="timings of all runs")
+ap.add_argument('--baseline', type=str, default=os.path.join(root, 'benchmarks', 'baseline.json'), help="reference timings and fingerprints")
+ap.add_argument('--update_baseline', action='store_true', help="store this run as the baseline")
+ap.add_argument('--threshold', type=float, default=1.2, help="slowdown over the baseline reported as a regression (default 1.2)")
+ap.add_argument('--min_time', type=float, default=0.05, help="stages faster than this [sec.] are not compared (default 0.05)")
+ap.add_argument('--rtol', type=float, default=1e-4, help="relative tolerance of the P(k) fingerprints (default 1e-4)")
+ap.add_argument('--worker', type=str, default=None, help="internal: run the stages of the first nmesh under MPI and write the results to this file")
+cmd_args = ap.parse_args()
+
+seed = 2695896 # TNG300-1
+BoxSize = 205.
+zic = 127
+zout = 1.
+axis = 2
+Nmu = 6
+TNG_COSMO = dict(h=0.6774, T0_cmb=2.725, Omega0_b=0.0486, Omega0_cdm=0.2603, m_ncdm=[], n_s=0.9667, k_pivot=0.05, A_s=2.055e-9, YHe=0.24)
+
+def fingerprint(pk):
+    # k and power of a FFTPower result (monopole for 2d) at full precision, compared with rtol; the
+    # sha1 only labels them in the reports (its last bits change with the number of ranks)
+    poles = pk.poles if pk.attrs['mode'] == '2d' else pk.power
+    k, power = poles['k'], poles['power_0' if pk.attrs['mode'] == '2d' else 'power'].real
+    return {'k': k.tolist(), 'power': power.tolist(), 'sha1': hashlib.sha1(power.tobytes()).hexdigest()[:16]}
+
+def run_stages(Nmesh, repeat):
+    """Time the stages on all ranks of the world communicator; returns (max over ranks of the fastest run, fingerprints)."""
+    from nbodykit import CurrentMPIComm
+    from lib.tng_lib import (FFTPower, Profiler, profile_stage, TabulatedCosmology, get_dlin,
+                             generate_fields_new, generate_fields_rsd_new, generate_fields_new_smooth_cubic,
+                             orthogonalize, orthogonalize_rsd, orthogonalize_cubics, noise_zout_term, noise_kmu_zout_term,
+                             polynomial_field_zout, rsd_polynomial_field_zout, hifi_mock)
+    comm = CurrentMPIComm.get()
+    kmin = 2*np.pi/BoxSize/2
+    los = [0, 0, 1]
+    r_path = os.path.join(root, 'data', 'r_space_bestfit_params') + '/'
+    z_path = os.path.join(root, 'data', 'z_space_bestfit_params') + '/'
+    best = {}
+    prints = {}
+    for run in range(repeat):
+        profile = Profiler(comm, verbose=False)
+        with profile:
+            with profile_stage('tng_lib.TabulatedCosmology'):
+                c = TabulatedCosmology(None, comm, **TNG_COSMO)
+            with profile_stage('tng_lib.get_dlin'):
+                dlin = get_dlin(seed, Nmesh, BoxSize, c.LinearPower(0), comm)
+                dlin *= c.scale_independent_growth_factor(zic)
+            with profile_stage('tng_lib.generate_fields_new'):
+                d1, d2, dG2, d3 = generate_fields_new(dlin, c, zic, zout, comm=comm)
+            with profile_stage('nbodykit.FFTPower'):
+                p1 = FFTPower(d1, mode='1d', kmin=kmin)
+            with profile_stage('tng_lib.orthogonalize'):
+                d2, dG2, d3 = orthogonalize(d1, d2, dG2, d3)
+            with profile_stage('tng_lib.noise_zout_term'):
+                noise = noise_zout_term(zout, Nmesh, BoxSize, r_path, seed=seed, pm=d1.pm)
+            with profile_stage('tng_lib.polynomial_field_zout'):
+                HI = polynomial_field_zout(d1, d2, dG2, d3, r_path, zout, p1, noise=noise)
+            prints['d1'] = fingerprint(p1)
+            prints['d2_ort'] = fingerprint(FFTPower(d2, mode='1d', kmin=kmin))
+            prints['HI_real'] = fingerprint(FFTPower(HI, mode='1d', kmin=kmin))
+            del d1, d2, dG2, d3, noise, HI
+
+            with profile_stage('tng_lib.generate_fields_rsd_new'):
+                dz, d1, d2, dG2, dG2par, d3 = generate_fields_rsd_new(dlin, c, zic, zout, axis=axis, comm=comm)
+            p1 = FFTPower(d1, mode='2d', kmin=kmin, Nmu=Nmu, poles=[0,2], los=los)
+            with profile_stage('tng_lib.orthogonalize_rsd'):
+                d2, dG2, d3 = orthogonalize_rsd(d1, d2, dG2, d3, Nmu, axis=axis)
+            with profile_stage('tng_lib.noise_kmu_zout_term'):
+                noise = noise_kmu_zout_term(zout, Nmesh, BoxSize, axis, z_path, seed=seed, pm=d1.pm)
+            with profile_stage('tng_lib.rsd_polynomial_field_zout'):
+                HI = rsd_polynomial_field_zout(dz, d1, d2, dG2, dG2par, d3, z_path, zout, p1,
+                                               c.scale_independent_growth_rate(zout), noise=noise)
+            prints['HI_rsd'] = fingerprint(FFTPower(HI, mode='2d', kmin=kmin, Nmu=Nmu, poles=[0,2], los=los))
+            del dz, d1, d2, dG2, dG2par, d3, noise, HI
+
+            with profile_stage('tng_lib.generate_fields_new_smooth_cubic'):
+                fields = generate_fields_new_smooth_cubic(dlin, c, zic, zout, comm=comm)
+            with profile_stage('tng_lib.orthogonalize_cubics'):
+                fields = orthogonalize_cubics(*fields)
+            prints['cubic_ort'] = fingerprint(FFTPower(fields[-1], mode='1d', kmin=kmin))
+            del fields, dlin
+
+            with profile_stage('tng_lib.hifi_mock real'):
+                hifi_mock(seed, Nmesh, BoxSize, zout, c, comm, space='real', zic=zic, params_path=r_path)
+            with profile_stage('tng_lib.hifi_mock rsd'):
+                hifi_mock(seed, Nmesh, BoxSize, zout, c, comm, space='rsd', zic=zic, axis=axis, Nmu=Nmu, params_path=z_path)
+
+        # slowest rank of each stage, fastest of the runs (the stages of hifi_mock appear without prefix)
+        for entry in profile.summary(profile.gather() or []):
+            best[entry['stage']] = min(best.get(entry['stage'], np.inf), entry['wall']['max'])
+    return best, prints
+
+def run_driver(script, Nmesh, nranks):
+    # wall time of a driver run end to end in a scratch output folder
+    with tempfile.TemporaryDirectory() as tmp:
+        cmd = shlex.split(cmd_args.mpirun.format(n=nranks)) + [sys.executable, os.path.join(root, script), '--nmesh', str(Nmesh),
+                                                              '--output_folder', tmp, '--nthreads', '1']
+        start = time.time()
+        subprocess.check_call(cmd, cwd=root, stdout=subprocess.DEVNULL)
+        return time.time() - start
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(run, baseline):
+    """List of regressions of run with respect to baseline (both dicts of cases)."""
+    problems = []
+    for case, ref in baseline['cases'].items():
+        if case not in run['cases']:
+            continue
+        new = run['cases'][case]
+        for stage, t_ref in ref['wall'].items():
+            t = new['wall'].get(stage)
+            if t is not None and max(t, t_ref) > cmd_args.min_time and t > cmd_args.threshold * t_ref:
+                problems.append('%s %s: %.2f sec. vs %.2f sec. in the baseline (x%.2f)' % (case, stage, t, t_ref, t/t_ref))
+        for name, fp_ref in ref['fingerprints'].items():
+            fp = new['fingerprints'].get(name)
+            if fp is None:
+                continue
+            # (the k bins too, if the baseline has them)
+            names = ['power'] + (['k'] if 'k' in fp_ref else [])
+            a, b = [np.array(fp[n]) for n in names], [np.array(fp_ref[n]) for n in names]
+            if any(x.shape != y.shape or not np.allclose(x, y, rtol=cmd_args.rtol, atol=0, equal_nan=True) for x, y in zip(a, b)):
+                if a[0].shape == b[0].shape:
+                    change = 'max relative change %.2e' % np.nanmax(np.abs(a[0] / b[0] - 1))
+                else:
+                    change = '%d k bins instead of %d' % (a[0].size, b[0].size)
+                problems.append('%s %s: P(k) %s differs from the baseline %s (%s)' % (case, name, fp['sha1'], fp_ref['sha1'], change))
+    return problems
+
+if cmd_args.worker is not None:
+    from lib.tng_lib import set_threads
+    from nbodykit import CurrentMPIComm
+    set_threads(1)
+    wall, prints = run_stages(cmd_args.nmesh[0], cmd_args.repeat)
+    if CurrentMPIComm.get().rank == 0:
+        with open(cmd_args.worker, 'w') as f:
+            json.dump({'wall': wall, 'fingerprints': prints}, f)
+    sys.exit(0)
+
+run = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': git_commit(), 'host': socket.gethostname(), 'cases': {}}
+for Nmesh in cmd_args.nmesh:
+    for nranks in cmd_args.ranks:
+        case = 'Nmesh_%d_ranks_%d' % (Nmesh, nranks)
+        print('%s ...' % case, flush=True)
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            cmd = shlex.split(cmd_args.mpirun.format(n=nranks)) + [sys.executable, os.path.abspath(__file__),
+                                                                  '--nmesh', str(Nmesh), '--repeat', str(cmd_args.repeat),
+                                                                  '--worker', out.name]
+            subprocess.check_call(cmd, cwd=root)
+            with open(out.name) as f:
+                result = json.load(f)
+        if cmd_args.drivers:
+            for script in ('Hi-Fi_mock_real_space.py', 'Hi-Fi_mock_redshift_space.py'):
+                result['wall'][script] = run_driver(script, Nmesh, nranks)
+        for stage, t in sorted(result['wall'].items(), key=lambda x: -x[1]):
+            print('    %-34s %8.2f sec.' % (stage, t))
+        run['cases'][case] = result
+
+history = []
+if os.path.exists(cmd_args.history):
+    with open(cmd_args.history) as f:
+        history = json.load(f)
+history.append(run)
+with open(cmd_args.history, 'w') as f:
+    json.dump(history, f, indent=1)
+
+if cmd_args.update_baseline:
+    with open(cmd_args.baseline, 'w') as f:
+        json.dump(run, f, indent=1)
+    print('Stored the baseline in %s' % cmd_args.baseline)
+elif os.path.exists(cmd_args.baseline):
+    with open(cmd_args.baseline) as f:
+        problems = compare(run, json.load(f))
+    for problem in problems:
+        print('REGRESSION ' + problem)
+    if problems:
+        sys.exit(1)
+    print('No regression with respect to %s' % cmd_args.baseline)
+else:
+    print('No baseline in %s, store one with --update_baseline' % cmd_args.baseline)
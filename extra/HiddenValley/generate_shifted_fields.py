@@ -32,11 +32,11 @@ zic  = 99 # Abacus initial redshift
 kmin = np.pi/BoxSize # kmin used in Pk measurements [h/Mpc]
 seed = 9100 
 
-# HV cosmology:
-c = cosmology.Cosmology(h=0.6770, Omega0_b=0.049, Omega0_cdm=0.26014, n_s=0.96824, m_ncdm=[], A_s=2.10732e-9)
+# HV cosmology (tabulated once and shared by all jobs):
+c = TabulatedCosmology(output_folder + 'cosmology/', comm, h=0.6770, Omega0_b=0.049, Omega0_cdm=0.26014, n_s=0.96824, m_ncdm=[], A_s=2.10732e-9)
 
-Plin_zout = cosmology.LinearPower(c, zout)
-Plin_z0 = cosmology.LinearPower(c, 0)
+Plin_zout = c.LinearPower(zout)
+Plin_z0 = c.LinearPower(0)
 Dic  = c.scale_independent_growth_factor(zic)
 Dout = c.scale_independent_growth_factor(zout)
 
@@ -7,9 +7,7 @@ import numpy as np
 from nbodykit.lab import *
 import time
 from argparse import ArgumentParser
-from scipy.interpolate import interp1d
 start = time.time()
-from argparse import ArgumentParser
 
 comm = CurrentMPIComm.get()    
 print ('comm', comm, 'comm.rank', comm.rank, 'comm.size', comm.size)
@@ -18,10 +16,13 @@ rank = comm.rank
 parser = ArgumentParser()
 parser.add_argument('--batch_size', type=int, required=True)
 parser.add_argument('--batch_num', type=int, required=True)
+parser.add_argument('--c_ind', type=int, required=True, help='AbacusSmall cosmology of the HOD catalogs')
+parser.add_argument('--ngroups', type=int, default=1, help='Number of groups of ranks fitting catalogs at the same time (default 1)')
 args = parser.parse_args()
 
 batch_size = args.batch_size
 batch_num = args.batch_num
+c_ind = args.c_ind
 
 Nmesh = 256
 BoxSize = 1024
@@ -34,90 +35,39 @@ if not os.path.exists(output_folder):
 zic  = 99 # HV initial redshift
 kmin = np.pi/BoxSize # kmin used in Pk measurements [h/Mpc]
 
-# HV cosmology:
-c = cosmology.Cosmology(h=0.6770, Omega0_b=0.049, Omega0_cdm=0.26014, n_s=0.96824, m_ncdm=[], A_s=2.10732e-9)
+# HV cosmology (tabulated once and shared by all jobs):
+c = TabulatedCosmology(path + 'cosmology/', comm, h=0.6770, Omega0_b=0.049, Omega0_cdm=0.26014, n_s=0.96824, m_ncdm=[], A_s=2.10732e-9)
 
-Plin_zout = cosmology.LinearPower(c, zout)
-Plin_z0 = cosmology.LinearPower(c, 0)
+Plin_zout = c.LinearPower(zout)
+Plin_z0 = c.LinearPower(0)
 Dic  = c.scale_independent_growth_factor(zic)
 Dout = c.scale_independent_growth_factor(zout)
 
-d1, d2, dG2, d3 = np.load(path + 'shifted_fields/shifted_fields_real_N_%i_zout_%.1f.npy'%(Nmesh, zout))
-d1  = ArrayMesh(d1, BoxSize=BoxSize).to_field(mode='complex')
-d2  = ArrayMesh(d2, BoxSize=BoxSize).to_field(mode='complex')
-dG2 = ArrayMesh(dG2, BoxSize=BoxSize).to_field(mode='complex')
-d3  = ArrayMesh(d3, BoxSize=BoxSize).to_field(mode='complex')
-
-start = batch_num * batch_size
-end = start + batch_size
-
-for i in range(start, end):
-    
-    path_to_save = output_folder + "results_HV_z=%.4f_Nmesh_%i.npy"%(i, zout, Nmesh)
-    
-    if not os.path.exists(path_to_save):
-
-        # load delta_g
-        print ('Loading HI catalog... ')
-        gal_cat = np.load(path + 'AbacusSmall_c=%i_ph=3000_hod=%i_z=%.4f.npy'%(c_ind, i, zout))
-        gal_cat.shape
-        
-        dtype = np.dtype([('Position', ('f8', 3)),])
-        cat = np.empty((gal_cat.shape[0],), dtype=dtype)
-        cat['Position']  = gal_cat[:,:3]
-        
-        cat = ArrayCatalog(cat, BoxSize=BoxSize * np.ones(3), Nmesh=Nmesh)
-        cat = cat.to_mesh(compensated=True).paint() - 1.0
-        print('cat.mean', cat.cmean())
-        # nbar = gal_cat.shape[0]/BoxSize**3    
-        # print('Nh = %.2f, 1/nbar = %.2f'%(gal_cat.shape[0], 1/nbar))
-        
-        delta_h = ArrayMesh(cat, BoxSize)
-        print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
-        
-        # Compute various Pk and cross-Pk
-        ph_fin  = FFTPower(delta_h, mode='1d', kmin=kmin)
-        kk = ph_fin.power.coords['k']
-        
-        ph_d1ort  = FFTPower(delta_h, mode='1d', second=d1, kmin=kmin)
-        ph_d2ort  = FFTPower(delta_h, mode='1d', second=d2, kmin=kmin)
-        ph_dG2ort = FFTPower(delta_h, mode='1d', second=dG2, kmin=kmin)
-        ph_d3ort  = FFTPower(delta_h, mode='1d', second=d3, kmin=kmin)
-        
-        pd1     = FFTPower(d1, mode='1d', kmin=kmin)
-        pd2ort  = FFTPower(d2, mode='1d', kmin=kmin)
-        pdG2ort = FFTPower(dG2, mode='1d', kmin=kmin)
-        pd3ort  = FFTPower(d3, mode='1d', kmin=kmin)
-        
-        # Transfer functions
-        beta1 = ph_d1ort.power['power'].real/pd1.power['power'].real
-        beta2 = ph_d2ort.power['power'].real/pd2ort.power['power'].real
-        betaG2 = ph_dG2ort.power['power'].real/pdG2ort.power['power'].real
-        beta3 = ph_d3ort.power['power'].real/pd3ort.power['power'].real
-        
-        beta1inter  = interp1d(kk, beta1, kind='linear', fill_value=(beta1[0],beta1[-1]), bounds_error=False)
-        beta2inter  = interp1d(kk, beta2, kind='linear', fill_value=(beta2[0],beta2[-1]), bounds_error=False)
-        betaG2inter = interp1d(kk, betaG2, kind='linear', fill_value=(betaG2[0],betaG2[-1]), bounds_error=False)
-        beta3inter  = interp1d(kk, beta3, kind='linear', fill_value=(beta3[0],beta3[-1]), bounds_error=False)
-        
-        beta11d1ort  =  d1.apply(lambda k, v: beta1inter(sum(ki ** 2 for ki in k)**0.5) * v)
-        beta22d2ort  =  d2.apply(lambda k, v: beta2inter(sum(ki ** 2 for ki in k)**0.5) * v)
-        betaG2dG2ort = dG2.apply(lambda k, v: betaG2inter(sum(ki** 2 for ki in k)**0.5) * v)
-        beta33d3ort  =  d3.apply(lambda k, v: beta3inter(sum(ki ** 2 for ki in k)**0.5) * v)
-        
-        # Best-fit fields including different bias operators
-        final_field = beta11d1ort + beta22d2ort + betaG2dG2ort + beta33d3ort
-    
-        diff = delta_h.to_field(mode='complex') - final_field
-        
-        # compute Pk of the residual
-        perr = FFTPower(diff, mode='1d', kmin=kmin)
-        phbestfit = FFTPower(delta_h, mode='1d', second=final_field, kmin=kmin)
-        pbestfit = FFTPower(final_field, mode='1d', kmin=kmin)
-        rhbestfit = phbestfit.power['power'].real/(ph_fin.power['power'].real*pbestfit.power['power'].real)**0.5
-        
-        results = kk, perr.power['power'].real, ph_fin.power['power'].real, phbestfit.power['power'].real, rhbestfit, beta1, beta2, betaG2, beta3, nbar
-        np.save(path_to_save, results)
+def load_operators(comm):
+    # orthogonalized shifted fields of generate_shifted_fields.py, on the ranks of comm
+    d1, d2, dG2, d3 = np.load(path + 'shifted_fields/shifted_fields_real_N_%i_zout_%.1f.npy'%(Nmesh, zout))
+    return [ArrayMesh(d, BoxSize=BoxSize, comm=comm).to_field(mode='complex') for d in (d1, d2, dG2, d3)]
+
+def load_positions(i, comm):
+    # the part of HOD catalog i read by this rank
+    gal_cat = np.load(path + 'AbacusSmall_c=%i_ph=3000_hod=%i_z=%.4f.npy'%(c_ind, i, zout), mmap_mode='r')
+    n = len(gal_cat)
+    return np.array(gal_cat[n * comm.rank // comm.size:n * (comm.rank + 1) // comm.size, :3], dtype='f8')
+
+def output_name(i):
+    return output_folder + "results_HV_c=%i_hod=%i_z=%.4f_Nmesh_%i.npy"%(c_ind, i, zout, Nmesh)
+
+def save(i, result):
+    beta1, beta2, betaG2, beta3 = result['beta']
+    results = result['k'], result['Perr'], result['Phh'], result['Phbestfit'], result['r'], beta1, beta2, betaG2, beta3, result['nbar']
+    np.save(output_name(i), np.array(results, dtype=object))
+    print ('HOD %i done (elapsed time: %1.f sec.)'%(i, time.time()-start))
+
+# the operator spectra and the k bins are computed once per group of ranks; each HOD catalog
+# then costs one paint, one FFT and two passes over the modes (see TransferFunctionFit)
+hods = list(range(batch_num * batch_size, (batch_num + 1) * batch_size))
+fit_catalogs(hods, load_operators, load_positions, save, ngroups=args.ngroups, comm=comm,
+             done=lambda i: os.path.exists(output_name(i)), kmin=kmin)
 
 
 # # redshift space
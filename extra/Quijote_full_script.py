@@ -52,14 +52,30 @@ elif simulation == 'Kazu':
                 default='/global/cfs/projectdirs/m4031/divijsharma/PNG/output_folder/Kazu',
                 help="name for output folder")
 
+ap.add_argument('--cache_folder',
+                type=str,
+                default=None,
+                help="folder caching dlin, shifted and orthogonalized fields between runs (default: no cache)")
+
+ap.add_argument('--cache_size',
+                type=float,
+                default=50.,
+                help="size limit of the cache folder in GB (default 50)")
+
+ap.add_argument('--nthreads',
+                type=int,
+                default=None,
+                help="threads for the FFTs and painting (default: all cores on a single process, 1 with MPI)")
 
 cmd_args = ap.parse_args()
+set_threads(cmd_args.nthreads if cmd_args.nthreads or comm.size == 1 else 1)
 
 seed = cmd_args.seed
 Nmesh = cmd_args.nmesh
 BoxSize = cmd_args.boxsize
 zout = cmd_args.output_redshift
 output_folder = cmd_args.output_folder + '/'
+cache = StageCache(cmd_args.cache_folder, comm, max_bytes=cmd_args.cache_size*1024**3)
 
 # sim_type = 'Gaussian'
 # sim_type = 'nonGaussian'
@@ -79,15 +95,17 @@ kmin = 2*np.pi/BoxSize/2 # kmin used in Pk measurements [h/Mpc]
 print ("Generating shifted fields in real-space at output redshift z=%.1f, in a BoxSize L=%.1f on a Nmesh=%i^3 grid with IC seed %i..."\
        %(zout, BoxSize, Nmesh, seed))
 
+# (tabulated once per parameter set, in the cache folder if there is one)
+cosmo_cache = os.path.join(cmd_args.cache_folder, 'cosmology') if cmd_args.cache_folder else None
 #Kazu's cosmology
 if simulation == 'Kazu':
-    c = cosmology.Cosmology(h=0.6766, Omega0_cdm=0.309640, n_s=0.9665, m_ncdm=[], A_s=2.105e-9)
+    c = TabulatedCosmology(cosmo_cache, comm, h=0.6766, Omega0_cdm=0.309640, n_s=0.9665, m_ncdm=[], A_s=2.105e-9)
 else:
     # Quijote cosmology:
-    c = cosmology.Cosmology(h=0.6711, Omega0_b=0.049, Omega0_cdm=0.3175 - 0.049, n_s=0.9624, m_ncdm=[]).match(sigma8=0.834)
+    c = TabulatedCosmology(cosmo_cache, comm, match=dict(sigma8=0.834), h=0.6711, Omega0_b=0.049, Omega0_cdm=0.3175 - 0.049, n_s=0.9624, m_ncdm=[])
 
-Plin_zout = cosmology.LinearPower(c, zout)
-Plin_z0 = cosmology.LinearPower(c, 0)
+Plin_zout = c.LinearPower(zout)
+Plin_z0 = c.LinearPower(0)
 Dic  = c.scale_independent_growth_factor(zic)
 Dout = c.scale_independent_growth_factor(zout)
 
@@ -114,21 +132,33 @@ if simulation == 'Quijote':
                 ### Main part ###
                 #################
     
+                # The fields only depend on the seed, not on sim_type or Mh_bins: they are
+                # computed once and loaded from the cache afterwards
+                ic_params = dict(seed=seed, Nmesh=Nmesh, BoxSize=BoxSize, cosmo=c, zic=zic)
+                shifted_params = dict(ic_params, zout=zout, operators=['d1', 'd2', 'G2', 'd3'])
+
                 # Generate linear overdensity field at zic
-                print ('Generating initial density field... ')
-                dlin = get_dlin(seed, Nmesh, BoxSize, Plin_z0, comm)
-                dlin *= Dic
-                print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
+                def compute_dlin():
+                    print ('Generating initial density field... ')
+                    dlin = get_dlin(seed, Nmesh, BoxSize, Plin_z0, comm)
+                    dlin *= Dic
+                    print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
+                    return [dlin]
     
                 # Compute shifted fields
-                print ('Computing shifted fields... ')
-                d1, d2, dG2, d3 = generate_fields_new(dlin, c, zic, zout, comm=comm)
+                def compute_shifted():
+                    dlin, = cache.stage('dlin', compute_dlin, **ic_params)
+                    print ('Computing shifted fields... ')
+                    fields = generate_fields_new(dlin, c, zic, zout, comm=comm)
+                    print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
+                    return fields
+
+                d1, d2, dG2, d3 = cache.stage('shifted', compute_shifted, **shifted_params)
                 p1 = FFTPower(d1, mode='1d', kmin=kmin)
-                print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
     
                 # Orthogonalize shifted fields
                 print ('Orthogonalizing shifted fields... ')
-                d2, dG2, d3 = orthogonalize(d1, d2, dG2, d3)
+                d2, dG2, d3 = cache.stage('orthogonalized', lambda: orthogonalize(d1, d2, dG2, d3), pm=d1.pm, **shifted_params)
                 print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
     
                 #################
@@ -181,24 +211,14 @@ if simulation == 'Quijote':
                 delta_h = ArrayMesh(cat, BoxSize)
     
                 # Compute various Pk and cross-Pk
-                ph_fin  = FFTPower(delta_h, mode='1d', kmin=kmin)
+                P, ph_fin = cross_power_matrix([cat.r2c(), d1, d2, dG2, d3], kmin=kmin)
                 kk = p1.power.coords['k']
     
-                ph_d1ort  = FFTPower(delta_h, mode='1d', second=d1, kmin=kmin)
-                ph_d2ort  = FFTPower(delta_h, mode='1d', second=d2, kmin=kmin)
-                ph_dG2ort = FFTPower(delta_h, mode='1d', second=dG2, kmin=kmin)
-                ph_d3ort  = FFTPower(delta_h, mode='1d', second=d3, kmin=kmin)
-    
-                pd1     = FFTPower(d1, mode='1d', kmin=kmin)
-                pd2ort  = FFTPower(d2, mode='1d', kmin=kmin)
-                pdG2ort = FFTPower(dG2, mode='1d', kmin=kmin)
-                pd3ort  = FFTPower(d3, mode='1d', kmin=kmin)
-    
                 # Transfer functions
-                beta1 = ph_d1ort.power['power'].real/pd1.power['power'].real
-                beta2 = ph_d2ort.power['power'].real/pd2ort.power['power'].real
-                betaG2 = ph_dG2ort.power['power'].real/pdG2ort.power['power'].real
-                beta3 = ph_d3ort.power['power'].real/pd3ort.power['power'].real
+                beta1 = P[:,0,1]/P[:,1,1]
+                beta2 = P[:,0,2]/P[:,2,2]
+                betaG2 = P[:,0,3]/P[:,3,3]
+                beta3 = P[:,0,4]/P[:,4,4]
     
                 beta1inter  = interp1d(kk, beta1, kind='linear', fill_value=(beta1[0],beta1[-1]), bounds_error=False)
                 beta2inter  = interp1d(kk, beta2, kind='linear', fill_value=(beta2[0],beta2[-1]), bounds_error=False)
@@ -381,7 +401,9 @@ elif simulation == 'Kazu':
 
                 # Compute shifted fields
                 print ('Computing shifted fields... ')
-                d1, d2, dG2, d3 = generate_fields_new(dlin, c, zic, zout, comm=comm)
+                shifted_params = dict(snapdir=snapdir, Nmesh=Nmesh, BoxSize=BoxSize, cosmo=c, zic=zic, zout=zout,
+                                      operators=['d1', 'd2', 'G2', 'd3'])
+                d1, d2, dG2, d3 = cache.stage('shifted', lambda: generate_fields_new(dlin, c, zic, zout, comm=comm), **shifted_params)
                 p1 = FFTPower(d1, mode='1d', kmin=kmin)
                 print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
                 
@@ -425,7 +447,7 @@ elif simulation == 'Kazu':
                     
                 # Orthogonalize shifted fields
                 print ('Orthogonalizing shifted fields... ')
-                d2, dG2, d3 = orthogonalize(d1, d2, dG2, d3)
+                d2, dG2, d3 = cache.stage('orthogonalized', lambda: orthogonalize(d1, d2, dG2, d3), pm=d1.pm, **shifted_params)
                 print ('done (elapsed time: %1.f sec.)'%(time.time()-start))
 
                 if sim_type == 'Gaussian':
@@ -542,15 +564,11 @@ elif simulation == 'Kazu':
                 plt.close()
     
                 # Compute various Pk and cross-Pk
-                ph_fin  = FFTPower(delta_h, mode='1d', kmin=kmin)
+                P, ph_fin = cross_power_matrix([cat.r2c(), d1, d2, dG2, d3], kmin=kmin)
                 kk = p1.power.coords['k']
-    
-                ph_d1ort  = FFTPower(delta_h, mode='1d', second=d1, kmin=kmin)
-                # print(ph_d1ort, flush=True)
-                # print(ph_d1ort.shape, flush=True)
 
                 plt.figure(figsize=(8,5))
-                plt.plot(kk, ph_d1ort.power['power'].real, label='ph_d1ort')
+                plt.plot(kk, P[:,0,1], label='ph_d1ort')
                 plt.plot(kk, b1_fit*Plin_zout(kk), label='$b_1 P_{\\rm lin}$')
                 plt.xscale('log')
                 plt.xlabel("$k\,[h\,\mathrm{Mpc}^{-1}]$")
@@ -559,21 +577,12 @@ elif simulation == 'Kazu':
                 plt.tight_layout()
                 plt.savefig(output_folder + "ph_d1ort.pdf")
                 plt.close()
-                
-                ph_d2ort  = FFTPower(delta_h, mode='1d', second=d2, kmin=kmin)
-                ph_dG2ort = FFTPower(delta_h, mode='1d', second=dG2, kmin=kmin)
-                ph_d3ort  = FFTPower(delta_h, mode='1d', second=d3, kmin=kmin)
-    
-                pd1     = FFTPower(d1, mode='1d', kmin=kmin)
-                pd2ort  = FFTPower(d2, mode='1d', kmin=kmin)
-                pdG2ort = FFTPower(dG2, mode='1d', kmin=kmin)
-                pd3ort  = FFTPower(d3, mode='1d', kmin=kmin)
     
                 # Transfer functions
-                beta1 = ph_d1ort.power['power'].real/pd1.power['power'].real
-                beta2 = ph_d2ort.power['power'].real/pd2ort.power['power'].real
-                betaG2 = ph_dG2ort.power['power'].real/pdG2ort.power['power'].real
-                beta3 = ph_d3ort.power['power'].real/pd3ort.power['power'].real
+                beta1 = P[:,0,1]/P[:,1,1]
+                beta2 = P[:,0,2]/P[:,2,2]
+                betaG2 = P[:,0,3]/P[:,3,3]
+                beta3 = P[:,0,4]/P[:,4,4]
     
                 beta1inter  = interp1d(kk, beta1, kind='linear', fill_value=(beta1[0],beta1[-1]), bounds_error=False)
                 beta2inter  = interp1d(kk, beta2, kind='linear', fill_value=(beta2[0],beta2[-1]), bounds_error=False)
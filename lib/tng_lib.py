@@ -4,16 +4,22 @@ import matplotlib.pyplot as plt
 from nbodykit.lab import ArrayMesh, FieldMesh
 from nbodykit.filters import Gaussian
 from nbodykit.source.catalog import UniformCatalog, ArrayCatalog
+from nbodykit.source.mesh.catalog import CompensateCICShotnoise
 from nbodykit import mockmaker
 from nbodykit.algorithms import FFTPower
-from pmesh.pm import ParticleMesh
+from nbodykit.binned_statistic import BinnedStatistic
+from pmesh.pm import ParticleMesh, RealField, BaseComplexField
 
 from nbodykit.utils import GatherArray
 
 # from collections import OrderedDict
 # import numpy.core.numeric as NX
-import os, sys, time
+import os, sys, time, weakref, json, hashlib, shutil, threading, contextlib, resource
+import bigfile
 from scipy import interpolate as interp
+import scipy.fft
+from concurrent.futures import ThreadPoolExecutor
+from scipy.special import legendre
 
 def generate_fields(delta_ic, cosmo, nbar, zic, zout, plot=True, weight=True, Rsmooth=0, seed=1234, Rdelta=0, posgrid='uniform'):
     scale_factor = 1/(1+zout)
@@ -69,157 +75,462 @@ def generate_fields(delta_ic, cosmo, nbar, zic, zout, plot=True, weight=True, Rs
     d3 = catalog.to_mesh(value='delta_3', compensated=True).to_real_field()
     return d1, d2, dG2, d3
 
-def generate_fields_new(dlin, cosmo, zic, zout, comm=None, compensate=True):
-    print('Creating copy', flush=True)
-    delta_ic = dlin.copy()
-    print('Done', flush=True)
-    scale_factor = 1/(1+zout)
-    Nmesh = delta_ic.Nmesh
-    print(Nmesh, flush=True)
-    BoxSize = delta_ic.BoxSize[0]
-    prefactor = cosmo.scale_independent_growth_factor(zout)/cosmo.scale_independent_growth_factor(zic)
-    
-    pos = delta_ic.pm.generate_uniform_particle_grid(shift=0)
-    print("Min position (x, y, z) for the uniform particle catalog:", np.min(pos, axis=0), flush=True)
-    print("Max position (x, y, z)for the uniform particle catalog:", np.max(pos, axis=0), flush=True)
-    N = pos.shape[0]
-    print('Creating catalog', flush=True)
-    catalog = np.empty(N, dtype=[('Position', ('f8', 3)), ('delta_1', 'f8'), ('delta_2', 'f8'), ('delta_G2', 'f8'), ('delta_3', 'f8')])
-    print('Done', flush=True)
-    catalog['Position'][:] = pos[:]
-    layout = delta_ic.pm.decompose(catalog['Position']) 
-    del pos
+# threads used by fft_r2c, fft_c2r and paint_fields, see set_threads
+_NTHREADS = 1
 
-    print('Readout', flush=True)
-    delta_1 = delta_ic.c2r().readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    print('Done', flush=True)
-    delta_1 -= np.mean(delta_1)
-    catalog['delta_1'][:] = delta_1[:]
-    del delta_1
-    print('Done delta_1', flush=True)
-    
-    catalog['delta_2'][:] = catalog['delta_1']**2
-    catalog['delta_2'][:] -= np.mean(catalog['delta_2'])
-    
-    delta_G2 = tidal_G2(FieldMesh(delta_ic)).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**2
-    catalog['delta_G2'][:] = delta_G2[:]
-    del delta_G2
-    print('Done delta_G2', flush=True)
-    
-    delta_3 = d3_smooth(FieldMesh(delta_ic)).readout(catalog['Position'], layout=layout, resampler='cic')**3*prefactor**3
-    catalog['delta_3'][:] = delta_3[:]
-    del delta_3
-    print('Done delta_3', flush=True)
+def set_threads(nthreads=None):
+    """
+    Number of threads for the FFTs and the painting of a single process (default: all cores).
+    On one rank fft_r2c and fft_c2r then go through scipy.fft with that many workers instead
+    of the single-threaded pfft plans, and paint_fields paints chunks of particles on a thread
+    pool. All threads work on the same mesh buffers, nothing is copied between them. With
+    several ranks the FFTs stay with pfft and only the painting is threaded.
+    """
+    global _NTHREADS
+    if nthreads is None:
+        nthreads = os.cpu_count() or 1
+    _NTHREADS = max(1, int(nthreads))
+    return _NTHREADS
 
-    def potential_transfer_function(k, v):
-        k2 = k.normp(zeromode=1)
-        return v / (k2)
-    pot_k = delta_ic.apply(potential_transfer_function, out=Ellipsis)
+def _threaded_fft(pm):
+    return _NTHREADS > 1 and pm.comm.size == 1
 
-    displ_catalog = np.empty(N, dtype=[('displ', ('f8',3))])
-    
-    for d in range(3):
-        def force_transfer_function(k, v, d=d):
-            return k[d] * 1j * v
-        force_d = pot_k.apply(force_transfer_function).c2r(out=Ellipsis)
-        displ_catalog['displ'][:, d] = force_d.readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    
-    catalog['Position'][:] = (catalog['Position'][:] + displ_catalog['displ'][:]) % BoxSize
-    del displ_catalog, force_d, pot_k
-    
-    catalog = ArrayCatalog(catalog, BoxSize=BoxSize * np.ones(3), Nmesh=Nmesh, comm=comm)
-    
-    d1 = catalog.to_mesh(value='delta_1', compensated=compensate).paint().r2c()
-    d2 = catalog.to_mesh(value='delta_2', compensated=compensate).paint().r2c()
-    dG2 = catalog.to_mesh(value='delta_G2', compensated=compensate).paint().r2c()
-    d3 = catalog.to_mesh(value='delta_3', compensated=compensate).paint().r2c()
-    
-    return d1, d2, dG2, d3
+def fft_r2c(real, out=None):
+    """
+    real.r2c(out), with pmesh's normalization (1/Nmesh^3 forward), threaded on a single rank.
+    out=Ellipsis reuses the memory of real, as in r2c.
+    """
+    if not _threaded_fft(real.pm):
+        return real.r2c(out=out)
+    profile_count('nfft')
+    value = scipy.fft.rfftn(real.value, norm='forward', workers=_NTHREADS)
+    if out is Ellipsis:
+        out = real.pm.create(type='complex', base=real._base)
+    elif out is None:
+        out = real.pm.create(type='complex')
+    # value is in logical (x, y, z) order, whatever the layout of the buffer
+    out.value[...] = value
+    return out
+
+def fft_c2r(cfield, out=None):
+    """
+    cfield.c2r(out) (unnormalized backward transform), threaded on a single rank.
+    out=Ellipsis reuses the memory of cfield, as in c2r.
+    """
+    if not _threaded_fft(cfield.pm):
+        return cfield.c2r(out=out)
+    profile_count('nfft')
+    value = scipy.fft.irfftn(cfield.value, s=tuple(cfield.pm.Nmesh), norm='forward', workers=_NTHREADS)
+    if out is Ellipsis:
+        out = cfield.pm.create(type='real', base=cfield._base)
+    elif out is None:
+        out = cfield.pm.create(type='real')
+    out.value[...] = value
+    return out
+
+def readout_lagrangian(field, pos, layout=None):
+    """
+    Sample a real field at the Lagrangian particles of pm.generate_uniform_particle_grid(shift=0).
 
-def generate_fields_new_smooth_cubic(dlin, cosmo, zic, zout, comm=None, compensate=True, Rgsmooth=20):
-    delta_ic = dlin.copy()
-    scale_factor = 1/(1+zout)
-    Nmesh = delta_ic.Nmesh
-    BoxSize = delta_ic.BoxSize[0]
+    Those particles sit exactly on the local mesh nodes, in the same C order as field.value,
+    so with layout=None the CIC readout reduces to a copy of the local slab (no decompose,
+    no particle exchange). Pass a layout from pm.decompose to fall back to the full readout.
+    """
+    if layout is None:
+        return field.value.flatten()
+    return field.readout(pos, layout=layout, resampler='cic')
+
+def _exchange(layout, array):
+    # layout.exchange, counting the bytes sent to other ranks for the profiler
+    sent = layout.sendcounts.sum() - layout.sendcounts[layout.comm.rank]
+    profile_count('exchange_bytes', int(sent) * array[:1].nbytes)
+    return layout.exchange(array)
+
+def decompose_particles(pos, pm):
+    """
+    Layout of the particles at pos (shape (N, 3)) for CIC painting on pm, and pos exchanged with
+    it, so that several paint_fields calls can share one exchange of the positions.
+    """
+    # smoothing = half the CIC support, so particles next to a domain edge reach both ranks
+    layout = pm.decompose(pos, smoothing=1.0)
+    return layout, _exchange(layout, pos)
+
+def paint_fields(pos, columns, pm, compensate=True, chunksize=1024**2, layout=None):
+    """
+    CIC-paint several weight columns of the same particles, one mesh per column.
+
+    Equivalent to ArrayCatalog(...).to_mesh(value=column, compensated=compensate).paint().r2c()
+    for every column, but the particles are decomposed and exchanged once and the CIC kernel
+    (cells and weights) is computed once per chunk and shared by all columns. A column of None
+    paints the unweighted number density. As in nbodykit, every mesh is divided by the mean
+    number of particles per cell. With the layout of decompose_particles, pos are the positions
+    it exchanged and only the columns are exchanged. Returns a list of ComplexFields.
+    """
+    if layout is None:
+        layout, pos = decompose_particles(pos, pm)
+    N = pm.comm.allreduce(layout.sendlength)
+    columns = [None if column is None else _exchange(layout, column) for column in columns]
+    reals = [pm.create(type='real', value=0) for column in columns]
+    paint_cic(pos, columns, reals, chunksize=chunksize)
+    return finish_paint(reals, N, compensate=compensate)
+
+def paint_cic(pos, columns, reals, chunksize=1024**2):
+    """
+    Add the CIC assignment of the local particles at pos (already exchanged with
+    decompose_particles) weighted by each column (None for unit weights) to the real field of
+    the same index, on chunksize particles at a time (on the threads of set_threads).
+    """
+    pm = reals[0].pm
+    start = pm.partition.local_i_start
+    shape = pm.partition.local_i_shape
+    H = pm.BoxSize / pm.Nmesh
+    if reals[0].value.size == 0:
+        return
+    # pmesh pads the last axis of the real fields (PFFT_PADDED_R2C), so value is not contiguous
+    # and reshape(-1) would be a copy: the cells are addressed through the strides of value, in
+    # a flat view of its buffer (all the reals of a pm have the same layout)
+    itemsize = reals[0].value.itemsize
+    strides = [st // itemsize for st in reals[0].value.strides]
+    span = sum((n - 1) * st for n, st in zip(shape, strides)) + 1
+    flats = [np.lib.stride_tricks.as_strided(real.value, shape=(span,), strides=(itemsize,)) for real in reals]
+
+    lock = threading.Lock()
+    def paint_chunk(s):
+        x = pos[s:s+chunksize] / H
+        i0 = np.floor(x).astype('intp')
+        x -= i0
+
+        cells, weights, src = [], [], []
+        for corner in np.ndindex(2, 2, 2):
+            cell = 0
+            w = 1.
+            inside = np.ones(len(x), dtype='?')
+            for d in range(3):
+                i = (i0[:, d] + corner[d]) % pm.Nmesh[d] - start[d]
+                inside &= (i >= 0) & (i < shape[d])
+                cell = cell + i * strides[d]
+                w = w * (x[:, d] if corner[d] else 1 - x[:, d])
+            cells.append(cell[inside])
+            weights.append(w[inside])
+            src.append(np.nonzero(inside)[0])
+        cells = np.concatenate(cells)
+        weights = np.concatenate(weights)
+        src = np.concatenate(src)
+        if len(cells) == 0:
+            return
+
+        # particles are roughly in mesh order, so each chunk only touches a few planes
+        lo, hi = cells.min(), cells.max() + 1
+        cells -= lo
+        for flat, column in zip(flats, columns):
+            w = weights if column is None else weights * column[s:s+chunksize][src]
+            w = np.bincount(cells, weights=w, minlength=hi - lo)
+            # chunks painted by different threads can share planes
+            with lock:
+                flat[lo:hi] += w
+
+    chunks = range(0, len(pos), chunksize)
+    if _NTHREADS > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(_NTHREADS) as pool:
+            list(pool.map(paint_chunk, chunks))
+    else:
+        for s in chunks:
+            paint_chunk(s)
+
+def finish_paint(reals, N, compensate=True):
+    """
+    Complex fields of the meshes painted by paint_cic with N particles in total: divided by the
+    mean number of particles per cell, Fourier transformed in place and CIC compensated.
+    """
+    nbar = 1. * N / np.prod(reals[0].pm.Nmesh)
+    fields = []
+    for real in reals:
+        if nbar > 0:
+            real[...] /= nbar
+        field = fft_r2c(real, out=Ellipsis)
+        if compensate:
+            field.apply(CompensateCICShotnoise, kind='circular', out=Ellipsis)
+        fields.append(field)
+    return fields
+
+# operators painted as products of sampled ones
+_DERIVED_OPERATORS = {'d2': ['d1'], 'G2d': ['G2', 'd1']}
+
+def generate_fields_operators(dlin, operators, prefactor, fout=None, axis=2, comm=None, compensate=True, grid_aligned=True,
+                              cubic_filter=None, subtract_mean=('d1', 'd2'), paint_group=None, memory_budget=None, verbose=True):
+    """
+    Shifted operators for any list of names of LAGRANGIAN_OPERATORS, plus 'dz' for the shifted
+    (unweighted) density. The operators are computed on the Lagrangian grid with the FFT plan of
+    compute_lagrangian_operators, scaled by prefactor**order, sampled at the particles and painted
+    at the Zeldovich-displaced positions (with the displacement along axis scaled by 1+fout if fout
+    is given). d2 and G2d are the products of the sampled d1 and G2; operators in subtract_mean
+    have their mean over the particles removed. Returns the complex fields in the order requested.
+
+    The particles are stored column by column: the positions as one contiguous array per axis
+    and every operator as its own array. The displacements are computed first, then each operator
+    is sampled and painted as soon as paint_group operators are ready, and its column is freed
+    right after. paint_group=None paints all of them together, sharing the CIC kernel (fastest);
+    paint_group=1 keeps the positions and about two columns in memory at any time. With a
+    memory_budget in bytes, the particles are instead streamed in chunks of slabs of that size,
+    see generate_fields_streamed.
+
+    The operators, positions and weights are in the precision of dlin (single precision for
+    get_dlin(..., dtype='f4')); the means and the power spectra are accumulated in double
+    precision either way. The output meshes are single precision, as nbodykit's to_mesh.
+    """
+    if memory_budget is not None:
+        if not grid_aligned:
+            raise Exception('Streaming the particles needs a grid aligned readout')
+        return generate_fields_streamed(dlin, operators, prefactor, fout=fout, axis=axis, comm=comm, compensate=compensate,
+                                        cubic_filter=cubic_filter, subtract_mean=subtract_mean,
+                                        memory_budget=memory_budget, verbose=verbose)
+    Nmesh = dlin.Nmesh
+    BoxSize = dlin.BoxSize[0]
+    dtype = dlin.pm.dtype
+    pm = ParticleMesh(Nmesh=Nmesh, BoxSize=BoxSize * np.ones(3), comm=dlin.pm.comm if comm is None else comm, dtype='f4')
+
+    # Lagrangian positions, one contiguous array per axis; q is only kept for a readout that is
+    # not grid aligned (otherwise the readout is a copy of the local slab)
+    q = dlin.pm.generate_uniform_particle_grid(shift=0)
+    readout_layout = None if grid_aligned else dlin.pm.decompose(q)
+    pos = np.array(q.T, dtype=dtype, order='C')
+    if grid_aligned:
+        q = None
+    rsd_factor = np.ones(3)
+    if fout is not None:
+        rsd_factor[axis] = 1+fout
+
+    weights = [name for name in operators if name != 'dz']
+    derived = _DERIVED_OPERATORS
+    sampled = []
+    for name in weights:
+        for dep in derived.get(name, [name]):
+            if dep not in sampled:
+                sampled.append(dep)
+
+    columns = {}   # sampled operators still needed by an output
+    ready = {}     # output columns waiting to be painted
+    todo = list(weights)
+    painted = {}
+    particles = {}  # layout and exchanged positions, once the particles have moved
+    def paint(flush=False):
+        names = list(ready)
+        if 'dz' in operators and 'dz' not in painted:
+            names.append('dz')
+        if not names or not flush and (paint_group is None or len(ready) < paint_group):
+            return
+        cols = [ready.pop(name) if name != 'dz' else None for name in names]
+        fields = paint_fields(particles['pos'], cols, pm, compensate=compensate, layout=particles['layout'])
+        del cols
+        painted.update(zip(names, fields))
+
+    def sample(name, field):
+        nonlocal pos
+        col = readout_lagrangian(field, q, readout_layout)*prefactor**LAGRANGIAN_OPERATORS[name]
+        if name.startswith('psi'):
+            d = int(name[3])
+            pos[d] += col * rsd_factor[d]
+            pos[d] %= BoxSize
+            if d == 2:
+                # the particles have moved: exchange them once for all the paints
+                particles['layout'], particles['pos'] = decompose_particles(pos.T, pm)
+                pos = None
+            return
+        if name in subtract_mean:
+            col -= np.mean(col, dtype='f8')
+        columns[name] = col
+        for out in list(todo):
+            deps = derived.get(out, [out])
+            if not all(dep in columns for dep in deps):
+                continue
+            if out == 'd2':
+                ready[out] = columns['d1']**2
+            elif out == 'G2d':
+                ready[out] = columns['G2'] * columns['d1']
+            else:
+                ready[out] = columns[out]
+            if out in derived and out in subtract_mean:
+                ready[out] -= np.mean(ready[out], dtype='f8')
+            todo.remove(out)
+        for dep in list(columns):
+            if not any(dep in derived.get(out, [out]) for out in todo):
+                del columns[dep]
+        paint()
+
+    compute_lagrangian_operators(dlin, ['psi0', 'psi1', 'psi2'] + sampled, axis=axis, cubic_filter=cubic_filter,
+                                 callback=sample, verbose=verbose)
+    paint(flush=True)
+    fields = [painted.pop(name) for name in operators]
+    if 'dz' in operators:
+        # subtracting the mean of the real field is zeroing the k=0 mode
+        fields[operators.index('dz')].csetitem([0, 0, 0], 0)
+    return fields
+
+def lagrangian_meshes(dlin, operators, prefactor, axes=(2,), cubic_filter=None, subtract_mean=('d1', 'd2'), verbose=True):
+    """
+    The Lagrangian stage of generate_fields_operators, kept as meshes on the Lagrangian grid so
+    that it can be painted several times with paint_shifted: the displacements psi0-2 and the
+    operators the outputs in operators are sampled from (G2par once per axis of axes, as
+    'G2par_<axis>'), scaled by prefactor**order and with the operators of subtract_mean made
+    zero mean over the local slab. Returns a dict of real fields.
+    """
+    sampled = []
+    for name in operators:
+        if name == 'dz':
+            continue
+        deps = ['G2par_%d' % axis for axis in axes] if name == 'G2par' else _DERIVED_OPERATORS.get(name, [name])
+        sampled += [dep for dep in deps if dep not in sampled]
+    meshes = compute_lagrangian_operators(dlin, ['psi0', 'psi1', 'psi2'] + sampled, cubic_filter=cubic_filter,
+                                          verbose=verbose)
+    for name, mesh in meshes.items():
+        mesh.value[...] *= prefactor**LAGRANGIAN_OPERATORS[name]
+        if name.split('_')[0] in subtract_mean:
+            mesh.value[...] -= np.mean(mesh.value, dtype='f8')
+    return meshes
+
+def paint_shifted(meshes, operators, fout=None, axis=2, comm=None, compensate=True, subtract_mean=('d1', 'd2'),
+                  memory_budget=None, prefactor=1., verbose=True):
+    """
+    Paint the operators of the meshes of lagrangian_meshes at the Zeldovich-displaced positions
+    (displacement along axis scaled by 1+fout if fout is given), as generate_fields_operators
+    with grid_aligned=True. The displacements and operators are further scaled by
+    prefactor**order on the fly, so that meshes computed once with a unit growth factor can be
+    painted at several redshifts. With a memory_budget in bytes the local slabs are processed in
+    chunks: the particles of a chunk are displaced, weighted, exchanged and painted into the
+    output meshes before the next chunk is built, so a chunk holds at most about memory_budget
+    bytes per rank of positions, weights and their exchanged copies. Without one all the
+    particles are painted at once. The means of subtract_mean of d2 and G2d are taken over the
+    local slab, i.e. over the particles of the rank, as in generate_fields_operators.
+    """
+    mesh = meshes['psi0']
+    Nmesh = mesh.pm.Nmesh
+    BoxSize = mesh.pm.BoxSize[0]
+    dtype = mesh.pm.dtype
+    pm = ParticleMesh(Nmesh=Nmesh, BoxSize=BoxSize * np.ones(3), comm=mesh.pm.comm if comm is None else comm, dtype='f4')
+    rsd_factor = np.ones(3)
+    if fout is not None:
+        rsd_factor[axis] = 1+fout
+    weights = [name for name in operators if name != 'dz']
+    sampled = lambda name: meshes['G2par_%d' % axis] if name == 'G2par' else meshes[name]
+
+    # the derived operators are products of the sampled ones, their means are summed slab by slab
+    local = mesh.value.shape
+    means = {}
+    for name in _DERIVED_OPERATORS:
+        if name in weights and name in subtract_mean:
+            total = 0.
+            for i in range(local[0]):
+                d1 = meshes['d1'].value[i]
+                total += np.sum(d1**2 if name == 'd2' else meshes['G2'].value[i] * d1, dtype='f8')
+            means[name] = total / max(1, np.prod(local))
+
+    if memory_budget is None:
+        nslabs = max(1, local[0])
+    else:
+        # slabs per chunk: positions and weights, and their exchanged copies
+        nbytes = 2 * (3 + len(weights)) * np.dtype(dtype).itemsize
+        nslabs = max(1, int(memory_budget // (nbytes * max(1, np.prod(local[1:])))))
+    # every rank takes part in the exchange of every chunk
+    nchunks = max(pm.comm.allgather(-(-local[0] // nslabs)))
+    start = mesh.pm.partition.local_i_start
+    H = mesh.pm.BoxSize / mesh.pm.Nmesh
+    if verbose and nchunks > 1 and pm.comm.rank == 0:
+        print('Painting the particles in %d chunks of %d slabs' % (nchunks, nslabs), flush=True)
+
+    reals = [pm.create(type='real', value=0) for name in operators]
+    for chunk in range(nchunks):
+        sl = slice(chunk * nslabs, (chunk + 1) * nslabs)
+        shape = mesh.value[sl].shape
+        pos = np.empty((3, int(np.prod(shape))), dtype=dtype)
+        for d in range(3):
+            # Lagrangian coordinates of the slabs, in the order of pm.generate_uniform_particle_grid
+            x = (start[d] + np.arange(shape[d]) + (sl.start if d == 0 else 0)) * H[d]
+            pos[d] = np.broadcast_to(x.reshape([-1 if i == d else 1 for i in range(3)]), shape).ravel()
+            pos[d] += meshes['psi%d' % d].value[sl].ravel() * (prefactor * rsd_factor[d])
+            pos[d] %= BoxSize
+        layout, pos = decompose_particles(pos.T, pm)
+
+        columns = []
+        for name in operators:
+            if name == 'dz':
+                column = None
+            elif name == 'd2':
+                column = meshes['d1'].value[sl].ravel()**2
+            elif name == 'G2d':
+                column = meshes['G2'].value[sl].ravel() * meshes['d1'].value[sl].ravel()
+            else:
+                column = sampled(name).value[sl].ravel()
+            if name in means:
+                column = column - means[name]
+            if column is not None and prefactor != 1:
+                column = column * prefactor**LAGRANGIAN_OPERATORS[name]
+            columns.append(None if column is None else _exchange(layout, column))
+        paint_cic(pos, columns, reals, chunksize=min(1024**2, max(1, len(pos))))
+        del pos, columns
+
+    fields = finish_paint(reals, np.prod(Nmesh), compensate=compensate)
+    if 'dz' in operators:
+        # subtracting the mean of the real field is zeroing the k=0 mode
+        fields[operators.index('dz')].csetitem([0, 0, 0], 0)
+    return fields
+
+def generate_fields_streamed(dlin, operators, prefactor, fout=None, axis=2, comm=None, compensate=True, cubic_filter=None,
+                             subtract_mean=('d1', 'd2'), memory_budget=1024**3, verbose=True):
+    """
+    generate_fields_operators (with grid_aligned=True) with bounded particle memory: the
+    displacements and the sampled operators are kept as meshes (lagrangian_meshes) and painted
+    slab by slab within memory_budget bytes per rank (paint_shifted). The meshes come on top of
+    the budget. The output is the same as generate_fields_operators up to rounding.
+    """
+    meshes = lagrangian_meshes(dlin, operators, prefactor, axes=[axis], cubic_filter=cubic_filter,
+                               subtract_mean=subtract_mean, verbose=verbose)
+    return paint_shifted(meshes, operators, fout=fout, axis=axis, comm=comm, compensate=compensate,
+                         subtract_mean=subtract_mean, memory_budget=memory_budget, verbose=verbose)
+
+def generate_fields_los(dlin, cosmo, zic, zout, axes=(0, 1, 2), real=True, comm=None, compensate=True, memory_budget=None,
+                        callback=None, verbose=True):
+    """
+    The shifted fields of generate_fields_new (if real) and of generate_fields_rsd_new along each
+    line of sight of axes, sharing one Lagrangian stage: the displacements and operators are
+    computed once and every output only costs a paint (see paint_shifted). The outputs are keyed
+    'real' or by the axis; without callback they are returned in a dict, otherwise each list of
+    fields is passed to callback(key, fields) as soon as it is painted.
+    """
     prefactor = cosmo.scale_independent_growth_factor(zout)/cosmo.scale_independent_growth_factor(zic)
-    
-    pos = delta_ic.pm.generate_uniform_particle_grid(shift=0)
-    N = pos.shape[0]
-    catalog = np.empty(N, dtype=[('Position', ('f8', 3)), ('delta_1', 'f8'), ('delta_2', 'f8'), ('delta_G2', 'f8'), ('delta_3', 'f8'), 
-                                 ('delta_Gamma3', 'f8'), ('delta_G2delta', 'f8'), ('delta_S3', 'f8'), ('delta_G3', 'f8')])
-    catalog['Position'][:] = pos[:]
-    layout = delta_ic.pm.decompose(catalog['Position']) 
-    del pos
-    
-    delta_1 = delta_ic.c2r().readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    delta_1 -= np.mean(delta_1)
-    catalog['delta_1'][:] = delta_1[:]
-    
-    catalog['delta_2'][:] = catalog['delta_1']**2
-    catalog['delta_2'][:] -= np.mean(catalog['delta_2'])
-    
-    delta_G2 = tidal_G2(FieldMesh(delta_ic)).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**2
-    print (np.mean(delta_G2))
-    catalog['delta_G2'][:] = delta_G2[:]
-    catalog['delta_G2delta'][:] = delta_G2[:] * delta_1[:]
-    print ('mean G2 * delta ', np.mean(delta_G2 * delta_1))
-    del delta_1
-    
-    delta_3 = FieldMesh(delta_ic).apply(Gaussian(Rgsmooth)).compute(mode='real').readout(catalog['Position'], layout=layout, resampler='cic')**3*prefactor**3
-    print ('mean delta_3 ', np.mean(delta_3))
-    delta_3 -= np.mean(delta_3)
-    catalog['delta_3'][:] = delta_3[:]
-    print ('mean delta_3 ', np.mean(delta_3))
-    del delta_3
-    
-    delta_ic = FieldMesh(delta_ic).apply(Gaussian(Rgsmooth))
-    
-    delta_Gamma3 = Gamma3(delta_ic).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**3        
-    print ('mean delta_Gamma3', np.mean(delta_Gamma3))
-    delta_Gamma3 -= np.mean(delta_Gamma3)
-    catalog['delta_Gamma3'][:] = delta_Gamma3[:]
-    print ('mean delta_Gamma3', np.mean(delta_Gamma3))
-
-    delta_G3 = G3(delta_ic).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**3
-    print ('mean delta_G3', np.mean(delta_G3))
-    delta_G3 -= np.mean(delta_G3)
-    catalog['delta_G3'][:] = delta_G3[:]
-    print ('mean delta_G3', np.mean(delta_G3))
-    
-    delta_S3 = S3(delta_ic).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**3
-    print ('mean delta_S3 ', np.mean(delta_S3))
-    delta_S3 -= np.mean(delta_S3)
-    catalog['delta_S3'][:] = delta_S3[:]
-    print ('mean delta_S3 ', np.mean(delta_S3))
-    del delta_G2, delta_Gamma3, delta_S3, delta_G3
-    
-    def potential_transfer_function(k, v):
-        k2 = k.normp(zeromode=1)
-        return v / (k2)
-    pot_k = dlin.copy().apply(potential_transfer_function, out=Ellipsis)
+    fout = cosmo.scale_independent_growth_rate(zout)
+    meshes = lagrangian_meshes(dlin, ['d1', 'd2', 'G2', 'd3'] + (['G2par'] if len(axes) else []), prefactor, axes=axes,
+                               verbose=verbose)
+    out = {}
+    for key in (['real'] if real else []) + list(axes):
+        if key == 'real':
+            fields = paint_shifted(meshes, ['d1', 'd2', 'G2', 'd3'], comm=comm, compensate=compensate,
+                                   memory_budget=memory_budget, verbose=verbose)
+        else:
+            fields = paint_shifted(meshes, ['dz', 'd1', 'd2', 'G2', 'G2par', 'd3'], fout=fout, axis=key, comm=comm,
+                                   compensate=compensate, memory_budget=memory_budget, verbose=verbose)
+        if callback is None:
+            out[key] = fields
+        else:
+            callback(key, fields)
+        del fields
+    return out
 
-    displ_catalog = np.empty(N, dtype=[('displ', ('f8',3))])
-    
-    for d in range(3):
-        def force_transfer_function(k, v, d=d):
-            return k[d] * 1j * v
-        force_d = pot_k.apply(force_transfer_function).c2r(out=Ellipsis)
-        displ_catalog['displ'][:, d] = force_d.readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    
-    catalog['Position'][:] = (catalog['Position'][:] + displ_catalog['displ'][:]) % BoxSize
-    del displ_catalog, force_d, pot_k
-    
-    catalog = ArrayCatalog(catalog, BoxSize=BoxSize * np.ones(3), Nmesh=Nmesh, comm=comm)
-    
-    d1 = catalog.to_mesh(value='delta_1', compensated=compensate).paint().r2c()
-    d2 = catalog.to_mesh(value='delta_2', compensated=compensate).paint().r2c()
-    dG2 = catalog.to_mesh(value='delta_G2', compensated=compensate).paint().r2c()
-    d3 = catalog.to_mesh(value='delta_3', compensated=compensate).paint().r2c()
-    dGamma3 = catalog.to_mesh(value='delta_Gamma3', compensated=compensate).paint().r2c()
-    dG2d = catalog.to_mesh(value='delta_G2delta', compensated=compensate).paint().r2c()
-    dS3 = catalog.to_mesh(value='delta_S3', compensated=compensate).paint().r2c()
-    dG3 = catalog.to_mesh(value='delta_G3', compensated=compensate).paint().r2c()
-    
+def generate_fields_new(dlin, cosmo, zic, zout, comm=None, compensate=True, grid_aligned=True, paint_group=None,
+                        memory_budget=None):
+    prefactor = cosmo.scale_independent_growth_factor(zout)/cosmo.scale_independent_growth_factor(zic)
+    d1, d2, dG2, d3 = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3'], prefactor, comm=comm, compensate=compensate,
+                                                grid_aligned=grid_aligned, paint_group=paint_group, memory_budget=memory_budget)
+    return d1, d2, dG2, d3
+
+def generate_fields_new_smooth_cubic(dlin, cosmo, zic, zout, comm=None, compensate=True, Rgsmooth=20, grid_aligned=True,
+                                     paint_group=None, memory_budget=None):
+    prefactor = cosmo.scale_independent_growth_factor(zout)/cosmo.scale_independent_growth_factor(zic)
+    # the cubic operators are built from the Gaussian smoothed field
+    fields = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3', 'Gamma3', 'G2d', 'S3', 'G3'], prefactor, comm=comm,
+                                       compensate=compensate, grid_aligned=grid_aligned, cubic_filter=Gaussian(Rgsmooth).filter,
+                                       subtract_mean=('d1', 'd2', 'd3', 'Gamma3', 'S3', 'G3'), paint_group=paint_group,
+                                       memory_budget=memory_budget)
+    d1, d2, dG2, d3, dGamma3, dG2d, dS3, dG3 = fields
     return d1, d2, dG2, d3, dGamma3, dG2d, dS3, dG3
 
 # def generate_fields_new_gamma3(dlin, cosmo, zic, zout, comm=None, compensate=True):
@@ -437,74 +748,15 @@ def generate_fields_rsd(delta_ic, cosmo, nbar, zic, zout, fout, plot=True, weigh
 
     return dz, d1, d2, dG2, dG2par, d3
 
-def generate_fields_rsd_new(dlin, cosmo, zic, zout, axis=2, comm=None, compensate=True):
-    delta_ic = dlin.copy()
-    scale_factor = 1/(1+zout)
-    Nmesh = delta_ic.Nmesh
-    BoxSize = delta_ic.BoxSize[0]
+def generate_fields_rsd_new(dlin, cosmo, zic, zout, axis=2, comm=None, compensate=True, grid_aligned=True, paint_group=None,
+                            memory_budget=None):
     prefactor = cosmo.scale_independent_growth_factor(zout)/cosmo.scale_independent_growth_factor(zic)
     fout = cosmo.scale_independent_growth_rate(zout)
-
-    pos = delta_ic.pm.generate_uniform_particle_grid(shift=0)
-    N = pos.shape[0]
-    catalog = np.empty(N, dtype=[('Position', ('f8', 3)), ('delta_1', 'f8'), ('delta_2', 'f8'), ('delta_G2', 'f8'), ('delta_G2_par', 'f8'), ('delta_3', 'f8')])
-    catalog['Position'][:] = pos[:]
-    del pos
-    
-    layout = delta_ic.pm.decompose(catalog['Position']) 
-
-    delta_1 = delta_ic.c2r().readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    delta_1 -= np.mean(delta_1)
-    catalog['delta_1'][:] = delta_1[:]
-    del delta_1
-    
-    catalog['delta_2'][:] = catalog['delta_1']**2
-    catalog['delta_2'][:] -= np.mean(catalog['delta_2'])
-    
-    delta_G2 = tidal_G2(FieldMesh(delta_ic))#
-    catalog['delta_G2'][:] = delta_G2.readout(catalog['Position'], layout=layout, resampler='cic')[:]*prefactor**2
-    
-    delta_G2_par = tidal_G2_par(FieldMesh(delta_G2), axis=axis).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**2
-    catalog['delta_G2_par'][:] = delta_G2_par[:]
-    del delta_G2, delta_G2_par
-    
-    delta_3 = d3_smooth(FieldMesh(delta_ic)).readout(catalog['Position'], layout=layout, resampler='cic')**3*prefactor**3
-    catalog['delta_3'][:] = delta_3[:]
-    del delta_3
-    
-    def potential_transfer_function(k, v):
-        k2 = k.normp(zeromode=1)
-        return v / (k2)
-    pot_k = delta_ic.apply(potential_transfer_function, out=Ellipsis)
-
-    displ_catalog = np.empty(N, dtype=[('displ', ('f8',3))])
-    
-    for d in range(3):
-        def force_transfer_function(k, v, d=d):
-            return k[d] * 1j * v
-        force_d = pot_k.apply(force_transfer_function).c2r(out=Ellipsis)
-        displ_catalog['displ'][:, d] = force_d.readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-
-    rsd_factor = np.ones(3)
-    rsd_factor[axis] = 1+fout
-    catalog['Position'][:] = (catalog['Position'][:] + displ_catalog['displ'][:] * rsd_factor) % BoxSize    
-    # catalog['Position'][:] = (catalog['Position'][:] + displ_catalog['displ'][:]*[1,1,(1+fout)]) % BoxSize
-    del displ_catalog, force_d, pot_k
-    
-    catalog = ArrayCatalog(catalog, BoxSize=BoxSize * np.ones(3), Nmesh=Nmesh, comm=comm)
-    
-    dz = catalog.to_mesh(compensated=compensate).paint()
-    dz -= dz.cmean()
-    dz = dz.r2c()
-    
-    d1 = catalog.to_mesh(value='delta_1', compensated=compensate).paint().r2c()
-    d2 = catalog.to_mesh(value='delta_2', compensated=compensate).paint().r2c()
-    dG2 = catalog.to_mesh(value='delta_G2', compensated=compensate).paint().r2c()
-    dG2par = catalog.to_mesh(value='delta_G2_par', compensated=compensate).paint().r2c()
-    d3 = catalog.to_mesh(value='delta_3', compensated=compensate).paint().r2c()
+    dz, d1, d2, dG2, dG2par, d3 = generate_fields_operators(dlin, ['dz', 'd1', 'd2', 'G2', 'G2par', 'd3'], prefactor, fout=fout,
+                                                            axis=axis, comm=comm, compensate=compensate, grid_aligned=grid_aligned,
+                                                            paint_group=paint_group, memory_budget=memory_budget)
     return dz, d1, d2, dG2, dG2par, d3
 
-# this routine is taken from here: https://github.com/mschmittfull/lsstools/
 def get_displacement_from_density_rfield(in_density_rfield,
                                          in_density_cfield=None,
                                          component=None,
@@ -591,38 +843,20 @@ def smoothen_cfield(in_pm_cfield, mode='Gaussian', R=0.0, kmax=None):
     # zero pad all k>=kmax
     if kmax is not None:
 
-        def kmax_fcn(k, v, kmax=kmax):
-            k2 = sum(ki**2 for ki in k)
-            return np.where(k2 < kmax**2, v, 0.0 * v)
-
-        pm_cfield = pm_cfield.apply(kmax_fcn, out=Ellipsis)
+        pm_cfield = apply_transfer(pm_cfield, lambda kg: kg.k2 < kmax**2, out=Ellipsis)
 
     # apply smoothing
     if mode == 'Gaussian':
         if R != 0.0:
 
-            def smoothing_fcn(k, v, R=R):
-                k2 = sum(ki**2 for ki in k)
-                W = np.exp(-0.5 * k2 * R**2)
-                #print("smoothing: k:", k)
-                #print("smoothing: :", W)
-                return v * W
-
-            pm_cfield = pm_cfield.apply(smoothing_fcn, out=Ellipsis)
+            pm_cfield = apply_transfer(pm_cfield, lambda kg: np.exp(-0.5 * kg.k2 * R**2), out=Ellipsis)
     elif mode == '1-Gaussian':
         if R == 0.0:
             # W=1 so 1-W=0 and (1-W)delta=0
             pm_cfield = 0 * pm_cfield
         else:
 
-            def OneMinusW_smoothing_fcn(k, v, R=R):
-                k2 = sum(ki**2 for ki in k)
-                W = np.exp(-0.5 * k2 * R**2)
-                #print("smoothing: k:", k)
-                #print("smoothing: :", W)
-                return v * (1.0 - W)
-
-            pm_cfield = pm_cfield.apply(OneMinusW_smoothing_fcn, out=Ellipsis)
+            pm_cfield = apply_transfer(pm_cfield, lambda kg: 1.0 - np.exp(-0.5 * kg.k2 * R**2), out=Ellipsis)
 
     else:
         raise Exception("Invalid smoothing mode %s" % str(mode))
@@ -645,246 +879,430 @@ def plotpk(delta_field, plot=True, label=None, second=None, ls='-'):
     if plot: plt.loglog(pk.power['k'], pk.power['power'].real, label=label, ls=ls)
     return pk
 
-def tidal_G2(delta):
-# Compute -delta^2(\vx)
-    out_rfield = - delta.compute(mode='real')**2
+class KGrid(object):
+    """
+    Wavevectors of the local slab of the complex fields of one ParticleMesh, in the layout of
+    field.value. Use kgrid(pm) to get the cached instance. k2, k and the masks are computed on
+    first use, in the dtype of the pm and with the same expressions as the transfer functions,
+    and kept; mu(los) is cached per line of sight and is NaN at k=0, as in the rsd filters.
+    """
+    def __init__(self, pm):
+        # sparse coordinates, broadcastable to the local complex field
+        self.kvec = pm.create_coords('complex')
+        self.kf = 2 * np.pi / np.asarray(pm.BoxSize, dtype='f8')
+        self._cache = {}
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    @property
+    def k2(self):
+        return self._cached('k2', lambda: sum(ki**2 for ki in self.kvec))
+
+    @property
+    def k(self):
+        return self._cached('k', lambda: self.k2**0.5)
+
+    @property
+    def k2_nozero(self):
+        # k^2 with the k=0 mode set to 1, to divide by k^2
+        def k2_nozero():
+            kk = self.k2.copy()
+            kk[kk == 0] = 1
+            return kk
+        return self._cached('k2_nozero', k2_nozero)
 
-    # Compute d_ij(x). It's symmetric in i<->j so only compute j>=i.
-    # d_ij = k_ik_j/k^2*basefield(\vk).
-    for idir in range(3):
-        for jdir in range(idir, 3):
-
-            def my_transfer_function(k3vec, val, idir=idir, jdir=jdir):
-                kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-                kk[kk == 0] = 1
-                return k3vec[idir] * k3vec[jdir] / kk * val
-
-            dij_k = delta.apply(my_transfer_function,
-                                          mode='complex',
-                                          kind='wavenumber')
-            del my_transfer_function
-            # do fft and convert field_mesh to RealField object
-            dij_x = dij_k.compute(mode='real')
-            # if verbose:
-                # rfield_print_info(dij_x, comm, 'd_%d%d: ' % (idir, jdir))
-            # Add \sum_{i,j=0..2} d_ij(\vx)d_ij(\vx)
-            #   = [d_00^2+d_11^2+d_22^2 + 2*(d_01^2+d_02^2+d_12^2)]
-            if jdir == idir:
-                fac = 1.0
-            else:
-                fac = 2.0
-            out_rfield += fac * dij_x**2
-            del dij_x, dij_k
-    return out_rfield
+    @property
+    def zero(self):
+        return self._cached('zero', lambda: self.k2 == 0)
 
-def Gamma3(delta):
-    # formula Gamma3 = -16/63 delta**3 + 8/21 delta * K**2 + 8/21 Kij d_i d_j / nabla^2 (delta**2 - 3/2 K**2) 
-    # Kij = d_i d_j / nabla^2  delta - delta / 3
-    # G2 = (didj/nabla^2 delta)^2 - delta^2
-    # G2 = K^2 - 2/3 delta^2
-    # Gamma3 = 8/21 delta * G2 - 24/63 Kij di dj/nabla^2 G2
-    
-    # Compute
-    delta_r = delta.compute(mode='real')
-    G2 = - delta_r**2
-    Gamma3_field = 0.
+    def kmask(self, kmax):
+        # k <= kmax
+        return self._cached(('kmask', kmax), lambda: self.k <= kmax)
 
-    # let's compute G2 again
+    def mu(self, los):
+        los = tuple(los)
+        def mu():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return sum(self.kvec[i] * los[i] for i in range(3)) / self.k
+        return self._cached(('mu', los), mu)
+
+    def kshell_index(self):
+        """
+        (kshells, index): |k| of the shells of the local slab and the shell of every mode, so
+        that f(kshells).take(index) is f(k). For equal fundamental modes along all axes the
+        shells are the integers n=(k/kf)^2, otherwise the distinct values of k^2.
+        """
+        def index():
+            kf = self.kf[0]
+            if np.allclose(self.kf, kf):
+                n = sum(np.rint(ki.astype('f8') / kf).astype(np.int64)**2 for ki in self.kvec)
+                n = n.astype(np.int32)
+                return kf * np.arange(n.max() + 1)**0.5, n
+            k2, n = np.unique(np.broadcast_to(self.k2, self.zero.shape), return_inverse=True)
+            return k2**0.5, n.reshape(self.zero.shape).astype(np.int32)
+        return self._cached('kshell', index)
+
+    def on_shells(self, func):
+        # func(k), evaluated once per |k| shell and scattered to the modes
+        kshells, index = self.kshell_index()
+        return np.asarray(func(kshells)).take(index)
+
+    def kbin_index(self, dk, nbins):
+        """
+        Slot of every mode in the table [fill_low, P_0, ..., P_{nbins-1}, fill_high] of the 1d
+        manual k binning (bin i is centered on (i+1)*dk), as in interp1d_manual_k_binning.
+        """
+        def index():
+            ibin = round_float2int_arr(self.k / dk) - 1
+            return _small_index(np.clip(ibin, -1, nbins) + 1, nbins + 2)
+        return self._cached(('kbin', dk, nbins), index)
+
+    def kmubin_index(self, kedges, muedges, los):
+        """
+        Slot of every mode in the table [fill_low, P_00, P_01, ..., fill_high, nan] of the 2d
+        (k, mu) binning with the given edges, as in interp1d_manual_k_binning. Modes with
+        mu=nan (k=0) go to the last slot.
+        """
+        kedges, muedges, los = tuple(kedges), tuple(muedges), tuple(los)
+        def index():
+            Nk, Nmu = len(kedges) - 1, len(muedges) - 1
+            mu = self.mu(los)
+            k_indices = np.digitize(self.k, kedges) - 1
+            with np.errstate(invalid='ignore'):
+                mu_indices = np.digitize(np.abs(mu), muedges) - 1
+            # mu==1 goes to the last bin, so it is right-inclusive
+            mu_indices[np.isclose(np.abs(mu), 1.0)] = Nmu - 1
+            if not np.all(mu_indices[~np.isnan(mu)] < Nmu):
+                raise Exception('Too large mu')
+            slot = np.where(k_indices < 0, 0, np.where(k_indices >= Nk, Nk * Nmu + 1,
+                                                       k_indices * Nmu + mu_indices + 1))
+            slot = np.where(np.isnan(mu), Nk * Nmu + 2, slot)
+            return _small_index(slot, Nk * Nmu + 3)
+        return self._cached(('kmubin', kedges, muedges, los), index)
 
-    # Compute d_ij(x). It's symmetric in i<->j so only compute j>=i.
-    # d_ij = k_ik_j/k^2*basefield(\vk).
-    for idir in range(3):
-        for jdir in range(idir, 3):
-
-            def my_transfer_function(k3vec, val, idir=idir, jdir=jdir):
-                kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-                kk[kk == 0] = 1
-                return k3vec[idir] * k3vec[jdir] / kk * val
-
-            dij_k = delta.apply(my_transfer_function,
-                                          mode='complex',
-                                          kind='wavenumber')
-            del my_transfer_function
-            # do fft and convert field_mesh to RealField object
-            dij_x = dij_k.compute(mode='real')
-            # if verbose:
-                # rfield_print_info(dij_x, comm, 'd_%d%d: ' % (idir, jdir))
-            # Add \sum_{i,j=0..2} d_ij(\vx)d_ij(\vx)
-            #   = [d_00^2+d_11^2+d_22^2 + 2*(d_01^2+d_02^2+d_12^2)]
-            if jdir == idir:
-                fac = 1.0
-            else:
-                fac = 2.0
-            G2 += fac * dij_x**2
-            del dij_x, dij_k
-            
-    # now let's compute the rest
-    Gamma3_field += 8./21. * delta_r * G2
+def _small_index(slot, nslots):
+    # int16 unless the table is too long for it
+    return slot.astype(np.int16 if nslots <= np.iinfo(np.int16).max else np.int32)
 
-    for idir in range(3):
-        for jdir in range(idir, 3):
-
-            def my_transfer_function(k3vec, val, idir=idir, jdir=jdir):
-                kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-                kk[kk == 0] = 1
-                return k3vec[idir] * k3vec[jdir] / kk * val
-
-            Kij_k = delta.apply(my_transfer_function,
-                                          mode='complex',
-                                          kind='wavenumber')
-            
-            DG2ij_k = FieldMesh(G2).apply(my_transfer_function,
-                                          mode='complex',
-                                          kind='wavenumber')
-            # del my_transfer_function
-            # do fft and convert field_mesh to RealField object
-            Kij_x = Kij_k.compute(mode='real')
-            if idir==jdir: 
-                Kij_x -= delta_r/3
-            DG2ij_x = DG2ij_k.compute(mode='real')
-            del Kij_k, DG2ij_k
-
-            if jdir == idir:
-                fac = 1.0
-            else:
-                fac = 2.0
-                
-            Gamma3_field += - fac * 4./7. * Kij_x*DG2ij_x
+_kgrids = weakref.WeakKeyDictionary()
 
-    return Gamma3_field
+def kgrid(pm):
+    """ The KGrid of pm, built on the first call and kept as long as pm is alive. """
+    if pm not in _kgrids:
+        _kgrids[pm] = KGrid(pm)
+    return _kgrids[pm]
 
-def S3(delta):
-    delta_r = delta.compute(mode='real')
-    G2 = - delta_r**2
-    S3_field = 0.
-    # let's compute G2 again
-    # Compute d_ij(x). It's symmetric in i<->j so only compute j>=i.
-    # d_ij = k_ik_j/k^2*basefield(\vk).
-    for idir in range(3):
-        for jdir in range(idir, 3):
-
-            def my_transfer_function(k3vec, val, idir=idir, jdir=jdir):
-                kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-                kk[kk == 0] = 1
-                return k3vec[idir] * k3vec[jdir] / kk * val
-
-            dij_k = delta.apply(my_transfer_function,
-                                          mode='complex',
-                                          kind='wavenumber')
-            del my_transfer_function
-            # do fft and convert field_mesh to RealField object
-            dij_x = dij_k.compute(mode='real')
-            # if verbose:
-                # rfield_print_info(dij_x, comm, 'd_%d%d: ' % (idir, jdir))
-            # Add \sum_{i,j=0..2} d_ij(\vx)d_ij(\vx)
-            #   = [d_00^2+d_11^2+d_22^2 + 2*(d_01^2+d_02^2+d_12^2)]
-            if jdir == idir:
-                fac = 1.0
+def apply_transfer(field, transfer, out=None):
+    """
+    Multiply a complex field by a transfer function of the wavevector, on the whole local slab
+    at once. transfer is an array broadcastable to the local field or a function of the KGrid of
+    the field's pm, e.g. lambda kg: Pk(kg.k)**0.5. out=Ellipsis works in place, as in apply.
+    """
+    if callable(transfer):
+        transfer = transfer(kgrid(field.pm))
+    if out is Ellipsis:
+        out = field
+    elif out is None:
+        out = field.pm.create(type=type(field))
+    np.multiply(field.value, transfer, out=out.value)
+    return out
+
+def _kslab_chunks(field, los, chunksize):
+    # (slice of value axis 0, k, mu) over chunks of about chunksize modes of the local k-slab
+    kvec = kgrid(field.pm).kvec
+    nslab = field.value.shape[0]
+    step = max(1, chunksize // max(1, field.value[0].size))
+    for i0 in range(0, nslab, step):
+        sl = slice(i0, i0 + step)
+        kslab = [ki[sl] if ki.shape[0] != 1 else ki for ki in kvec]
+        k = sum(ki**2 for ki in kslab)**0.5
+        mu = None
+        if los is not None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mu = sum(kslab[i] * los[i] for i in range(3)) / k
+        yield sl, k, mu
+
+def scale_field(field, beta, los=None, chunksize=1024**2):
+    """
+    field *= beta(k, mu) in place for a complex field, chunk by chunk as in assemble_fields, with
+    nan products set to zero. Returns field.
+    """
+    for sl, k, mu in _kslab_chunks(field, los, chunksize):
+        v = field.value[sl]
+        v *= beta(k, mu)
+        v[np.isnan(v)] = 0
+    return field
+
+def assemble_fields(terms, los=None, out=None, chunksize=1024**2):
+    """
+    Sum_i beta_i(k, mu) O_i of complex fields in one pass over the local k-slab. terms is a list
+    of (field, beta), beta a number, a function of (k, mu) arrays (mu along los, nan at k=0;
+    None if los is None) or a (table, index) pair from the lookup of an interpolator of
+    interp1d_manual_k_binning. Where a term with a non-scalar beta is nan it is set to zero, as
+    in the rsd filters. The betas are evaluated on chunks of about chunksize modes, so the
+    output is the only full mesh allocated.
+    """
+    if out is None:
+        out = terms[0][0].pm.create(type='complex', value=0)
+    for sl, k, mu in _kslab_chunks(out, los, chunksize):
+        acc = out.value[sl]
+        for field, beta in terms:
+            if isinstance(beta, tuple):
+                term = beta[0].take(beta[1][sl]) * field.value[sl]
+                term[np.isnan(term)] = 0
+                acc += term
+            elif callable(beta):
+                term = beta(k, mu) * field.value[sl]
+                term[np.isnan(term)] = 0
+                acc += term
             else:
-                fac = 2.0
-            G2 += fac * dij_x**2
-            del dij_x, dij_k
-    
-    for idir in range(3):
-        print ('idir', idir)
-        def psi2(k3vec, val, idir=idir):
-            kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-            kk[kk == 0] = 1
-            return k3vec[idir] * 1j / kk * val
-        
-        def grad(k3vec, val, idir=idir):
-            return k3vec[idir] * 1j * val
-        
-        G2_ii_k = FieldMesh(G2).apply(psi2, mode='complex', kind='wavenumber')
-        G2_ii_x = G2_ii_k.compute(mode='real')
-        del G2_ii_k
-        
-        d_i_k  = delta.apply(grad, mode='complex', kind='wavenumber')
-        d_i_x  = d_i_k.compute(mode='real')
+                acc += beta * field.value[sl]
+    return out
 
-        S3_field += G2_ii_x * d_i_x
+def _lagrangian_operator(delta, name, axis=2):
+    # one operator of the mesh delta from the operator graph, with the cubic operators of delta itself (no smoothing)
+    return compute_lagrangian_operators(delta.compute(mode='complex'), [name], axis=axis,
+                                        cubic_filter=lambda k, v: v)[name]
 
-    return -3./14. * S3_field
+def tidal_G2(delta):
+    # G2 = \sum_ij d_ij(\vx)d_ij(\vx) - delta^2(\vx)
+    return _lagrangian_operator(delta, 'G2')
 
-def G3(delta):
-    
-    # Compute
-    delta_r = delta.compute(mode='real')
-    G2_field = 0.#-delta_r**2 (this one doesn't have -delta^2)
+def _gamma3_term(delta_r, dij_x, DG2ij_x, idir, jdir):
+    # - 4/7 Kij di dj/nabla^2 G2 for one j>=i component, with Kij = d_ij - delta_ij delta / 3
+    if idir == jdir:
+        return - 4./7. * (dij_x - delta_r/3) * DG2ij_x
+    return - 2. * 4./7. * dij_x * DG2ij_x
+
+def _G3_field(delta_r, K2, dij):
+    # G3 = 3/2 (d_i d_j / nabla^2 delta)^2 * delta - (d_i d_j / nabla^2 delta)^3 - delta**3 / 2
     G3_field = -delta_r**3/2
- 
-    # Compute d_ij(x). It's symmetric in i<->j so only compute j>=i.
-    # d_ij = k_ik_j/k^2*basefield(\vk).
-    dij_x_dict = {}
-    for idir in range(3):
-        for jdir in range(idir, 3):
-
-            def my_transfer_function(k3vec, val, idir=idir, jdir=jdir):
-                kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-                kk[kk == 0] = 1
-                return k3vec[idir] * k3vec[jdir] * val / kk
-
-            dij_k = delta.apply(my_transfer_function,
-                                          mode='complex',
-                                          kind='wavenumber')
-            del my_transfer_function
-            # do fft and convert field_mesh to RealField object
-            dij_x = dij_k.compute(mode='real')
-            del dij_k
-            if jdir == idir:
-                fac = 1.0
-            else:
-                fac = 2.0
-            G2_field += fac * dij_x**2
-            dij_x_dict[(idir,jdir)] = dij_x
-            del dij_x
-
-    # get j<i by symmetry
-    def get_dij_x(idir, jdir):
-        if jdir>=idir:
-            return dij_x_dict[(idir,jdir)]
-        else:
-            return dij_x_dict[(jdir,idir)]
 
     # Compute - sum_ijl d_ij(k) d_il(q) d_jl(p)
     for idir in range(3):
         for jdir in range(3):
             for ldir in range(3):
                 G3_field -= (
-                      get_dij_x(idir,jdir)
-                    * get_dij_x(idir,ldir)
-                    * get_dij_x(jdir,ldir) )
+                      dij(idir,jdir)
+                    * dij(idir,ldir)
+                    * dij(jdir,ldir) )
 
     # take out the mean (already close to 0 but still subtract)
     mymean = G3_field.cmean()
-    # if comm.rank == 0:
-        # print('Subtract mean of G3: %g' % mymean)
     G3_field -= mymean 
 
-    ###
+    G3_field += 3/2 * K2 * delta_r
+
+    return G3_field
 
-    # formula G3 = 3/2 (d_i d_j / nabla^2 delta)^2 * delta - (d_i d_j / nabla^2 delta)^3 - delta**3 / 2
+def Gamma3(delta):
+    # formula Gamma3 = -16/63 delta**3 + 8/21 delta * K**2 + 8/21 Kij d_i d_j / nabla^2 (delta**2 - 3/2 K**2) 
+    # Kij = d_i d_j / nabla^2  delta - delta / 3
+    # G2 = (didj/nabla^2 delta)^2 - delta^2
+    # G2 = K^2 - 2/3 delta^2
+    # Gamma3 = 8/21 delta * G2 - 24/63 Kij di dj/nabla^2 G2
+    return _lagrangian_operator(delta, 'Gamma3')
 
-    G3_field += 3/2 * G2_field * delta_r
+def S3(delta):
+    # S3 = -3/14 \sum_i (d_i/nabla^2 G2) d_i delta
+    return _lagrangian_operator(delta, 'S3')
 
-    return G3_field
+def G3(delta):
+    # G3 = 3/2 (d_i d_j / nabla^2 delta)^2 * delta - (d_i d_j / nabla^2 delta)^3 - delta**3 / 2
+    return _lagrangian_operator(delta, 'G3')
 
 def tidal_G2_par(g2field, axis=2):
-    # now for any axis, default z
-    print (axis)
-    def par_transfer_function(k3vec, val):
-        kk = sum(ki**2 for ki in k3vec)  # k^2 on the mesh
-        kk[kk == 0] = 1
-        return k3vec[axis]**2 / kk * val
-    g2par = g2field.apply(par_transfer_function, mode='complex', kind='wavenumber')
-    return g2par.compute(mode='real')
+    # now for any axis, default z; d_axis^2/nabla^2 of the G2 mesh g2field
+    return fft_c2r(apply_transfer(g2field.compute(mode='complex'), lambda kg: kg.kvec[axis]**2 / kg.k2_nozero), out=Ellipsis)
+
+# growth order of each Lagrangian operator (psi_i are the Zeldovich displacements)
+LAGRANGIAN_OPERATORS = {'d1': 1, 'd2': 2, 'G2': 2, 'G2par': 2, 'd3': 3, 'Gamma3': 3, 'G2d': 3, 'S3': 3, 'G3': 3,
+                        'G2par_0': 2, 'G2par_1': 2, 'G2par_2': 2, 'psi0': 1, 'psi1': 1, 'psi2': 1}
+
+def _lagrangian_operator_graph(axis=2, cubic_filter=None):
+    """
+    DAG of the Lagrangian operators and their shared intermediates: name -> (dependencies,
+    number of FFTs, function of the dict of computed nodes, whether the result reuses the
+    memory of the first dependency). 'delta_k' is the input linear field; nodes prefixed
+    with 's_' are built from the field smoothed by cubic_filter, which is what the cubic
+    operators use. dij are d_i d_j/nabla^2 delta, DG2_ij and DG2_i are d_i d_j/nabla^2 G2
+    and d_i/nabla^2 G2, grad_i is d_i delta, phi_k the potential and psi_i the displacement.
+    Sums over components are accumulated one term at a time (the '@' nodes), so that each
+    component can be freed as soon as it has been added.
+    """
+    def c2r_node(src, transfer):
+        # transfer is a function of the KGrid
+        return ([src], 1, lambda f: fft_c2r(apply_transfer(f[src], transfer), out=Ellipsis), False)
+
+    def kij_over_k2(i, j):
+        return lambda kg: kg.kvec[i] * kg.kvec[j] / kg.k2_nozero
+
+    def ki_over_k2(i):
+        return lambda kg: kg.kvec[i] * 1j / kg.k2_nozero
+
+    def grad(i):
+        return lambda kg: kg.kvec[i] * 1j
+
+    if cubic_filter is None:
+        # same as d3_smooth
+        smooth = lambda f: apply_transfer(f['delta_k'], lambda kg: kg.kmask(0.5))
+    else:
+        smooth = lambda f: f['delta_k'].apply(cubic_filter, kind='wavenumber')
+    graph = {'delta_k': ([], 0, None, False),
+             's_delta_k': (['delta_k'], 0, smooth, False)}
+
+    def accumulate(name, terms):
+        # name = sum of terms, each term is (dependencies, function)
+        prev = None
+        for n, (deps, term) in enumerate(terms):
+            node = name if n == len(terms) - 1 else name + '@%d' % n
+            if prev is None:
+                graph[node] = (deps, 0, term, False)
+            else:
+                def add(f, prev=prev, term=term):
+                    acc = f[prev]
+                    acc += term(f)
+                    return acc
+                graph[node] = ([prev] + deps, 0, add, True)
+            prev = node
+
+    pairs = [(idir, jdir) for idir in range(3) for jdir in range(idir, 3)]
+    for p in ('', 's_'):
+        graph[p + 'd1'] = ([p + 'delta_k'], 1, lambda f, p=p: fft_c2r(f[p + 'delta_k']), False)
+        for i, j in pairs:
+            graph[p + 'd%d%d' % (i, j)] = c2r_node(p + 'delta_k', kij_over_k2(i, j))
+            graph[p + 'DG2_%d%d' % (i, j)] = c2r_node(p + 'G2_k', kij_over_k2(i, j))
+        for i in range(3):
+            graph[p + 'DG2_%d' % i] = c2r_node(p + 'G2_k', ki_over_k2(i))
+            graph[p + 'grad_%d' % i] = c2r_node(p + 'delta_k', grad(i))
+        # K2 = \sum_{i,j=0..2} d_ij(\vx)d_ij(\vx) = [d_00^2+d_11^2+d_22^2 + 2*(d_01^2+d_02^2+d_12^2)]
+        accumulate(p + 'K2', [([p + 'd%d%d' % (i, j)], lambda f, d=p + 'd%d%d' % (i, j), fac=1.0 if i == j else 2.0: fac * f[d]**2)
+                              for i, j in pairs])
+        graph[p + 'G2'] = ([p + 'K2', p + 'd1'], 0, lambda f, p=p: f[p + 'K2'] - f[p + 'd1']**2, False)
+        graph[p + 'G2_k'] = ([p + 'G2'], 1, lambda f, p=p: fft_r2c(f[p + 'G2']), False)
+
+    graph['phi_k'] = (['delta_k'], 0, lambda f: apply_transfer(f['delta_k'], lambda kg: 1 / kg.k2_nozero), False)
+    for d in range(3):
+        graph['psi%d' % d] = c2r_node('phi_k', grad(d))
+
+    graph['d2'] = (['d1'], 0, lambda f: f['d1']**2, False)
+    graph['G2d'] = (['G2', 'd1'], 0, lambda f: f['G2'] * f['d1'], False)
+    graph['G2par'] = c2r_node('G2_k', kij_over_k2(axis, axis))
+    for d in range(3):
+        # G2par along each line of sight, for several of them at once
+        graph['G2par_%d' % d] = c2r_node('G2_k', kij_over_k2(d, d))
+    graph['d3'] = (['s_d1'], 0, lambda f: f['s_d1']**3, False)
+    accumulate('Gamma3', [(['s_d1', 's_G2'], lambda f: 8./21. * f['s_d1'] * f['s_G2'])] +
+               [(['s_d1', 's_d%d%d' % (i, j), 's_DG2_%d%d' % (i, j)],
+                 lambda f, i=i, j=j: _gamma3_term(f['s_d1'], f['s_d%d%d' % (i, j)], f['s_DG2_%d%d' % (i, j)], i, j))
+                for i, j in pairs])
+    accumulate('S3', [(['s_DG2_%d' % i, 's_grad_%d' % i], lambda f, i=i: -3./14. * f['s_DG2_%d' % i] * f['s_grad_%d' % i])
+                      for i in range(3)])
+    graph['G3'] = (['s_d1', 's_K2'] + ['s_d%d%d' % ij for ij in pairs], 0,
+                   lambda f: _G3_field(f['s_d1'], f['s_K2'], lambda i, j: f['s_d%d%d' % (min(i, j), max(i, j))]), False)
+    return graph
+
+def plan_lagrangian_operators(operators, pm=None, axis=2, cubic_filter=None, keep_outputs=True):
+    """
+    Schedule the computation of a set of Lagrangian operators (names of the operator graph, e.g.
+    ['d1', 'd2', 'G2', 'd3', 'Gamma3', 'G2d', 'S3', 'G3', 'G2par']). Every shared intermediate is
+    computed once, in dependency order, and freed right after its last consumer. Operators are
+    kept until the end if keep_outputs, otherwise freed after they are handed out.
+
+    Returns a dict with the order, the nodes to free after each step, the number of FFTs and the
+    peak number of meshes held at once (real and complex nodes, the '_k' ones, counted apart). With
+    pm (collective), also the peak bytes of these meshes in the whole run (real meshes of Nmesh^3
+    and complex ones of Nmesh^2 (Nmesh/2+1) values) and on the most loaded rank, where pmesh gives
+    every mesh, real or complex, the padded buffer of the FFT.
+    """
+    graph = _lagrangian_operator_graph(axis, cubic_filter)
+    order = []
+    def visit(name):
+        if name in order:
+            return
+        for dep in graph[name][0]:
+            visit(dep)
+        order.append(name)
+    for name in operators:
+        if name not in graph:
+            raise Exception('Unknown operator %s' % name)
+        visit(name)
+
+    last_use = {}
+    for step, name in enumerate(order):
+        for dep in graph[name][0]:
+            last_use[dep] = step
+    free = [[] for name in order]
+    for step, name in enumerate(order):
+        # the input belongs to the caller
+        if name == 'delta_k' or (keep_outputs and name in operators):
+            continue
+        free[last_use.get(name, step)].append(name)
+
+    if pm is not None:
+        itemsize = np.dtype(pm.dtype).itemsize
+        real_bytes = np.prod(pm.Nmesh) * itemsize
+        complex_bytes = np.prod(pm.Nmesh[:-1]) * (pm.Nmesh[-1] // 2 + 1) * 2 * itemsize
+        # alloc_local complex values per mesh on this rank
+        rank_bytes = max(pm.comm.allgather(2 * itemsize * pm._get_partition(RealField).alloc_local))
+
+    live = set()
+    peak = peak_real = peak_complex = peak_bytes = 0
+    for step, name in enumerate(order):
+        deps, nfft, func, inplace = graph[name]
+        if inplace:
+            live.discard(deps[0])
+        live.add(name)
+        ncomplex = sum(1 for node in live if node.endswith('_k'))
+        if len(live) > peak:
+            peak, peak_real, peak_complex = len(live), len(live) - ncomplex, ncomplex
+        if pm is not None:
+            peak_bytes = max(peak_bytes, (len(live) - ncomplex) * real_bytes + ncomplex * complex_bytes)
+        live.difference_update(free[step])
+
+    plan = {'order': order, 'free': free, 'nfft': sum(graph[name][1] for name in order), 'peak_fields': peak,
+            'peak_real': peak_real, 'peak_complex': peak_complex}
+    if pm is not None:
+        plan['peak_bytes'] = peak_bytes
+        plan['peak_bytes_per_rank'] = peak * rank_bytes
+    return plan
+
+def compute_lagrangian_operators(delta_k, operators, axis=2, cubic_filter=None, callback=None, verbose=False):
+    """
+    Compute a set of Lagrangian operators (see plan_lagrangian_operators) of the complex field delta_k
+    as real fields. Without callback they are returned in a dict; otherwise each operator is passed to
+    callback(name, field) as soon as it is ready and freed afterwards.
+    """
+    graph = _lagrangian_operator_graph(axis, cubic_filter)
+    plan = plan_lagrangian_operators(operators, delta_k.pm, axis, cubic_filter, keep_outputs=callback is None)
+    if verbose and delta_k.pm.comm.rank == 0:
+        print('Operators %s: %d FFTs, peak %d meshes (%d real, %d complex; %.2f GB in total, %.2f GB per rank)'
+              % (', '.join(operators), plan['nfft'], plan['peak_fields'], plan['peak_real'], plan['peak_complex'],
+                 plan['peak_bytes']/1024.**3, plan['peak_bytes_per_rank']/1024.**3), flush=True)
+
+    nodes = {'delta_k': delta_k}
+    out = {}
+    for step, name in enumerate(plan['order']):
+        if name != 'delta_k':
+            nodes[name] = graph[name][2](nodes)
+        if name in operators:
+            if callback is None:
+                out[name] = nodes[name]
+            else:
+                callback(name, nodes[name])
+        for dead in plan['free'][step]:
+            del nodes[dead]
+    return out
 
 def d3_smooth(delta, km=0.5, rspace=True):
     def smooth(k, v):
         kk = (k.normp()**0.5)
         return v*(kk <= km)
     if rspace:
-        dk = delta.apply(smooth, mode='complex', kind='wavenumber').compute(mode='real')
+        dk = fft_c2r(apply_transfer(delta.compute(mode='complex'), lambda kg: kg.kmask(km)), out=Ellipsis)
     else:
         dk = delta.apply(smooth, mode='complex', kind='wavenumber')    
     return dk
@@ -912,12 +1330,840 @@ def reg_grid(Nptcles_per_dim = 20):
 
 
 
-def get_dlin(seed, Nmesh, BoxSize, Pk, comm):
-    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize, comm=comm)
+def get_dlin(seed, Nmesh, BoxSize, Pk, comm, dtype='f8'):
+    # dtype='f4' runs the whole mock in single precision, see generate_fields_operators
+    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize, comm=comm, dtype=dtype)
     wn = pm.generate_whitenoise(seed)
-    dlin = wn.apply(lambda k, v: Pk(sum(ki ** 2 for ki in k)**0.5) ** 0.5 * v / v.BoxSize.prod() ** 0.5)
+    # Pk is evaluated once per |k| shell
+    dlin = apply_transfer(wn, lambda kg: kg.on_shells(lambda k: Pk(k) ** 0.5 / wn.BoxSize.prod() ** 0.5))
     return dlin
 
+class TabulatedCosmology(object):
+    """
+    Linear power spectrum at z=0, growth factor and growth rate of a cosmology, tabulated once
+    with CLASS (nbodykit's Cosmology(**pars), matched with match, e.g. dict(sigma8=0.834)) and
+    saved in cache_folder as a small npz keyed by the parameters, so that later runs with the
+    same parameters skip CLASS. Rank 0 computes or reads the table and broadcasts it. Provides
+    what this code uses of a Cosmology: pars, scale_independent_growth_factor/rate,
+    comoving_distance (and its inverse redshift_at_distance) and LinearPower(z), which is
+    P(k, z=0) D(z)^2 (power-law extrapolated outside kmin-kmax).
+    """
+    version = 2
+
+    def __init__(self, cache_folder=None, comm=None, match=None, kmin=1e-5, kmax=1e3, nk=4096, zmax=999., nz=2048, **pars):
+        self.pars = dict(pars, match=match)
+        grid = dict(k=(kmin, kmax, nk), z=(zmax, nz))
+        key = 'cosmo-' + hashlib.sha1(repr(_canonical(dict(self.pars, grid=grid, version=self.version))).encode()).hexdigest()[:16]
+        table = None
+        if comm is None or comm.rank == 0:
+            fname = os.path.join(cache_folder, key + '.npz') if cache_folder is not None else None
+            if fname is not None and os.path.exists(fname):
+                with np.load(fname) as f:
+                    table = dict((name, f[name]) for name in f.files)
+            else:
+                table = self.tabulate(pars, match, grid)
+                if fname is not None:
+                    if not os.path.exists(cache_folder):
+                        os.makedirs(cache_folder)
+                    tmp = os.path.join(cache_folder, '%s.%d.npz' % (key, os.getpid()))
+                    np.savez(tmp, **table)
+                    os.rename(tmp, fname)
+        if comm is not None:
+            table = comm.bcast(table)
+
+        self._lnk = np.log(table['k'])
+        self._lnP = interp.CubicSpline(self._lnk, np.log(table['Pk']))
+        # growth as a function of ln a (z is descending)
+        self._lna = -np.log1p(table['z'])
+        self._D = interp.CubicSpline(self._lna, table['D'])
+        self._f = interp.CubicSpline(self._lna, table['f'])
+        self._chi = interp.CubicSpline(self._lna, table['chi'])
+        # z as a function of the distance (increasing along the reversed table)
+        self._z_of_chi = interp.CubicSpline(table['chi'][::-1], table['z'][::-1])
+
+    @staticmethod
+    def tabulate(pars, match, grid):
+        from nbodykit import cosmology
+        c = cosmology.Cosmology(**pars)
+        if match is not None:
+            c = c.match(**match)
+        kmin, kmax, nk = grid['k']
+        zmax, nz = grid['z']
+        k = np.logspace(np.log10(kmin), np.log10(kmax), nk)
+        z = 1/np.logspace(-np.log10(1 + zmax), 0, nz) - 1
+        z[-1] = 0
+        return dict(k=k, Pk=cosmology.LinearPower(c, 0)(k), z=z,
+                    D=c.scale_independent_growth_factor(z), f=c.scale_independent_growth_rate(z), chi=c.comoving_distance(z))
+
+    def _lna_of(self, z):
+        lna = -np.log1p(np.asarray(z, dtype='f8'))
+        if np.any(lna < self._lna[0]) or np.any(lna > self._lna[-1]):
+            raise Exception("z outside of the tabulated range 0-%g" % np.expm1(-self._lna[0]))
+        return lna
+
+    def scale_independent_growth_factor(self, z):
+        return self._D(self._lna_of(z))[()]
+
+    def scale_independent_growth_rate(self, z):
+        return self._f(self._lna_of(z))[()]
+
+    def comoving_distance(self, z):
+        # [Mpc/h]
+        return self._chi(self._lna_of(z))[()]
+
+    def redshift_at_distance(self, chi):
+        chi = np.asarray(chi, dtype='f8')
+        if np.any(chi < self._z_of_chi.x[0]) or np.any(chi > self._z_of_chi.x[-1]):
+            raise Exception("comoving distance outside of the tabulated range 0-%g Mpc/h" % self._z_of_chi.x[-1])
+        return self._z_of_chi(chi)[()]
+
+    def _lnpower(self, lnk):
+        lo, hi = self._lnk[0], self._lnk[-1]
+        lnP = self._lnP(np.clip(lnk, lo, hi))
+        lnP += np.where(lnk < lo, (lnk - lo) * self._lnP(lo, 1), 0)
+        lnP += np.where(lnk > hi, (lnk - hi) * self._lnP(hi, 1), 0)
+        return lnP
+
+    def LinearPower(self, z=0):
+        """
+        The linear power spectrum at z as a function of k [h/Mpc], zero at k=0.
+        """
+        D2 = self.scale_independent_growth_factor(z)**2
+        def Plin(k):
+            k = np.asarray(k, dtype='f8')
+            lnk = np.log(np.where(k > 0, k, 1))
+            return np.where(k > 0, np.exp(self._lnpower(lnk)) * D2, 0.)[()]
+        return Plin
+
+def _canonical(value):
+    # a repr-stable form of a stage parameter; cosmologies are described by their CLASS parameters
+    if hasattr(value, 'pars'):
+        value = value.pars
+    if isinstance(value, dict):
+        return sorted((str(key), _canonical(v)) for key, v in value.items())
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+_code_version = []
+def code_version():
+    """
+    Hash of the source of this module, part of every stage cache key so that changes of the
+    code invalidate the cached fields.
+    """
+    if not _code_version:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            _code_version.append(hashlib.sha1(f.read()).hexdigest()[:12])
+    return _code_version[0]
+
+def write_fields(fields, path, comm):
+    """
+    Save a list of real or complex fields in the bigfile path (datasets Field0, Field1, ...),
+    each rank writing its own part. The datasets can also be read with BigFileMesh.
+    """
+    with bigfile.FileMPI(comm, path, create=True) as ff:
+        for i, field in enumerate(fields):
+            data = np.empty(shape=field.size, dtype=field.dtype)
+            field.ravel(out=data)
+            with ff.create_from_array('Field%d' % i, data) as bb:
+                bb.attrs['ndarray.shape'] = field.cshape
+                bb.attrs['BoxSize'] = field.pm.BoxSize
+                bb.attrs['Nmesh'] = field.pm.Nmesh
+
+def read_fields(path, comm, pm=None):
+    """
+    Load the fields saved by write_fields, each rank reading its own part. Without pm, a
+    ParticleMesh of the stored Nmesh, BoxSize and precision is created and shared by all fields.
+    """
+    fields = []
+    with bigfile.FileMPI(comm, path) as ff:
+        n = len([name for name in ff.blocks if name.startswith('Field')])
+        for i in range(n):
+            with ff['Field%d' % i] as ds:
+                if pm is None:
+                    itemsize = ds.dtype.itemsize // (2 if ds.dtype.kind == 'c' else 1)
+                    pm = ParticleMesh(Nmesh=ds.attrs['Nmesh'], BoxSize=ds.attrs['BoxSize'], comm=comm, dtype='f%d' % itemsize)
+                field = pm.create(type='complex' if ds.dtype.kind == 'c' else 'real')
+                start = np.sum(comm.allgather(field.size)[:comm.rank], dtype='intp')
+                field.unravel(ds[start:start + field.size])
+                fields.append(field)
+    return fields
+
+class StageCache(object):
+    """
+    On-disk cache of the fields of pipeline stages (dlin, shifted fields, orthogonalized fields),
+    keyed by a hash of the stage name, its parameters (seed, Nmesh, BoxSize, cosmology, zic, zout,
+    axis, operators, ...) and code_version(). Entries are bigfiles under root read and written by
+    all ranks of comm; rank 0 keeps an index of their sizes and last use and evicts the least
+    recently used entries when the total exceeds max_bytes. With root=None nothing is cached.
+    """
+    def __init__(self, root, comm, max_bytes=None, verbose=True):
+        self.root = root
+        self.comm = comm
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        if root is not None and comm.rank == 0 and not os.path.exists(root):
+            os.makedirs(root)
+
+    def key(self, stage, **params):
+        params = dict(params, stage=stage, code_version=code_version())
+        return stage + '-' + hashlib.sha1(repr(_canonical(params)).encode()).hexdigest()[:16]
+
+    def _index_path(self):
+        return os.path.join(self.root, 'index.json')
+
+    def _read_index(self):
+        if not os.path.exists(self._index_path()):
+            return {}
+        with open(self._index_path()) as f:
+            return json.load(f)
+
+    def _write_index(self, index):
+        tmp = self._index_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.rename(tmp, self._index_path())
+
+    def _lock(self, timeout=60.):
+        # lock file around index updates, as several groups of an ensemble share the cache;
+        # a lock older than timeout is left over from a crashed run and is removed
+        lock = os.path.join(self.root, 'index.lock')
+        while True:
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+                return lock
+            except OSError:
+                try:
+                    if time.time() - os.path.getmtime(lock) > timeout:
+                        os.remove(lock)
+                except OSError:
+                    pass
+                time.sleep(0.05)
+
+    def _touch(self, key, params=None):
+        # rank 0 only: record the use of key (and its size if new), then evict
+        lock = self._lock()
+        try:
+            self._update_index(key, params)
+        finally:
+            os.remove(lock)
+
+    def _update_index(self, key, params):
+        index = self._read_index()
+        entry = index.setdefault(key, {})
+        if 'size' not in entry:
+            path = os.path.join(self.root, key)
+            entry['size'] = sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(path) for name in names)
+            entry['params'] = repr(_canonical(params))
+        entry['atime'] = time.time()
+        if self.max_bytes is not None:
+            total = sum(e['size'] for e in index.values())
+            for old in sorted(index, key=lambda k: index[k]['atime']):
+                if total <= self.max_bytes or old == key:
+                    continue
+                if self.verbose:
+                    print('stage cache: evicting %s (%.1f MB)' % (old, index[old]['size']/1024.**2))
+                shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+                total -= index.pop(old)['size']
+        self._write_index(index)
+
+    def _has(self, key):
+        # whether key is in the cache now (collective); advisory only, as another group sharing
+        # the cache may evict it afterwards: load is what tells whether the fields can be read
+        if self.root is None:
+            return False
+        path = os.path.join(self.root, key)
+        return self.comm.bcast(os.path.exists(path) if self.comm.rank == 0 else None)
+
+    def load(self, key, pm=None):
+        """
+        The cached fields of key, or None. An entry missing, or evicted or incomplete when read,
+        is a miss.
+        """
+        if self.root is None:
+            return None
+        path = os.path.join(self.root, key)
+        found = False
+        if self.comm.rank == 0:
+            # look it up and mark it used under the lock, so that the LRU eviction of a concurrent
+            # save does not remove it in between (it is now the most recently used)
+            lock = self._lock()
+            try:
+                found = os.path.exists(path)
+                if found:
+                    self._update_index(key, None)
+            finally:
+                os.remove(lock)
+        if not self.comm.bcast(found):
+            return None
+        try:
+            fields, error = read_fields(path, self.comm, pm=pm), None
+        except Exception as e:
+            fields, error = None, str(e)
+        if not fields and error is None:
+            error = 'no fields'
+        errors = [e for e in self.comm.allgather(error) if e is not None]
+        if errors:
+            # drop what is left of it, so that save writes it again
+            if self.comm.rank == 0:
+                print('stage cache: could not read %s (%s), recomputing' % (key, errors[0]))
+                lock = self._lock()
+                try:
+                    shutil.rmtree(path, ignore_errors=True)
+                    index = self._read_index()
+                    if index.pop(key, None) is not None:
+                        self._write_index(index)
+                finally:
+                    os.remove(lock)
+            self.comm.barrier()
+            return None
+        return fields
+
+    def save(self, key, fields, **params):
+        if self.root is None:
+            return
+        # write to a temporary file and move it in place, so that an interrupted write is not a hit
+        tmp = self.comm.bcast(os.path.join(self.root, 'tmp-%s-%d' % (key, os.getpid())) if self.comm.rank == 0 else None)
+        write_fields(fields, tmp, self.comm)
+        self.comm.barrier()
+        if self.comm.rank == 0:
+            path = os.path.join(self.root, key)
+            if os.path.exists(path):
+                # written meanwhile by another run; the content is the same
+                shutil.rmtree(tmp)
+            else:
+                os.rename(tmp, path)
+            self._touch(key, params)
+        self.comm.barrier()
+
+    def stage(self, stage, compute, pm=None, **params):
+        """
+        The list of fields of stage for params: loaded from the cache (on pm if given) if present,
+        otherwise computed with compute() and saved.
+        """
+        key = self.key(stage, **params)
+        fields = self.load(key, pm=pm)
+        if fields is not None:
+            if self.verbose and self.comm.rank == 0:
+                print('stage cache: loaded %s' % key)
+            return fields
+        fields = list(compute())
+        self.save(key, fields, **params)
+        return fields
+
+# profiler collecting the stages run inside its with block, see Profiler
+_PROFILER = None
+
+def _rss():
+    # current resident set size in bytes (0 where /proc is not available)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def _peak_rss():
+    # peak resident set size of the process so far in bytes (ru_maxrss is in kB on Linux, B on macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+class Profiler(object):
+    """
+    Per-rank timings of pipeline stages (ic, shift, orthogonalize, noise, polynomial, save, pk).
+    Inside `with Profiler(comm) as prof:` every `with profile_stage(name):` records its wall and
+    CPU time, the RSS and peak RSS of the rank at its end, the number of FFTs of the rank (all
+    pmesh transforms, also those inside nbodykit's FFTPower, apply and paint, and the threaded
+    ones of fft_r2c/fft_c2r) and the bytes each rank sent to others in particle exchanges (counted by
+    profile_count, also in the enclosing stages). Stages nest: shift includes ic when dlin has
+    to be computed. save(path) gathers the records of all ranks on rank 0 and writes path (JSON
+    with per-stage min/mean/max over ranks and the raw records) and path + '.trace.json', a
+    Chrome trace (chrome://tracing, Perfetto) with one row per rank.
+    """
+    def __init__(self, comm, verbose=True):
+        self.comm = comm
+        self.verbose = verbose
+        self.records = []
+        self._open = []
+        self._previous = None
+
+    def __enter__(self):
+        global _PROFILER
+        self._previous = _PROFILER
+        if self._previous is None:
+            _count_pmesh_ffts(True)
+        _PROFILER = self
+        return self
+
+    def __exit__(self, *exc):
+        global _PROFILER
+        _PROFILER = self._previous
+        if self._previous is None:
+            _count_pmesh_ffts(False)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'rank': self.comm.rank, 'depth': len(self._open), 'start': time.time(),
+                  'nfft': 0, 'exchange_bytes': 0}
+        wall, cpu = time.perf_counter(), time.process_time()
+        self._open.append(record)
+        try:
+            yield record
+        finally:
+            self._open.pop()
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+            record['rss'] = _rss()
+            record['peak_rss'] = max(_peak_rss(), record['rss'])
+            self.records.append(record)
+            if self.verbose and self.comm.rank == 0:
+                print('%s%s done (%.1f sec., peak RSS %.2f GB on rank 0)' % ('  ' * record['depth'], name, record['wall'],
+                      record['peak_rss']/1024.**3), flush=True)
+
+    def count(self, key, n=1):
+        for record in self._open:
+            record[key] += n
+
+    def gather(self):
+        """Records of all ranks on rank 0 (None on the other ranks)."""
+        records = self.comm.gather(self.records, root=0)
+        if records is not None:
+            records = [record for rank_records in records for record in rank_records]
+        return records
+
+    def summary(self, records):
+        # per stage statistics over ranks, stages in order of first completion
+        stages = []
+        for record in records:
+            if record['stage'] not in stages:
+                stages.append(record['stage'])
+        summary = []
+        for name in stages:
+            rs = [r for r in records if r['stage'] == name]
+            entry = {'stage': name, 'calls': len(rs) // self.comm.size}
+            for key in ('wall', 'cpu', 'rss', 'peak_rss', 'nfft', 'exchange_bytes'):
+                # sum over calls on each rank, then statistics over ranks
+                per_rank = np.zeros(self.comm.size)
+                for r in rs:
+                    if key in ('rss', 'peak_rss'):
+                        per_rank[r['rank']] = max(per_rank[r['rank']], r[key])
+                    else:
+                        per_rank[r['rank']] += r[key]
+                entry[key] = {'min': per_rank.min(), 'mean': per_rank.mean(), 'max': per_rank.max()}
+            # load imbalance: slowest rank over the average
+            entry['imbalance'] = entry['wall']['max'] / entry['wall']['mean'] if entry['wall']['mean'] > 0 else 1.
+            summary.append(entry)
+        return summary
+
+    def save(self, path):
+        """Gather the records on rank 0 and write path and path + '.trace.json' (collective)."""
+        records = self.gather()
+        if self.comm.rank != 0:
+            return
+        t0 = min([r['start'] for r in records] or [0])
+        trace = [{'name': r['stage'], 'ph': 'X', 'pid': 0, 'tid': r['rank'], 'ts': (r['start'] - t0) * 1e6,
+                  'dur': r['wall'] * 1e6, 'args': dict((k, r[k]) for k in ('cpu', 'rss', 'peak_rss', 'nfft', 'exchange_bytes'))}
+                 for r in records]
+        trace += [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': rank, 'args': {'name': 'rank %d' % rank}}
+                  for rank in range(self.comm.size)]
+        with open(path, 'w') as f:
+            json.dump({'nranks': self.comm.size, 'nthreads': _NTHREADS, 'stages': self.summary(records),
+                       'records': records}, f, indent=1)
+        with open(path + '.trace.json', 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        if self.verbose:
+            for entry in self.summary(records):
+                print('%-14s wall %8.2f s (max over %d ranks, imbalance %.2f), %4d FFTs, %.2f GB exchanged, peak RSS %.2f GB'
+                      % (entry['stage'], entry['wall']['max'], self.comm.size, entry['imbalance'], entry['nfft']['max'],
+                         entry['exchange_bytes']['max']/1024.**3, entry['peak_rss']['max']/1024.**3))
+
+def profile_stage(name):
+    """Context manager timing stage name in the active Profiler (does nothing without one)."""
+    if _PROFILER is None:
+        return contextlib.nullcontext()
+    return _PROFILER.stage(name)
+
+def profile_count(key, n=1):
+    # add n to the counter key ('nfft' or 'exchange_bytes') of the open stages of the active Profiler
+    if _PROFILER is not None:
+        _PROFILER.count(key, n)
+
+def _counted(transform):
+    def counted(self, *args, **kwargs):
+        profile_count('nfft')
+        return transform(self, *args, **kwargs)
+    counted.transform = transform
+    return counted
+
+def _count_pmesh_ffts(on):
+    # every FFT of pmesh (also those of nbodykit) goes through RealField.r2c or BaseComplexField.c2r:
+    # count them while a Profiler is active
+    for cls, name in ((RealField, 'r2c'), (BaseComplexField, 'c2r')):
+        method = cls.__dict__[name]
+        if on and not hasattr(method, 'transform'):
+            setattr(cls, name, _counted(method))
+        elif not on and hasattr(method, 'transform'):
+            setattr(cls, name, method.transform)
+
+def _shifted_params(ic_params, zout, space, axis):
+    # cache parameters of the shifted fields of hifi_mock
+    if space == 'real':
+        return dict(ic_params, zout=zout, operators=['d1', 'd2', 'G2', 'd3'])
+    elif space == 'rsd':
+        return dict(ic_params, zout=zout, axis=axis, operators=['dz', 'd1', 'd2', 'G2', 'G2par', 'd3'])
+    raise Exception("invalid space %s" % str(space))
+
+def _hifi_dlin(seed, Nmesh, BoxSize, cosmo, comm, zic, dtype):
+    # initial field of hifi_mock, at zic
+    with profile_stage('ic'):
+        dlin = get_dlin(seed, Nmesh, BoxSize, cosmo.LinearPower(0), comm, dtype=dtype)
+        dlin *= cosmo.scale_independent_growth_factor(zic)
+    return [dlin]
+
+def _hifi_from_shifted(shifted, space, seed, Nmesh, BoxSize, zout, cosmo, axis, Nmu, cache, params_path, shifted_params):
+    # orthogonalize, noise and polynomial stages of hifi_mock
+    kmin = 2*np.pi/BoxSize/2
+    los = np.zeros(3, dtype='int')
+    los[axis] = 1
+    if space == 'real':
+        d1, d2, dG2, d3 = shifted
+        with profile_stage('orthogonalize'):
+            p1 = FFTPower(d1, mode='1d', kmin=kmin)
+            d2, dG2, d3 = cache.stage('orthogonalized', lambda: orthogonalize(d1, d2, dG2, d3), pm=d1.pm, **shifted_params)
+        with profile_stage('noise'):
+            noise = noise_zout_term(zout, Nmesh, BoxSize, params_path, seed=seed, pm=d1.pm)
+        with profile_stage('polynomial'):
+            HI_field = polynomial_field_zout(d1, d2, dG2, d3, params_path, zout, p1, noise=noise)
+    else:
+        dz, d1, d2, dG2, dG2par, d3 = shifted
+        with profile_stage('orthogonalize'):
+            p1 = FFTPower(d1, mode='2d', kmin=kmin, Nmu=Nmu, poles=[0,2], los=los)
+            d2, dG2, d3 = cache.stage('orthogonalized', lambda: orthogonalize_rsd(d1, d2, dG2, d3, Nmu, axis=axis), pm=d1.pm,
+                                      Nmu=Nmu, **shifted_params)
+        with profile_stage('noise'):
+            noise = noise_kmu_zout_term(zout, Nmesh, BoxSize, axis, params_path, seed=seed, pm=d1.pm)
+        with profile_stage('polynomial'):
+            fout = cosmo.scale_independent_growth_rate(zout)
+            HI_field = rsd_polynomial_field_zout(dz, d1, d2, dG2, dG2par, d3, params_path, zout, p1, fout, noise=noise)
+    del noise
+    return HI_field, p1
+
+def hifi_mock(seed, Nmesh, BoxSize, zout, cosmo, comm, space='real', zic=127, axis=2, Nmu=6, cache=None,
+              params_path=None, dtype='f8', memory_budget=None):
+    """
+    HI mock of the IC seed at zout as a complex field, following Hi-Fi_mock_real_space.py
+    (space='real') or Hi-Fi_mock_redshift_space.py (space='rsd', line of sight along axis) on the
+    communicator comm. cosmo is a TabulatedCosmology; the dlin, shifted and orthogonalized
+    fields go through cache, a StageCache or None. Returns the HI field and the power spectrum
+    p1 of d1 that sets the binning of the transfer functions. The ic, shift, orthogonalize, noise
+    and polynomial stages are timed by the active Profiler, if any. dtype='f4' computes the
+    initial field and the Lagrangian operators in single precision (see precision_report). With a
+    memory_budget in bytes, the shifted fields are painted slab by slab (see generate_fields_streamed);
+    it does not change the result, so it is not part of the cache key.
+    """
+    if cache is None:
+        cache = StageCache(None, comm)
+    if params_path is None:
+        params_path = './data/%s_space_bestfit_params/' % ('r' if space == 'real' else 'z')
+
+    ic_params = dict(seed=seed, Nmesh=Nmesh, BoxSize=BoxSize, cosmo=cosmo, zic=zic, dtype=np.dtype(dtype).str)
+    shifted_params = _shifted_params(ic_params, zout, space, axis)
+
+    def compute_shifted():
+        dlin, = cache.stage('dlin', lambda: _hifi_dlin(seed, Nmesh, BoxSize, cosmo, comm, zic, dtype), **ic_params)
+        if space == 'real':
+            return generate_fields_new(dlin, cosmo, zic, zout, comm=comm, memory_budget=memory_budget)
+        return generate_fields_rsd_new(dlin, cosmo, zic, zout, axis=axis, comm=comm, memory_budget=memory_budget)
+
+    with profile_stage('shift'):
+        shifted = cache.stage('shifted', compute_shifted, **shifted_params)
+    return _hifi_from_shifted(shifted, space, seed, Nmesh, BoxSize, zout, cosmo, axis, Nmu, cache, params_path,
+                              shifted_params)
+
+def hifi_mock_zouts(seed, Nmesh, BoxSize, zouts, cosmo, comm, axes=(), real=True, zic=127, Nmu=6, cache=None,
+                    params_paths=None, dtype='f8', memory_budget=None, callback=None):
+    """
+    hifi_mock at every redshift of zouts, in real space (if real) and in redshift space along
+    each line of sight of axes, sharing the initial field and one Lagrangian stage: the
+    displacements and operators are computed once at zic (stage 'lagrangian'; they scale as
+    powers of the growth factor) and each output costs a paint of them rescaled by
+    D(zout)/D(zic) (see paint_shifted), an orthogonalization, the noise and the polynomial. The
+    shifted and orthogonalized fields go through the same cache entries as hifi_mock.
+    params_paths maps 'real' and 'rsd' to the best-fit parameter folders. The outputs are keyed
+    (zout, 'real' or the axis); without callback a dict of (HI_field, p1) is returned, otherwise
+    each is passed to callback(zout, key, HI_field, p1) and freed.
+    """
+    if cache is None:
+        cache = StageCache(None, comm)
+    paths = {'real': './data/r_space_bestfit_params/', 'rsd': './data/z_space_bestfit_params/'}
+    paths.update(params_paths or {})
+    ic_params = dict(seed=seed, Nmesh=Nmesh, BoxSize=BoxSize, cosmo=cosmo, zic=zic, dtype=np.dtype(dtype).str)
+    outputs = [(zout, key) for zout in zouts for key in (['real'] if real else []) + list(axes)]
+    space = lambda key: 'real' if key == 'real' else 'rsd'
+    params = {(zout, key): _shifted_params(ic_params, zout, space(key), 2 if key == 'real' else key) for zout, key in outputs}
+    # only a hint for planning the Lagrangian stage: an entry evicted meanwhile is a miss of cache.load
+    # below, and the stage is then computed again for the outputs that need it
+    cached = lambda output: cache._has(cache.key('shifted', **params[output]))
+
+    meshes = None
+    out = {}
+    for n, (zout, key) in enumerate(outputs):
+        axis = 2 if key == 'real' else key
+        fields = cache.load(cache.key('shifted', **params[zout, key]))
+        if fields is None:
+            if meshes is None or key != 'real' and 'G2par_%d' % key not in meshes:
+                # the Lagrangian stage of this output and of the later ones that are not cached
+                axes_rsd = sorted(set(k for z, k in outputs[n:] if k != 'real' and ((z, k) == (zout, key) or not cached((z, k)))))
+                meshes = None
+                dlin, = cache.stage('dlin', lambda: _hifi_dlin(seed, Nmesh, BoxSize, cosmo, comm, zic, dtype), **ic_params)
+                with profile_stage('lagrangian'):
+                    meshes = lagrangian_meshes(dlin, ['d1', 'd2', 'G2', 'd3'] + (['G2par'] if axes_rsd else []), 1.,
+                                               axes=axes_rsd, verbose=False)
+                del dlin
+            prefactor = cosmo.scale_independent_growth_factor(zout)/cosmo.scale_independent_growth_factor(zic)
+            with profile_stage('shift'):
+                if key == 'real':
+                    fields = paint_shifted(meshes, ['d1', 'd2', 'G2', 'd3'], comm=comm, memory_budget=memory_budget,
+                                           prefactor=prefactor, verbose=False)
+                else:
+                    fields = paint_shifted(meshes, ['dz', 'd1', 'd2', 'G2', 'G2par', 'd3'],
+                                           fout=cosmo.scale_independent_growth_rate(zout), axis=key, comm=comm,
+                                           memory_budget=memory_budget, prefactor=prefactor, verbose=False)
+                cache.save(cache.key('shifted', **params[zout, key]), fields, **params[zout, key])
+        HI_field, p1 = _hifi_from_shifted(fields, space(key), seed, Nmesh, BoxSize, zout, cosmo, axis, Nmu, cache,
+                                          paths[space(key)], params[zout, key])
+        del fields
+        if callback is None:
+            out[zout, key] = (HI_field, p1)
+        else:
+            callback(zout, key, HI_field, p1)
+        del HI_field, p1
+    return out
+
+def hifi_mock_los(seed, Nmesh, BoxSize, zout, cosmo, comm, axes=(0, 1, 2), real=True, zic=127, Nmu=6, cache=None,
+                  params_paths=None, dtype='f8', memory_budget=None, callback=None):
+    """
+    hifi_mock in real space (if real) and in redshift space along each line of sight of axes,
+    sharing the Lagrangian stage (hifi_mock_zouts at a single redshift). The outputs are keyed
+    'real' or by the axis; without callback a dict of (HI_field, p1) is returned, otherwise each
+    is passed to callback(key, HI_field, p1) and freed.
+    """
+    out = hifi_mock_zouts(seed, Nmesh, BoxSize, [zout], cosmo, comm, axes=axes, real=real, zic=zic, Nmu=Nmu, cache=cache,
+                          params_paths=params_paths, dtype=dtype, memory_budget=memory_budget,
+                          callback=None if callback is None else lambda z, key, HI_field, p1: callback(key, HI_field, p1))
+    return {key: value for (z, key), value in out.items()}
+
+def _shell_tiles(BoxSize, observer, rmin, rmax):
+    # corners (relative to the observer) of the periodic replicas of the box that intersect the shell
+    m = int(np.ceil(rmax / BoxSize)) + 1
+    tiles = []
+    for n in np.ndindex(2*m + 1, 2*m + 1, 2*m + 1):
+        lo = (np.array(n) - m) * BoxSize - observer
+        hi = lo + BoxSize
+        near = np.sum(np.maximum(0, np.maximum(lo, -hi))**2)**0.5
+        far = np.sum(np.maximum(np.abs(lo), np.abs(hi))**2)**0.5
+        if near < rmax and far >= rmin:
+            tiles.append(lo)
+    return tiles
+
+def _shell_cells(real, tiles, rmin, rmax):
+    # positions (relative to the observer), distances and values of the local cells of the
+    # replicas in tiles with a distance in [rmin, rmax), one slab of a replica at a time
+    start = real.pm.partition.local_i_start
+    shape = real.value.shape
+    H = real.pm.BoxSize / real.pm.Nmesh
+    x = [(start[d] + np.arange(shape[d])) * H[d] for d in range(3)]
+    for lo in tiles:
+        y = (x[1] + lo[1])[:, None]
+        z = (x[2] + lo[2])[None, :]
+        yz2 = y**2 + z**2
+        for i in range(shape[0]):
+            if abs(x[0][i] + lo[0]) >= rmax:
+                continue
+            r = ((x[0][i] + lo[0])**2 + yz2)**0.5
+            mask = (r >= rmin) & (r < rmax)
+            if not mask.any():
+                continue
+            j, k = np.nonzero(mask)
+            pos = np.stack([np.full(len(j), x[0][i] + lo[0]), y[j, 0], z[0, k]], axis=1)
+            yield pos, r[mask], real.value[i][mask]
+
+def write_lightcone_shell(real, path, observer, rmin, rmax, cosmo, attrs=None):
+    """
+    Write the cells of the real field of the periodic box (replicated as needed) whose comoving
+    distance to observer is in [rmin, rmax) as a bigfile catalog at path, readable with
+    BigFileCatalog: Position (relative to the observer), Z (redshift of the distance) and HI,
+    with attrs in the Header. The cells are counted, then written one slab of a replica at a
+    time, so that the shell is never held in memory. Collective on the ranks of real.
+    """
+    attrs = dict(attrs or {})
+    comm = real.pm.comm
+    tiles = _shell_tiles(real.pm.BoxSize[0], observer, rmin, rmax)
+    n = sum(len(value) for pos, r, value in _shell_cells(real, tiles, rmin, rmax))
+    size = comm.allreduce(n)
+    offset = np.sum(comm.allgather(n)[:comm.rank], dtype='i8')
+    # 32 million items per physical file, as nbodykit
+    Nfile = max(1, (size + 32*1024**2 - 1) // (32*1024**2))
+    # written to a temporary file and moved in place, so that an interrupted write is not a shell
+    tmp = comm.bcast('%s.tmp-%d' % (path, os.getpid()) if comm.rank == 0 else None)
+    with bigfile.FileMPI(comm, tmp, create=True) as ff:
+        columns = [('Position', np.dtype(('f4', 3))), ('Z', np.dtype('f4')), ('HI', np.dtype('f4'))]
+        for name, dtype in columns:
+            with ff.create(name, dtype, size, Nfile):
+                pass
+        blocks = [ff.open(name) for name, dtype in columns]
+        for pos, r, value in _shell_cells(real, tiles, rmin, rmax):
+            for block, column in zip(blocks, [pos, cosmo.redshift_at_distance(r), value]):
+                block.write(offset, np.asarray(column, dtype='f4'))
+            offset += len(value)
+        for block in blocks:
+            block.close()
+        with ff.create('Header') as bb:
+            header = dict(attrs, rmin=rmin, rmax=rmax, observer=observer, BoxSize=real.pm.BoxSize, Nmesh=real.pm.Nmesh)
+            for key in header:
+                bb.attrs[key] = header[key]
+    comm.barrier()
+    if comm.rank == 0:
+        os.rename(tmp, path)
+    comm.barrier()
+
+def hifi_lightcone(seed, Nmesh, BoxSize, cosmo, comm, output_folder, zmin=0., zmax=1., nshells=10, observer=None,
+                   space='real', axis=2, zic=127, Nmu=6, cache=None, params_paths=None, dtype='f8', memory_budget=None,
+                   verbose=True):
+    """
+    HI lightcone seen by observer (default: the centre of the box) between zmin and zmax, in
+    nshells comoving shells of equal width. The HI field of a shell is the mock of
+    hifi_mock_zouts at the redshift of its mid distance (transfer functions and Perr
+    interpolated there), painted from the Lagrangian stage shared by all shells; its cells of
+    the periodically replicated box that fall in the shell are streamed to
+    output_folder/shell_%03d (see write_lightcone_shell) and its meshes are freed before the
+    next shell, so the memory does not grow with the number of shells. In redshift space the
+    line of sight is along axis everywhere (distant observer), as for the boxes. Shells already
+    in output_folder are skipped. Returns the redshift edges of the shells.
+    """
+    if observer is None:
+        observer = 0.5 * BoxSize * np.ones(3)
+    observer = np.asarray(observer, dtype='f8')
+    if space not in ('real', 'rsd'):
+        raise Exception("invalid space %s" % str(space))
+    edges = np.linspace(cosmo.comoving_distance(zmin), cosmo.comoving_distance(zmax), nshells + 1)
+    zshells = cosmo.redshift_at_distance(0.5 * (edges[1:] + edges[:-1]))
+    path = lambda ishell: os.path.join(output_folder, 'shell_%03d' % ishell)
+    if comm.rank == 0 and not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    todo = [ishell for ishell in range(nshells) if not comm.bcast(os.path.exists(path(ishell)) if comm.rank == 0 else None)]
+    shell_of = dict((zshells[ishell], ishell) for ishell in todo)
+
+    def write(zout, key, HI_field, p1):
+        ishell = shell_of[zout]
+        with profile_stage('shell'):
+            real = fft_c2r(HI_field)
+            write_lightcone_shell(real, path(ishell), observer, edges[ishell], edges[ishell + 1], cosmo,
+                                  attrs=dict(seed=seed, zshell=zout, space=space, axis=axis))
+            del real
+        if verbose and comm.rank == 0:
+            print('lightcone: shell %d at z=%.3f (%.1f-%.1f Mpc/h) written' % (ishell, zout, edges[ishell], edges[ishell + 1]),
+                  flush=True)
+
+    hifi_mock_zouts(seed, Nmesh, BoxSize, list(shell_of), cosmo, comm, axes=[axis] if space == 'rsd' else [],
+                    real=space == 'real', zic=zic, Nmu=Nmu, cache=cache, params_paths=params_paths, dtype=dtype,
+                    memory_budget=memory_budget, callback=write)
+    return cosmo.redshift_at_distance(edges)
+
+def precision_report(seed, Nmesh, BoxSize, zout, cosmo, comm, space='real', verbose=True, **kwargs):
+    """
+    Validate the single precision mode: the HI mock of hifi_mock (with kwargs) in double and in
+    single precision, same seed and noise, and the deviation of their power spectra in the k bins
+    of the drivers. Returns a dict with k, the relative deviation P_f4/P_f8 - 1, 1 - r with r the
+    cross-correlation coefficient of the two fields and, in redshift space, the deviation of the
+    quadrupole relative to the monopole. The largest values are printed on rank 0 if verbose.
+    """
+    HI64, p1 = hifi_mock(seed, Nmesh, BoxSize, zout, cosmo, comm, space=space, dtype='f8', **kwargs)
+    HI32, p1 = hifi_mock(seed, Nmesh, BoxSize, zout, cosmo, comm, space=space, dtype='f4', **kwargs)
+    kmin = 2*np.pi/BoxSize/2
+    # sums over the modes are in double precision for both fields
+    P, pkref = cross_power_matrix([HI64, HI32], mode='1d', kmin=kmin)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        report = {'k': pkref.power['k'], 'dev': P[:, 1, 1] / P[:, 0, 0] - 1,
+                  'one_minus_r': 1 - P[:, 0, 1] / (P[:, 0, 0] * P[:, 1, 1])**0.5}
+        if space == 'rsd':
+            los = np.zeros(3, dtype='int')
+            los[kwargs.get('axis', 2)] = 1
+            P, Pell, pkref = cross_power_matrix([HI64, HI32], mode='2d', Nmu=kwargs.get('Nmu', 6), poles=[0, 2],
+                                                los=los, kmin=kmin)
+            report['dev_quadrupole'] = (Pell[1, :, 1, 1] - Pell[1, :, 0, 0]) / Pell[0, :, 0, 0]
+    if verbose and comm.rank == 0:
+        for name in ('dev', 'one_minus_r', 'dev_quadrupole'):
+            if name in report:
+                print('f4 vs f8 %s: max %.2e (k < 0.5 h/Mpc: %.2e)' % (name, np.nanmax(np.abs(report[name])),
+                      np.nanmax(np.abs(report[name][report['k'] < 0.5]))))
+    return report
+
+def run_ensemble(tasks, run_task, ngroups, comm=None, done=None, verbose=True):
+    """
+    Run run_task(task, subcomm) for every task of the list tasks, on ngroups sub-communicators
+    of comm (CurrentMPIComm by default) with about (comm.size-1)/ngroups ranks each, which is the
+    default communicator inside run_task. Rank 0 of comm only hands out the tasks, in order, to
+    whichever group asks first (point-to-point, so no one-sided progress is needed); on a single
+    rank the tasks run in turn. Tasks with done(task) true are skipped. Returns the (index,
+    result) of the tasks run by the group of this rank (none on rank 0 if comm.size > 1).
+    """
+    from mpi4py import MPI
+    from nbodykit import CurrentMPIComm
+    if comm is None:
+        comm = CurrentMPIComm.get()
+    # rank 0 is the dispatcher, the others the workers
+    nworkers = max(comm.size - 1, 1)
+    ngroups = max(1, min(ngroups, nworkers))
+    group = (comm.rank - 1) * ngroups // nworkers if comm.rank > 0 else (0 if comm.size == 1 else MPI.UNDEFINED)
+    subcomm = comm.Split(group, comm.rank)
+    tag = 7741
+
+    if comm.size > 1 and comm.rank == 0:
+        # hand out task indices until every group was told there are none left
+        itask, stopped = 0, 0
+        status = MPI.Status()
+        while stopped < ngroups:
+            comm.recv(source=MPI.ANY_SOURCE, tag=tag, status=status)
+            comm.send(itask, dest=status.Get_source(), tag=tag)
+            if itask >= len(tasks):
+                stopped += 1
+            itask += 1
+        comm.Barrier()
+        return []
+
+    counter = [0]
+    def next_task():
+        itask = None
+        if subcomm.rank == 0:
+            if comm.size > 1:
+                comm.send(None, dest=0, tag=tag)
+                itask = comm.recv(source=0, tag=tag)
+            else:
+                itask, counter[0] = counter[0], counter[0] + 1
+        return subcomm.bcast(itask)
+
+    results = []
+    while True:
+        itask = next_task()
+        if itask >= len(tasks):
+            break
+        task = tasks[itask]
+        skip = subcomm.bcast(done is not None and done(task) if subcomm.rank == 0 else None)
+        if skip:
+            if verbose and subcomm.rank == 0:
+                print ('group %i: skipping task %i %s, already done' % (group, itask, str(task)))
+            continue
+        if verbose and subcomm.rank == 0:
+            print ('group %i (%i ranks): running task %i %s' % (group, subcomm.size, itask, str(task)))
+        with CurrentMPIComm.enter(subcomm):
+            results.append((itask, run_task(task, subcomm)))
+
+    comm.Barrier()
+    subcomm.Free()
+    return results
+
 # this routine is based on th: 
 # https://github.com/mschmittfull/lsstools/
 def interp1d_manual_k_binning(kin,
@@ -1030,6 +2276,19 @@ def interp1d_manual_k_binning(kin,
                 print("Pout:\n", Pout)
             return Pout
 
+        def lookup(kg):
+            """
+            (table, index) such that table.take(index) is interpolator(kg.k) on the KGrid kg;
+            index holds the cached bin of every mode.
+            """
+            max_ibin = Pin.shape[0] - 1
+            islot = kg.kbin_index(dk * k_bin_width, max_ibin + 1)
+            if bounds_error and (np.any(islot == 0) or np.any(islot == max_ibin + 2)):
+                raise Exception("Bounds error: k out of range in interpolation")
+            fill = [np.nan, np.nan] if bounds_error else fill_value
+            table = np.concatenate([[fill[0]], Pin, [fill[1]]])
+            return table, islot
+
         if verbose:
             print("Test manual_Pk_k_bins interpolator")
             print("Pin-interpolator(kin):\n", Pin - interpolator(kin))
@@ -1177,9 +2436,28 @@ def interp1d_manual_k_binning(kin,
             Pout = np.where(np.isnan(muarg),np.zeros(Pout.shape) + np.nan, Pout)
             return Pout
 
+        def lookup(kg):
+            """
+            (table, index) such that table.take(index) is interpolator(kg.k, kg.mu(los)) on the
+            KGrid kg; index holds the cached bin of every mode.
+            """
+            islot = kg.kmubin_index(kedges, muedges, los0)
+            if bounds_error and (np.any(islot == 0) or np.any(islot == Nk * Nmu + 1)):
+                raise Exception("Bounds error: k out of range in interpolation")
+            fill = [np.nan, np.nan] if bounds_error else fill_value
+            table = np.concatenate([[fill[0]], Pin, [fill[1], np.nan]])
+            return table, islot
+
     else:
         raise Exception("invalid kind %s" % str(kind))
 
+    def on_grid(kg):
+        # the interpolator on all modes of the KGrid kg
+        table, islot = lookup(kg)
+        return table.take(islot)
+
+    interpolator.lookup = lookup
+    interpolator.on_grid = on_grid
     return interpolator
 
 # this routine is based on a routine from here: https://github.com/mschmittfull/lsstools/
@@ -1201,376 +2479,350 @@ def round_float2int_arr(x):
     """round float to nearest int"""
     return np.where(x >= 0.0, (x + 0.5).astype('int'), (x - 0.5).astype('int'))
 
-def orthogonalize(d1, d2, dG2, d3):
-    
-    kmin = 2*np.pi/d1.BoxSize[0]/2
-    
-    p1  = FFTPower(d1, mode='1d', kmin=kmin)
-    p2  = FFTPower(d2, mode='1d', kmin=kmin)
-    pG2 = FFTPower(dG2, mode='1d', kmin=kmin)
-    p3  = FFTPower(d3, mode='1d', kmin=kmin)
-
-    p12 = FFTPower(d1, mode='1d', second=d2, kmin=kmin)
-    p1G2 = FFTPower(d1, mode='1d', second=dG2, kmin=kmin)
-    p13 = FFTPower(d1, mode='1d', second=d3, kmin=kmin)
-
-    p2G2 = FFTPower(d2, mode='1d', second=dG2, kmin=kmin)
-    p23 = FFTPower(d2, mode='1d', second=d3, kmin=kmin)
-
-    pG23 = FFTPower(dG2, mode='1d', second=d3, kmin=kmin)
-    
-    C = np.zeros((p1.power['k'].size,4,4)) + np.nan
-
-    C[:,0,0] = 1.
-    C[:,1,1] = 1.
-    C[:,2,2] = 1.
-    C[:,3,3] = 1.
-
-    C[:,0,1] = p12.power['power'].real /(p1.power['power'].real*p2.power['power'].real)**0.5
-    C[:,0,2] = p1G2.power['power'].real/(p1.power['power'].real*pG2.power['power'].real)**0.5
-    C[:,0,3] = p13.power['power'].real/(p1.power['power'].real*p3.power['power'].real)**0.5
-
-    C[:,1,2] = p2G2.power['power'].real/(p2.power['power'].real*pG2.power['power'].real)**0.5
-    C[:,1,3] = p23.power['power'].real/(p2.power['power'].real*p3.power['power'].real)**0.5
-
-    C[:,2,3] = pG23.power['power'].real/(pG2.power['power'].real*p3.power['power'].real)**0.5
-
-    C[:,1,0] = C[:,0,1]
-    C[:,2,0] = C[:,0,2]
-    C[:,3,0] = C[:,0,3]
-
-    C[:,2,1] = C[:,1,2]
-    C[:,3,1] = C[:,1,3]
+class BinnedPower(object):
+    """
+    The binning of a cross_power_matrix, laid out like an FFTPower result: power (and poles)
+    hold the auto power of the first field, attrs the FFTPower attrs. Can be used as Pkref in
+    interp1d_manual_k_binning.
+    """
+    def __init__(self, power, poles, attrs):
+        self.power = power
+        self.poles = poles
+        self.attrs = attrs
+
+def _power_edges(pm, Nmu, kmin, dk, kmax):
+    # dk and the k and mu bin edges of FFTPower
+    if dk is None:
+        dk = 2 * np.pi / pm.BoxSize.min()
+    kedges = np.arange(kmin, np.pi * pm.Nmesh.min() / pm.BoxSize.max() + dk / 2 if kmax is None else kmax, dk)
+    return dk, kedges, np.linspace(-1, 1, Nmu + 1, endpoint=True)
+
+def _bin_chunks(pm, kedges, muedges, los, chunksize):
+    """
+    The (k, mu) binning of cross_power_matrix over chunks of about chunksize modes of the local
+    k-slab of pm: yields the slice of axis 0, the mask of the modes of the chunk (flattened)
+    that fall in a bin, and for those modes their bin index k * Nmu + mu, k, mu, the weight
+    for the modes not stored in the hermitian half, k != 0 and whether they have a conjugate
+    mode.
+    """
+    Nk, Nmu = len(kedges) - 1, len(muedges) - 1
+    kvec = kgrid(pm).kvec
+    # local shape of the complex fields
+    local = np.broadcast_shapes(*[ki.shape for ki in kvec])
+    nslab = local[0]
+    step = max(1, chunksize // max(1, int(np.prod(local[1:]))))
+    for i0 in range(0, nslab, step):
+        sl = slice(i0, i0 + step)
+        kslab = [ki[sl] if ki.shape[0] != 1 else ki for ki in kvec]
+        k2 = sum(ki**2 for ki in kslab)
+        shape = k2.shape
+        k = k2**0.5
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mu = sum(kslab[i] * los[i] for i in range(3)) / k
+        mu[k == 0] = 0
+
+        ik = np.digitize(k2.flat, kedges**2) - 1
+        # mu == 1 goes to the last mu bin
+        imu = np.minimum(np.digitize(mu.flat, muedges), Nmu) - 1
+        valid = (ik >= 0) & (ik < Nk) & (imu >= 0)
+        index = (ik * Nmu + imu)[valid]
+        nonsingular = np.broadcast_to(kslab[-1] > 0, shape).ravel()[valid]
+        weight = np.where(nonsingular, 2., 1.)
+        yield sl, valid, index, k.ravel()[valid], mu.ravel()[valid], weight, k2.ravel()[valid] != 0, nonsingular
+
+def cross_power_matrix(fields, mode='1d', Nmu=5, poles=(), los=(0, 0, 1), kmin=0., dk=None, kmax=None,
+                       chunksize=1024**2, basis=None, pm=None):
+    """
+    All N(N+1)/2 auto and cross power spectra of N complex fields on the same pm, with the
+    binning of FFTPower(..., mode, Nmu, poles, los, kmin, dk, kmax), in one pass over the modes.
+
+    basis optionally gives, per field, None or a function of the (k, mu) of the modes returning
+    a list of arrays: the field then stands for its products with each of them, e.g. with the
+    monomials of a polynomial transfer function, and N counts these products. A field of None
+    is one at every mode (on pm), so that its spectra with a basis are V times the bin averages
+    of the products of the basis functions.
+
+    Returns P, the real part of the power, with shape (Nk, N, N) for mode='1d' and
+    (Nk, Nmu, N, N) for mode='2d' (mu bins over [-1, 1] as in FFTPower); if poles are given,
+    the multipoles with shape (Nell, Nk, N, N); and a BinnedPower with the k (and mu) of the
+    bins.
+    """
+    if pm is None:
+        pm = [f for f in fields if f is not None][0].pm
+    if basis is None:
+        basis = [None] * len(fields)
+    N = sum(1 if fb is None else len(fb(np.ones(1), np.zeros(1))) for fb in basis)
+    BoxSize, Nmesh = pm.BoxSize, pm.Nmesh
+    if mode == '1d':
+        Nmu = 1
+    dk, kedges, muedges = _power_edges(pm, Nmu, kmin, dk, kmax)
+    Nk = len(kedges) - 1
+    pairs = [(i, j) for i in range(N) for j in range(i, N)]
+    ells = list(poles)
+
+    # sums over the modes in each (k, mu) bin, weighted for the modes not stored in the
+    # hermitian half, as in nbodykit's project_to_basis
+    ysum = np.zeros((len(pairs), Nk * Nmu))
+    ellsum = np.zeros((len(ells), len(pairs), Nk * Nmu))
+    ksum = np.zeros(Nk * Nmu)
+    musum = np.zeros(Nk * Nmu)
+    Nsum = np.zeros(Nk * Nmu)
+
+    for sl, valid, index, k, mu, weight, nonzero, nonsingular in _bin_chunks(pm, kedges, muedges, los, chunksize):
+        # the power of the zero mode is cleared
+        yweight = weight * nonzero
+
+        Nsum += np.bincount(index, weights=weight, minlength=Nk * Nmu)
+        ksum += np.bincount(index, weights=weight * k, minlength=Nk * Nmu)
+        musum += np.bincount(index, weights=weight * mu, minlength=Nk * Nmu)
+        values = []
+        for f, fb in zip(fields, basis):
+            value = np.ones(len(index)) if f is None else f.value[sl].ravel()[valid]
+            if fb is None:
+                values.append(value)
+            else:
+                values += [w * value for w in fb(k, mu)]
+        ellweights = []
+        for ell in ells:
+            # the real part of the conjugate mode cancels for odd ell
+            wl = np.where(nonsingular, 2. * (ell % 2 == 0), 1.) * nonzero
+            ellweights.append(wl * legendre(ell)(mu) * (2. * ell + 1.))
+        for ipair, (i, j) in enumerate(pairs):
+            y = (values[i] * values[j].conj()).real
+            ysum[ipair] += np.bincount(index, weights=yweight * y, minlength=Nk * Nmu)
+            for iell, wl in enumerate(ellweights):
+                ellsum[iell, ipair] += np.bincount(index, weights=wl * y, minlength=Nk * Nmu)
+
+    comm = pm.comm
+    ysum, ellsum = comm.allreduce(ysum), comm.allreduce(ellsum)
+    ksum, musum, Nsum = comm.allreduce(ksum), comm.allreduce(musum), comm.allreduce(Nsum)
+
+    V = BoxSize.prod()
+    P = np.zeros((Nk, Nmu, N, N))
+    Pell = np.zeros((len(ells), Nk, N, N))
+    N1d = Nsum.reshape(Nk, Nmu).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for ipair, (i, j) in enumerate(pairs):
+            P[..., i, j] = P[..., j, i] = (V * ysum[ipair] / Nsum).reshape(Nk, Nmu)
+            for iell in range(len(ells)):
+                Pell[iell, :, i, j] = Pell[iell, :, j, i] = V * ellsum[iell, ipair].reshape(Nk, Nmu).sum(axis=-1) / N1d
+        kmean = (ksum / Nsum).reshape(Nk, Nmu)
+        mumean = (musum / Nsum).reshape(Nk, Nmu)
+        kmean1d = ksum.reshape(Nk, Nmu).sum(axis=-1) / N1d
+
+    attrs = {'Nmesh': Nmesh.copy(), 'BoxSize': BoxSize.copy(), 'mode': mode, 'los': list(los), 'Nmu': Nmu,
+             'poles': ells, 'dk': dk, 'kmin': kmin, 'kmax': kmax}
+    if mode == '1d':
+        data = np.empty(Nk, dtype=[('k', 'f8'), ('power', 'c16'), ('modes', 'i8')])
+        data['k'], data['power'], data['modes'] = kmean[:, 0], P[:, 0, 0, 0], Nsum
+        power = BinnedStatistic(['k'], [kedges], data, fields_to_sum=['modes'], **attrs)
+        P = P[:, 0]
+    else:
+        data = np.empty((Nk, Nmu), dtype=[('k', 'f8'), ('mu', 'f8'), ('power', 'c16'), ('modes', 'i8')])
+        data['k'], data['mu'], data['power'] = kmean, mumean, P[..., 0, 0]
+        data['modes'] = Nsum.reshape(Nk, Nmu)
+        power = BinnedStatistic(['k', 'mu'], [kedges, muedges], data, fields_to_sum=['modes'], **attrs)
+    pkref = BinnedPower(power, None, attrs)
+    if not ells:
+        return P, pkref
+
+    data = np.empty(Nk, dtype=[('k', 'f8')] + [('power_%d' % ell, 'c16') for ell in ells] + [('modes', 'i8')])
+    data['k'], data['modes'] = kmean1d, N1d
+    for iell, ell in enumerate(ells):
+        data['power_%d' % ell] = Pell[iell, :, 0, 0]
+    pkref.poles = BinnedStatistic(['k'], [kedges], data, fields_to_sum=['modes'],
+                                  coords=[power.coords['k']], **attrs)
+    return P, Pell, pkref
+
+def orthogonalize_fields(fields, mode='1d', Nmu=None, axis=2, nbasis=None):
+    """
+    Orthogonalize fields[1:] against the fields before them, in each k (mode='1d') or
+    (k, mu>=0) bin (mode='2d', Nmu mu bins over [-1, 1] with los along axis), with the
+    Cholesky decomposition of the correlation matrix C_ij = P_ij/(P_ii P_jj)^0.5 of all bins
+    at once. O_i^ort = O_i + sum_{j<i} M_ij O_j with M_ij = Linv_ij/Linv_ii (P_ii/P_jj)^0.5.
+    With nbasis, only the first nbasis fields are subtracted. Empty bins get C=1 and M=0.
+    Returns the list of orthogonalized fields[1:], each assembled in one k-space pass.
+    """
+    N = len(fields)
+    nbasis = N if nbasis is None else nbasis
+    kmin = 2*np.pi/fields[0].BoxSize[0]/2
+    los = np.zeros(3, dtype='int')
+    los[axis] = 1
 
-    C[:,3,2] = C[:,2,3]
+    if mode == '1d':
+        P, pkref = cross_power_matrix(fields, kmin=kmin)
+        kin = pkref.power.coords['k']
+        kind = 'manual_Pk_k_bins'
+    else:
+        P, pkref = cross_power_matrix(fields, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
+        # keep the mu>=0 half
+        Nmu0 = int(pkref.attrs['Nmu']/2)
+        P = P[:, Nmu0:]
+        kin = pkref.power['k'][:, Nmu0:]
+        kind = 'manual_Pk_k_mu_bins'
+
+    Pd = np.diagonal(P, axis1=-2, axis2=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        C = P / (Pd[..., :, None] * Pd[..., None, :])**0.5
+        ratio = (Pd[..., :, None] / Pd[..., None, :])**0.5
+    C = np.where(np.isnan(C), 0, C)
+    C[..., range(N), range(N)] = 1.
+    ratio = np.where(np.isnan(ratio), 0, ratio)
 
     L = np.linalg.cholesky(C)
-    Linv = np.linalg.inv(L)
-
-    ratio10 = np.sqrt(p2.power['power'].real/p1.power['power'].real)
-    ratio20 = np.sqrt(pG2.power['power'].real/p1.power['power'].real)
-    ratio30 = np.sqrt(p3.power['power'].real/p1.power['power'].real)
-    ratio21 = np.sqrt(pG2.power['power'].real/p2.power['power'].real)
-    ratio31 = np.sqrt(p3.power['power'].real/p2.power['power'].real)
-    ratio32 = np.sqrt(p3.power['power'].real/pG2.power['power'].real)
-
-    M10 = Linv[:,1,0]/Linv[:,1,1]*ratio10
-    M20 = Linv[:,2,0]/Linv[:,2,2]*ratio20
-    M30 = Linv[:,3,0]/Linv[:,3,3]*ratio30
-    M21 = Linv[:,2,1]/Linv[:,2,2]*ratio21
-    M31 = Linv[:,3,1]/Linv[:,3,3]*ratio31
-    M32 = Linv[:,3,2]/Linv[:,3,3]*ratio32
-    
-    kk = p1.power.coords['k']
-    
-    interkmu_M10 = interp1d_manual_k_binning(kk, M10, fill_value=[M10[0],M10[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M20 = interp1d_manual_k_binning(kk, M20, fill_value=[M20[0],M20[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M30 = interp1d_manual_k_binning(kk, M30, fill_value=[M30[0],M30[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M21 = interp1d_manual_k_binning(kk, M21, fill_value=[M21[0],M21[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M31 = interp1d_manual_k_binning(kk, M31, fill_value=[M31[0],M31[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M32 = interp1d_manual_k_binning(kk, M32, fill_value=[M32[0],M32[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    
-    test = d1.apply(lambda k, v: interkmu_M10(sum(ki ** 2 for ki in k)**0.5) * v)
-    d2ort = d2+test
-
-    test = d1.apply(lambda k, v: interkmu_M20(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M21(sum(ki ** 2 for ki in k)**0.5) * v)
-    dG2ort = dG2+test+test2
+    Linv = np.linalg.solve(L, np.broadcast_to(np.eye(N), L.shape))
+    M = Linv / np.diagonal(Linv, axis1=-2, axis2=-1)[..., :, None] * ratio
+
+    kg = kgrid(fields[0].pm)
+    out = []
+    for i in range(1, N):
+        terms = [(fields[i], 1.)]
+        for j in range(min(i, nbasis)):
+            Mij = M[..., i, j]
+            inter = interp1d_manual_k_binning(kin, Mij, fill_value=[Mij.flat[0], Mij[-1].flat[0]],
+                                              Ngrid=pkref.attrs['Nmesh'], L=pkref.attrs['BoxSize'][0],
+                                              Pkref=pkref, kind=kind)
+            terms.append((fields[j], inter.lookup(kg)))
+        out.append(assemble_fields(terms))
+    return out
 
-    test = d1.apply(lambda k, v: interkmu_M30(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M31(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M32(sum(ki ** 2 for ki in k)**0.5) * v)
-
-    d3ort = d3+testG2+test+test2
-    del test, test2, testG2
-    
+def orthogonalize(d1, d2, dG2, d3):
+    d2ort, dG2ort, d3ort = orthogonalize_fields([d1, d2, dG2, d3])
     return d2ort, dG2ort, d3ort
 
 def orthogonalize_gamma3(d1, d2, dG2, d3, dg3):
-    
-    kmin = 2*np.pi/d1.BoxSize[0]/2
-    
-    p1  = FFTPower(d1, mode='1d', kmin=kmin)
-    p2  = FFTPower(d2, mode='1d', kmin=kmin)
-    pG2 = FFTPower(dG2, mode='1d', kmin=kmin)
-    p3  = FFTPower(d3, mode='1d', kmin=kmin)
-    pg3  = FFTPower(dg3, mode='1d', kmin=kmin)
-
-    p12 = FFTPower(d1, mode='1d', second=d2, kmin=kmin)
-    p1G2 = FFTPower(d1, mode='1d', second=dG2, kmin=kmin)
-    p13 = FFTPower(d1, mode='1d', second=d3, kmin=kmin)
-    p1g3 = FFTPower(d1, mode='1d', second=dg3, kmin=kmin)
-
-    p2G2 = FFTPower(d2, mode='1d', second=dG2, kmin=kmin)
-    p23 = FFTPower(d2, mode='1d', second=d3, kmin=kmin)
-    p2g3 = FFTPower(d2, mode='1d', second=dg3, kmin=kmin)
-
-    pG23 = FFTPower(dG2, mode='1d', second=d3, kmin=kmin)
-    pG2g3 = FFTPower(dG2, mode='1d', second=dg3, kmin=kmin)
-    
-    p3g3 = FFTPower(d3, mode='1d', second=dg3, kmin=kmin)
-
-    C = np.zeros((p1.power['k'].size,5,5)) + np.nan
-
-    C[:,0,0] = 1.
-    C[:,1,1] = 1.
-    C[:,2,2] = 1.
-    C[:,3,3] = 1.
-    C[:,4,4] = 1.
-
-    C[:,0,1] = p12.power['power'].real /(p1.power['power'].real*p2.power['power'].real)**0.5
-    C[:,0,2] = p1G2.power['power'].real/(p1.power['power'].real*pG2.power['power'].real)**0.5
-    C[:,0,3] = p13.power['power'].real/(p1.power['power'].real*p3.power['power'].real)**0.5
-    C[:,0,4] = p1g3.power['power'].real/(p1.power['power'].real*pg3.power['power'].real)**0.5
-
-    C[:,1,2] = p2G2.power['power'].real/(p2.power['power'].real*pG2.power['power'].real)**0.5
-    C[:,1,3] = p23.power['power'].real/(p2.power['power'].real*p3.power['power'].real)**0.5
-    C[:,1,4] = p2g3.power['power'].real/(p2.power['power'].real*pg3.power['power'].real)**0.5
-
-    C[:,2,3] = pG23.power['power'].real/(pG2.power['power'].real*p3.power['power'].real)**0.5
-    C[:,2,4] = pG2g3.power['power'].real/(pG2.power['power'].real*pg3.power['power'].real)**0.5
-
-    C[:,3,4] = p3g3.power['power'].real/(p3.power['power'].real*pg3.power['power'].real)**0.5
-
-    C[:,1,0] = C[:,0,1]
-    C[:,2,0] = C[:,0,2]
-    C[:,3,0] = C[:,0,3]
-    C[:,4,0] = C[:,0,4]
-
-    C[:,2,1] = C[:,1,2]
-    C[:,3,1] = C[:,1,3]
-    C[:,4,1] = C[:,1,4]
-
-    C[:,3,2] = C[:,2,3]
-    C[:,4,2] = C[:,2,4]
-
-    C[:,4,3] = C[:,3,4]
-
-    L = np.linalg.cholesky(C)
-    Linv = np.linalg.inv(L)
-
-    ratio10 = np.sqrt(p2.power['power'].real/p1.power['power'].real)
-    ratio20 = np.sqrt(pG2.power['power'].real/p1.power['power'].real)
-    ratio30 = np.sqrt(p3.power['power'].real/p1.power['power'].real)
-    ratio40 = np.sqrt(pg3.power['power'].real/p1.power['power'].real)
-    ratio21 = np.sqrt(pG2.power['power'].real/p2.power['power'].real)
-    ratio31 = np.sqrt(p3.power['power'].real/p2.power['power'].real)
-    ratio41 = np.sqrt(pg3.power['power'].real/p2.power['power'].real)
-    ratio32 = np.sqrt(p3.power['power'].real/pG2.power['power'].real)
-    ratio42 = np.sqrt(pg3.power['power'].real/pG2.power['power'].real)
-    ratio43 = np.sqrt(pg3.power['power'].real/p3.power['power'].real)
-
-    M10 = Linv[:,1,0]/Linv[:,1,1]*ratio10
-    M20 = Linv[:,2,0]/Linv[:,2,2]*ratio20
-    M30 = Linv[:,3,0]/Linv[:,3,3]*ratio30
-    M40 = Linv[:,4,0]/Linv[:,4,4]*ratio40
-    M21 = Linv[:,2,1]/Linv[:,2,2]*ratio21
-    M31 = Linv[:,3,1]/Linv[:,3,3]*ratio31
-    M41 = Linv[:,4,1]/Linv[:,4,4]*ratio41
-    M32 = Linv[:,3,2]/Linv[:,3,3]*ratio32
-    M42 = Linv[:,4,2]/Linv[:,4,4]*ratio42
-    M43 = Linv[:,4,3]/Linv[:,4,4]*ratio43
-    
-    kk = p1.power.coords['k']
-    
-    interkmu_M10 = interp1d_manual_k_binning(kk, M10, fill_value=[M10[0],M10[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M20 = interp1d_manual_k_binning(kk, M20, fill_value=[M20[0],M20[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M30 = interp1d_manual_k_binning(kk, M30, fill_value=[M30[0],M30[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M40 = interp1d_manual_k_binning(kk, M40, fill_value=[M40[0],M40[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M21 = interp1d_manual_k_binning(kk, M21, fill_value=[M21[0],M21[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M31 = interp1d_manual_k_binning(kk, M31, fill_value=[M31[0],M31[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M41 = interp1d_manual_k_binning(kk, M41, fill_value=[M41[0],M41[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M32 = interp1d_manual_k_binning(kk, M32, fill_value=[M32[0],M32[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M42 = interp1d_manual_k_binning(kk, M42, fill_value=[M42[0],M42[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M43 = interp1d_manual_k_binning(kk, M43, fill_value=[M43[0],M43[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    
-    test = d1.apply(lambda k, v: interkmu_M10(sum(ki ** 2 for ki in k)**0.5) * v)
-    d2ort = d2+test
-
-    test = d1.apply(lambda k, v: interkmu_M20(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M21(sum(ki ** 2 for ki in k)**0.5) * v)
-    dG2ort = dG2+test+test2
-
-    test = d1.apply(lambda k, v: interkmu_M30(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M31(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M32(sum(ki ** 2 for ki in k)**0.5) * v)
-    d3ort = d3+testG2+test+test2
-
-    test = d1.apply(lambda k, v: interkmu_M40(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M41(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M42(sum(ki ** 2 for ki in k)**0.5) * v)
-    test3 = d3.apply(lambda k, v: interkmu_M43(sum(ki ** 2 for ki in k)**0.5) * v)
-    dg3ort = dg3+test+test2+testG2+test3
-
-    del test, test2, testG2, test3
-    
+    d2ort, dG2ort, d3ort, dg3ort = orthogonalize_fields([d1, d2, dG2, d3, dg3])
     return d2ort, dG2ort, d3ort, dg3ort
 
 def orthogonalize_rsd(d1, d2, dG2, d3, Nmu, axis=2):
+    d2ort, dG2ort, d3ort = orthogonalize_fields([d1, d2, dG2, d3], mode='2d', Nmu=Nmu, axis=axis)
+    return d2ort, dG2ort, d3ort
 
-    los = np.zeros(3, dtype='int')
-    los[axis] = 1
-    
-    kmin = 2*np.pi/d1.BoxSize[0]/2
-
-    p1_ref = FFTPower(d1, mode='2d', Nmu=Nmu, kmin=kmin, poles=[0,2], los=los)
-    kk = p1_ref.poles['k']
-
-    p1 = FFTPower(d1, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    p1 = FFTPower(d1, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    p2 = FFTPower(d2, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    pG2 = FFTPower(dG2, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    p3 = FFTPower(d3, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-
-    p12 = FFTPower(d1, second=d2, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    p1G2 = FFTPower(d1, second=dG2, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    p13 = FFTPower(d1, second=d3, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-
-    p2G2 = FFTPower(d2, second=dG2, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-    p23 = FFTPower(d2, second=d3, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-
-    pG23 = FFTPower(dG2, second=d3, mode='2d', Nmu=Nmu, kmin=kmin, los=los)
-
-    Nmu0 = int(p1.attrs['Nmu']/2) 
-
-    p1.power = p1.power[:,Nmu0:]
-    p2.power = p2.power[:,Nmu0:]
-    pG2.power = pG2.power[:,Nmu0:]
-    p3.power = p3.power[:,Nmu0:]
-
-    p12.power = p12.power[:,Nmu0:]
-    p1G2.power = p1G2.power[:,Nmu0:]
-    p13.power = p13.power[:,Nmu0:]
-
-    p2G2.power = p2G2.power[:,Nmu0:]
-    p23.power = p23.power[:,Nmu0:]
-
-    pG23.power = pG23.power[:,Nmu0:]
-
-    C = np.zeros((p1.power['power'].shape[0],p1.power['power'].shape[1],4,4)) + np.nan
-
-    C[...,0,0] = 1.
-    C[...,1,1] = 1.
-    C[...,2,2] = 1.
-    C[...,3,3] = 1.
-
-    C[...,0,1] = p12.power['power'].real /(p1.power['power'].real*p2.power['power'].real)**0.5
-    C[...,0,2] = p1G2.power['power'].real/(p1.power['power'].real*pG2.power['power'].real)**0.5
-    C[...,0,3] = p13.power['power'].real/(p1.power['power'].real*p3.power['power'].real)**0.5
-
-    C[...,1,2] = p2G2.power['power'].real/(p2.power['power'].real*pG2.power['power'].real)**0.5
-    C[...,1,3] = p23.power['power'].real/(p2.power['power'].real*p3.power['power'].real)**0.5
-    C[...,2,3] = pG23.power['power'].real/(pG2.power['power'].real*p3.power['power'].real)**0.5
-
-    C[...,1,0] = C[...,0,1]
-    C[...,2,0] = C[...,0,2]
-    C[...,3,0] = C[...,0,3]
-
-    C[...,2,1] = C[...,1,2]
-    C[...,3,1] = C[...,1,3]
-    C[...,3,2] = C[...,2,3]
-
-
-    C = np.where(np.isnan(C), 0, C)
-    L = np.linalg.cholesky(C)
-    Linv = np.linalg.inv(L)
-
-    ratio10 = np.sqrt( p2.power['power'].real/p1.power['power'].real)
-    ratio20 = np.sqrt(pG2.power['power'].real/p1.power['power'].real)
-    ratio30 = np.sqrt(p3.power['power'].real/p1.power['power'].real)
-    ratio21 = np.sqrt(pG2.power['power'].real/p2.power['power'].real)
-    ratio31 = np.sqrt(p3.power['power'].real/p2.power['power'].real)
-    ratio32 = np.sqrt(p3.power['power'].real/pG2.power['power'].real)
-
-    ratio10 = np.where(np.isnan(ratio10), 0, ratio10)
-    ratio20 = np.where(np.isnan(ratio20), 0, ratio20)
-    ratio30 = np.where(np.isnan(ratio30), 0, ratio30)
-    ratio21 = np.where(np.isnan(ratio21), 0, ratio21)
-    ratio31 = np.where(np.isnan(ratio31), 0, ratio31)
-    ratio32 = np.where(np.isnan(ratio32), 0, ratio32)
-
-    M10 = Linv[...,1,0]/Linv[...,1,1]*ratio10
-    M20 = Linv[...,2,0]/Linv[...,2,2]*ratio20
-    M30 = Linv[...,3,0]/Linv[...,3,3]*ratio30
-    M21 = Linv[...,2,1]/Linv[...,2,2]*ratio21
-    M31 = Linv[...,3,1]/Linv[...,3,3]*ratio31
-    M32 = Linv[...,3,2]/Linv[...,3,3]*ratio32
-
-    interkmu_M10 = interp1d_manual_k_binning(p1.power['k'], M10, fill_value=[M10[0][0],M10[-1][0]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1_ref, kind='manual_Pk_k_mu_bins')
-    interkmu_M20 = interp1d_manual_k_binning(p1.power['k'], M20, fill_value=[M20[0][0],M20[-1][0]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1_ref, kind='manual_Pk_k_mu_bins')
-    interkmu_M30 = interp1d_manual_k_binning(p1.power['k'], M30, fill_value=[M30[0][0],M30[-1][0]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1_ref, kind='manual_Pk_k_mu_bins')
-    interkmu_M21 = interp1d_manual_k_binning(p1.power['k'], M21, fill_value=[M21[0][0],M21[-1][0]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1_ref, kind='manual_Pk_k_mu_bins')
-    interkmu_M31 = interp1d_manual_k_binning(p1.power['k'], M31, fill_value=[M31[0][0],M31[-1][0]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1_ref, kind='manual_Pk_k_mu_bins')
-    interkmu_M32 = interp1d_manual_k_binning(p1.power['k'], M32, fill_value=[M32[0][0],M32[-1][0]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1_ref, kind='manual_Pk_k_mu_bins')
-
-    def rsd_filter_M10(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5  # absk on the mesh
-        # Dont use absk[absk==0]=1 b/c interp does not allow k=1.
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return interkmu_M10(absk, mu) * val
-
-    def rsd_filter_M20(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return interkmu_M20(absk, mu) * val
-
-    def rsd_filter_M21(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return interkmu_M21(absk, mu) * val
-
-    def rsd_filter_M30(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return interkmu_M30(absk, mu) * val
-
-    def rsd_filter_M31(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return interkmu_M31(absk, mu) * val
-
-    def rsd_filter_M32(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return interkmu_M32(absk, mu) * val
-
-    M10d1 = d1.apply(rsd_filter_M10, kind='wavenumber')
-    M10d1[np.isnan(M10d1)]=0+0j
-
-    M20d1 = d1.apply(rsd_filter_M20, kind='wavenumber')
-    M20d1[np.isnan(M20d1)]=0+0j
-
-    M21d2 = d2.apply(rsd_filter_M21, kind='wavenumber')
-    M21d2[np.isnan(M21d2)]=0+0j
-
-    M30d1 = d1.apply(rsd_filter_M30, kind='wavenumber')
-    M30d1[np.isnan(M30d1)]=0+0j
-
-    M31d2 = d2.apply(rsd_filter_M31, kind='wavenumber')
-    M31d2[np.isnan(M31d2)]=0+0j
-
-    M32dG2 = dG2.apply(rsd_filter_M32, kind='wavenumber')
-    M32dG2[np.isnan(M32dG2)]=0+0j
-
-    d2ort  = d2  + M10d1
-    dG2ort = dG2 + M21d2 + M20d1
-    d3ort  = d3  + M30d1 + M31d2 + M32dG2
+BESTFIT_PARAMS_FILE = 'bestfit_params_v1.npy'
 
-    return d2ort, dG2ort, d3ort
+def compile_bestfit_params(data_dir, out=None):
+    """
+    Compile the best-fit coefficient files <name>_zout_<z>.txt of all *_bestfit_params folders of
+    data_dir, and the Perr(z) table z_Perr.txt, into one structured array with a row per redshift
+    and a column per name (nan where a name has no file at that redshift). Saved to out if given.
+    """
+    columns = {}
+    for folder in sorted(os.listdir(data_dir)):
+        if not folder.endswith('_bestfit_params'):
+            continue
+        for fname in sorted(os.listdir(os.path.join(data_dir, folder))):
+            fpath = os.path.join(data_dir, folder, fname)
+            if fname == 'z_Perr.txt':
+                z, perrz = np.loadtxt(fpath, unpack=True)
+                rows = dict(zip(z, perrz[:, None]))
+                name = 'Perr'
+            elif '_zout_' in fname and fname.endswith('.txt'):
+                name, zi = fname[:-len('.txt')].rsplit('_zout_', 1)
+                rows = {float(zi): np.atleast_1d(np.loadtxt(fpath, unpack=True))}
+            else:
+                continue
+            if name in columns and columns[name][0] != folder:
+                raise Exception("%s is in more than one folder" % name)
+            columns.setdefault(name, (folder, {}))[1].update(rows)
+
+    z_all = np.unique(np.concatenate([list(rows) for _, rows in columns.values()]))
+    dtype = [('z', 'f8')] + [(name, 'f8', (len(list(rows.values())[0]),)) for name, (_, rows) in sorted(columns.items())]
+    table = np.zeros(z_all.size, dtype=dtype)
+    table['z'] = z_all
+    for name, (_, rows) in columns.items():
+        table[name] = np.nan
+        for iz, zi in enumerate(z_all):
+            if zi in rows:
+                table[name][iz] = rows[zi]
+    if out is not None:
+        np.save(out, table)
+    return table
+
+def _bestfit_sources(data_dir):
+    # the text files of the *_bestfit_params folders of data_dir, read by compile_bestfit_params
+    sources = []
+    for folder in sorted(os.listdir(data_dir)):
+        if folder.endswith('_bestfit_params'):
+            fdir = os.path.join(data_dir, folder)
+            sources += [os.path.join(fdir, fname) for fname in sorted(os.listdir(fdir)) if fname.endswith('.txt')]
+    return sources
+
+def _bestfit_table_file(data_dir):
+    # BESTFIT_PARAMS_FILE keyed on a hash of the names and contents of the text files
+    digest = hashlib.sha1()
+    for source in _bestfit_sources(data_dir):
+        digest.update(os.path.relpath(source, data_dir).encode())
+        with open(source, 'rb') as f:
+            digest.update(f.read())
+    return os.path.join(data_dir, '%s-%s.npy' % (BESTFIT_PARAMS_FILE[:-len('.npy')], digest.hexdigest()[:16]))
+
+_bestfit_tables = {}
+def bestfit_table(path, comm=None):
+    """
+    Table of compile_bestfit_params for the parameter folder path. The text files are the
+    source of truth; their compiled table is cached next to the folder in a file named after
+    BESTFIT_PARAMS_FILE and a hash of the text files, which is built on first use (if the folder
+    is writable). Collective on comm (CurrentMPIComm by default): rank 0 reads or compiles the
+    table and broadcasts it. Loaded once per process.
+    """
+    data_dir = os.path.dirname(os.path.normpath(os.path.abspath(path)))
+    if data_dir not in _bestfit_tables:
+        if comm is None:
+            from nbodykit import CurrentMPIComm
+            comm = CurrentMPIComm.get()
+        table = None
+        if comm.rank == 0:
+            fname = _bestfit_table_file(data_dir)
+            if os.path.exists(fname):
+                table = np.load(fname)
+            else:
+                table = compile_bestfit_params(data_dir)
+                # written to a temporary file and moved in place, as other jobs may compile it concurrently
+                tmp = '%s.tmp-%d.npy' % (fname[:-len('.npy')], os.getpid())
+                try:
+                    np.save(tmp, table)
+                    os.replace(tmp, fname)
+                except OSError as e:
+                    print('Could not save the table of the text files to %s (%s)' % (fname, e))
+        _bestfit_tables[data_dir] = comm.bcast(table)
+    return _bestfit_tables[data_dir]
+
+_bestfit_cache = {}
+def bestfit_params(path, zout, names, comm=None):
+    """
+    Best-fit coefficients of each of names (e.g. 'b1_poly', 'rsd_b2_poly', 'Perr_polyfit', 'Perr')
+    linearly interpolated in z at zout, a number or an array of redshifts. Returns a list with an
+    array of shape (ncoef,), or (len(zout), ncoef), per name. Results are cached. The first call
+    for a folder is collective on comm, see bestfit_table.
+    """
+    zkey = tuple(np.atleast_1d(zout).tolist())
+    key = (os.path.abspath(path), zkey, tuple(names))
+    if key not in _bestfit_cache:
+        table = bestfit_table(path, comm)
+        zq = np.array(zkey)
+        result = []
+        for name in names:
+            col = np.asarray(table[name])
+            valid = ~np.isnan(col[:, 0])
+            z, col = np.asarray(table['z'])[valid], col[valid]
+            if np.any(zq < z[0]) or np.any(zq > z[-1]):
+                raise Exception("zout outside of the redshift range %g-%g of %s" % (z[0], z[-1], name))
+            if z.size == 1:
+                result.append(np.repeat(col, zq.size, axis=0))
+                continue
+            iz = np.clip(np.searchsorted(z, zq, side='right') - 1, 0, z.size - 2)
+            w = ((zq - z[iz]) / (z[iz + 1] - z[iz]))[:, None]
+            result.append(col[iz] * (1 - w) + col[iz + 1] * w)
+        _bestfit_cache[key] = result
+    result = [v.copy() for v in _bestfit_cache[key]]
+    if np.ndim(zout) == 0:
+        result = [v[0] for v in result]
+    return result
 
 def polynomial_field(d1, d2ort, dG2ort, d3ort, path, zout, p1):
     kk = p1.power['k']
 
-    b1_params = np.loadtxt(path + 'b1_poly_zout_%.1f.txt'%zout, unpack=True)
-    b2_params = np.loadtxt(path + 'b2_poly_zout_%.1f.txt'%zout, unpack=True)
-    bG2_params = np.loadtxt(path + 'bG2_poly_zout_%.1f.txt'%zout, unpack=True)
-    b3_params = np.loadtxt(path + 'b3_poly_zout_%.1f.txt'%zout, unpack=True)
+    b1_params, b2_params, bG2_params, b3_params = bestfit_params(path, zout, ['b1_poly', 'b2_poly', 'bG2_poly', 'b3_poly'], comm=d1.pm.comm)
 
     b1_poly = np.dot(np.array([kk*0+1, kk, kk**2, kk**4]).T, b1_params)
     b2_poly = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, b2_params)
@@ -1579,51 +2831,34 @@ def polynomial_field(d1, d2ort, dG2ort, d3ort, path, zout, p1):
 
     b1_polyinter = interp1d_manual_k_binning(kk, b1_poly, fill_value=[b1_poly[0], b1_poly[-1]], \
                                              Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field   =  d1.r2c().apply(lambda k, v: b1_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
+    poly_field   =  apply_transfer(fft_r2c(d1), b1_polyinter.on_grid)
     
     b2_polyinter = interp1d_manual_k_binning(kk, b2_poly, fill_value=[b2_poly[0], b2_poly[-1]], \
                                              Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field +=  d2ort.r2c().apply(lambda k, v: b2_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
+    poly_field +=  apply_transfer(fft_r2c(d2ort), b2_polyinter.on_grid)
     
     bG2_polyinter = interp1d_manual_k_binning(kk, bG2_poly, fill_value=[bG2_poly[0], bG2_poly[-1]], \
                                              Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field  +=  dG2ort.r2c().apply(lambda k, v: bG2_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
+    poly_field  +=  apply_transfer(fft_r2c(dG2ort), bG2_polyinter.on_grid)
     
     b3_polyinter = interp1d_manual_k_binning(kk, b3_poly, fill_value=[b3_poly[0], b3_poly[-1]], \
                                              Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field  +=  d3ort.r2c().apply(lambda k, v: b3_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
+    poly_field  +=  apply_transfer(fft_r2c(d3ort), b3_polyinter.on_grid)
     
     return poly_field
 
-def polynomial_field_zout(d1, d2ort, dG2ort, d3ort, path, zout, p1):
+def polynomial_field_zout(d1, d2ort, dG2ort, d3ort, path, zout, p1, noise=None):
+    # noise: optional (white noise, amplitude) term added in the same pass, see noise_zout_term
     kk = p1.power.coords['k']
 #     kk = np.logspace(-3, 0, 1000)
     
-    # available redshifts
-    z_arr = np.array([0,0.5,1,1.5,2,3,5])
-    b1_poly_z = np.zeros((z_arr.size, kk.size))
-    b2_poly_z = np.zeros((z_arr.size, kk.size))
-    bG2_poly_z = np.zeros((z_arr.size, kk.size))
-    b3_poly_z = np.zeros((z_arr.size, kk.size))
-    
-    assert (zout>=0) and (zout<=5)
+    # coefficients interpolated along redshifts at zout (the polynomials are linear in them)
+    b1_params, b2_params, bG2_params, b3_params = bestfit_params(path, zout, ['b1_poly', 'b2_poly', 'bG2_poly', 'b3_poly'], comm=d1.pm.comm)
 
-    for iz, zi in enumerate(z_arr):
-        b1_params = np.loadtxt(path + 'b1_poly_zout_%.1f.txt'%zi, unpack=True)
-        b2_params = np.loadtxt(path + 'b2_poly_zout_%.1f.txt'%zi, unpack=True)
-        bG2_params = np.loadtxt(path + 'bG2_poly_zout_%.1f.txt'%zi, unpack=True)
-        b3_params = np.loadtxt(path + 'b3_poly_zout_%.1f.txt'%zi, unpack=True)
-        
-        b1_poly_z[iz,:] = np.dot(np.array([kk*0+1, kk, kk**2, kk**4]).T, b1_params)
-        b2_poly_z[iz,:] = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, b2_params)
-        bG2_poly_z[iz,:] = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, bG2_params)
-        b3_poly_z[iz,:] = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, b3_params)
-
-    # interpolate along redshifts and take the value at zout       
-    b1_poly_zout = interp.interp1d(z_arr, b1_poly_z, axis=0)(zout)
-    b2_poly_zout = interp.interp1d(z_arr, b2_poly_z, axis=0)(zout)
-    bG2_poly_zout = interp.interp1d(z_arr, bG2_poly_z, axis=0)(zout)
-    b3_poly_zout = interp.interp1d(z_arr, b3_poly_z, axis=0)(zout)
+    b1_poly_zout = np.dot(np.array([kk*0+1, kk, kk**2, kk**4]).T, b1_params)
+    b2_poly_zout = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, b2_params)
+    bG2_poly_zout = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, bG2_params)
+    b3_poly_zout = np.dot(np.array([kk*0+1, kk**2, kk**4]).T, b3_params)
     
     # now make a function that interpolates at any k
     b1_poly = interp.interp1d(kk, b1_poly_zout, bounds_error=False, fill_value=(b1_poly_zout[0],b1_poly_zout[-1]))
@@ -1631,31 +2866,18 @@ def polynomial_field_zout(d1, d2ort, dG2ort, d3ort, path, zout, p1):
     bG2_poly = interp.interp1d(kk, bG2_poly_zout, bounds_error=False, fill_value=(bG2_poly_zout[0],bG2_poly_zout[-1]))
     b3_poly = interp.interp1d(kk, b3_poly_zout, bounds_error=False, fill_value=(b3_poly_zout[0],b3_poly_zout[-1]))
     
-    # b1_polyinter = interp1d_manual_k_binning(kk, b1_poly, fill_value=[b1_poly[0], b1_poly[-1]], \
-                                             # Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field   =  d1.apply(lambda k, v: b1_poly( sum(ki ** 2 for ki in k)**0.5) * v)
-    
-    # b2_polyinter = interp1d_manual_k_binning(kk, b2_poly, fill_value=[b2_poly[0], b2_poly[-1]], \
-                                             # Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field +=  d2ort.apply(lambda k, v: b2_poly( sum(ki ** 2 for ki in k)**0.5) * v)
-    
-    # bG2_polyinter = interp1d_manual_k_binning(kk, bG2_poly, fill_value=[bG2_poly[0], bG2_poly[-1]], \
-                                             # Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field  +=  dG2ort.apply(lambda k, v: bG2_poly( sum(ki ** 2 for ki in k)**0.5) * v)
-    
-    # b3_polyinter = interp1d_manual_k_binning(kk, b3_poly, fill_value=[b3_poly[0], b3_poly[-1]], \
-                                             # Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    poly_field  +=  d3ort.apply(lambda k, v: b3_poly( sum(ki ** 2 for ki in k)**0.5) * v)
-    
-    return poly_field
+    terms = [(d1, lambda k, mu: b1_poly(k)),
+             (d2ort, lambda k, mu: b2_poly(k)),
+             (dG2ort, lambda k, mu: bG2_poly(k)),
+             (d3ort, lambda k, mu: b3_poly(k))]
+    if noise is not None:
+        terms.append(noise)
+    return assemble_fields(terms)
 
 def polynomial_field_cnn(d1, d2ort, dG2ort, d3ort, path, zout, p1, b1, b2, bG2):
     kk = p1.power.coords['k']
     
-    b1_params = np.loadtxt(path + 'b1_poly_zout_%.1f.txt'%zout, unpack=True)
-    b2_params = np.loadtxt(path + 'b2_poly_zout_%.1f.txt'%zout, unpack=True)
-    bG2_params = np.loadtxt(path + 'bG2_poly_zout_%.1f.txt'%zout, unpack=True)
-    b3_params = np.loadtxt(path + 'b3_poly_zout_%.1f.txt'%zout, unpack=True)
+    b1_params, b2_params, bG2_params, b3_params = bestfit_params(path, zout, ['b1_poly', 'b2_poly', 'bG2_poly', 'b3_poly'], comm=d1.pm.comm)
     
     b1_params[0] = b1
     b2_params[0] = b2
@@ -1672,43 +2894,28 @@ def polynomial_field_cnn(d1, d2ort, dG2ort, d3ort, path, zout, p1, b1, b2, bG2):
     bG2_polyinter = interp.interp1d(kk, bG2_poly, bounds_error=False, fill_value=(bG2_poly[0],bG2_poly[-1]))
     b3_polyinter = interp.interp1d(kk, b3_poly, bounds_error=False, fill_value=(b3_poly[0],b3_poly[-1]))
     
-    poly_field   =  d1.apply(lambda k, v: b1_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
-    poly_field  +=  d2ort.apply(lambda k, v: b2_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)    
-    poly_field  +=  dG2ort.apply(lambda k, v: bG2_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
-    poly_field  +=  d3ort.apply(lambda k, v: b3_polyinter( sum(ki ** 2 for ki in k)**0.5) * v)
+    poly_field   =  apply_transfer(d1, lambda kg: b1_polyinter(kg.k))
+    poly_field  +=  apply_transfer(d2ort, lambda kg: b2_polyinter(kg.k))    
+    poly_field  +=  apply_transfer(dG2ort, lambda kg: bG2_polyinter(kg.k))
+    poly_field  +=  apply_transfer(d3ort, lambda kg: b3_polyinter(kg.k))
         
     return poly_field
 
 def rsd_polynomial_field(dz, d1, d2ort, dG2ort, dG2par, d3ort, path, zout, p1, fout):
 
-    b1_params = np.loadtxt(path + 'rsd_b1_poly_zout_%.1f.txt'%zout, unpack=True)
-    b2_params = np.loadtxt(path + 'rsd_b2_poly_zout_%.1f.txt'%zout, unpack=True)
-    bG2_params = np.loadtxt(path + 'rsd_bG2_poly_zout_%.1f.txt'%zout, unpack=True)
-    b3_params = np.loadtxt(path + 'rsd_b3_poly_zout_%.1f.txt'%zout, unpack=True)
+    b1_params, b2_params, bG2_params, b3_params = bestfit_params(path, zout, ['rsd_b1_poly', 'rsd_b2_poly', 'rsd_bG2_poly', 'rsd_b3_poly'], comm=d1.pm.comm)
 
-    def rsd_filter_beta1_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return beta1_poly_interkmu(absk, mu) * val
+    def rsd_filter_beta1_poly(kg):
+        return beta1_poly_interkmu(kg.k, kg.mu(p1.attrs['los']))
 
-    def rsd_filter_beta2_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return beta2_poly_interkmu(absk, mu) * val
+    def rsd_filter_beta2_poly(kg):
+        return beta2_poly_interkmu(kg.k, kg.mu(p1.attrs['los']))
 
-    def rsd_filter_betaG2_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return betaG2_poly_interkmu(absk, mu) * val
+    def rsd_filter_betaG2_poly(kg):
+        return betaG2_poly_interkmu(kg.k, kg.mu(p1.attrs['los']))
 
-    def rsd_filter_beta3_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return beta3_poly_interkmu(absk, mu) * val
+    def rsd_filter_beta3_poly(kg):
+        return beta3_poly_interkmu(kg.k, kg.mu(p1.attrs['los']))
 
     # def beta1_poly_interkmu(k,mu):
     #     return np.dot(b1_params, np.array([np.ones_like(k*mu), k, k**2, k**4, (k*mu)**2, (k*mu)**4]))
@@ -1731,132 +2938,342 @@ def rsd_polynomial_field(dz, d1, d2ort, dG2ort, dG2par, d3ort, path, zout, p1, f
     def beta3_poly_interkmu(k,mu):
         return np.dot(np.array([np.ones_like(k), k**2, k**4, (k*mu)**2, (k*mu)**4]).T, b3_params).T
 
-    beta11_poly = d1.r2c().apply(rsd_filter_beta1_poly, kind='wavenumber')
+    beta11_poly = apply_transfer(fft_r2c(d1), rsd_filter_beta1_poly)
     beta11_poly[np.isnan(beta11_poly)]=0+0j
-    beta22_poly = d2ort.r2c().apply(rsd_filter_beta2_poly, kind='wavenumber')
+    beta22_poly = apply_transfer(fft_r2c(d2ort), rsd_filter_beta2_poly)
     beta22_poly[np.isnan(beta22_poly)]=0+0j
-    betaG2G2_poly = dG2ort.r2c().apply(rsd_filter_betaG2_poly, kind='wavenumber')
+    betaG2G2_poly = apply_transfer(fft_r2c(dG2ort), rsd_filter_betaG2_poly)
     betaG2G2_poly[np.isnan(betaG2G2_poly)]=0+0j
-    beta33_poly = d3ort.r2c().apply(rsd_filter_beta3_poly, kind='wavenumber')
+    beta33_poly = apply_transfer(fft_r2c(d3ort), rsd_filter_beta3_poly)
     beta33_poly[np.isnan(beta33_poly)]=0+0j
 
-    final_field_poly = dz.r2c() - 3./7.*fout*dG2par.r2c() + beta11_poly + beta22_poly + betaG2G2_poly + beta33_poly
+    final_field_poly = fft_r2c(dz) - 3./7.*fout*fft_r2c(dG2par) + beta11_poly + beta22_poly + betaG2G2_poly + beta33_poly
 
     return final_field_poly
 
-def rsd_polynomial_field_zout(dz, d1, d2ort, dG2ort, dG2par, d3ort, path, zout, p1, fout):
-
-    # available redshifts
-    z_arr = np.array([0,0.5,1,1.5,2,3,5])
-    
-    rsd_b1_params_z = np.zeros((z_arr.size, 6))
-    rsd_b2_params_z = np.zeros((z_arr.size, 5))
-    rsd_bG2_params_z = np.zeros((z_arr.size, 5))
-    rsd_b3_params_z = np.zeros((z_arr.size, 5))
-
-    assert (zout>=0) and (zout<=5)
-    
-    for iz, zi in enumerate(z_arr):
-        rsd_b1_params_z[iz,:] = np.loadtxt(path+'rsd_b1_poly_zout_%.1f.txt'%zi, unpack=True)
-        rsd_b2_params_z[iz,:] = np.loadtxt(path+'rsd_b2_poly_zout_%.1f.txt'%zi, unpack=True)
-        rsd_bG2_params_z[iz,:] = np.loadtxt(path+'rsd_bG2_poly_zout_%.1f.txt'%zi, unpack=True)
-        rsd_b3_params_z[iz,:] = np.loadtxt(path+'rsd_b3_poly_zout_%.1f.txt'%zi, unpack=True)
-        
-    # interpolate along redshifts and take the value at zout       
-    rsd_b1_params_zout = interp.interp1d(z_arr, rsd_b1_params_z, axis=0)(zout)
-    rsd_b2_params_zout = interp.interp1d(z_arr, rsd_b2_params_z, axis=0)(zout)
-    rsd_bG2_params_zout = interp.interp1d(z_arr, rsd_bG2_params_z, axis=0)(zout)
-    rsd_b3_params_zout = interp.interp1d(z_arr, rsd_b3_params_z, axis=0)(zout)
-
-    def rsd_filter_beta1_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return beta1_poly_interkmu(absk, mu) * val
-
-    def rsd_filter_beta2_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return beta2_poly_interkmu(absk, mu) * val
-
-    def rsd_filter_betaG2_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
+def rsd_polynomial_field_zout(dz, d1, d2ort, dG2ort, dG2par, d3ort, path, zout, p1, fout, noise=None):
+    # noise: optional (white noise, amplitude) term added in the same pass, see noise_kmu_zout_term
+
+    # interpolate along redshifts and take the value at zout
+    rsd_b1_params_zout, rsd_b2_params_zout, rsd_bG2_params_zout, rsd_b3_params_zout = \
+        bestfit_params(path, zout, ['rsd_b1_poly', 'rsd_b2_poly', 'rsd_bG2_poly', 'rsd_b3_poly'], comm=d1.pm.comm)
+
+    # beta(k, mu), polynomials in k and k*mu
+    def beta1_poly_interkmu(k, mu):
+        kmu2 = (k*mu)**2
+        c = rsd_b1_params_zout
+        return c[0] + k*(c[1] + k*(c[2] + c[3]*k**2)) + kmu2*(c[4] + c[5]*kmu2)
+
+    def beta_poly_interkmu(c):
+        def beta(k, mu):
+            k2, kmu2 = k**2, (k*mu)**2
+            return c[0] + k2*(c[1] + c[2]*k2) + kmu2*(c[3] + c[4]*kmu2)
+        return beta
+
+    terms = [(dz, 1.),
+             (dG2par, -3./7.*fout),
+             (d1, beta1_poly_interkmu),
+             (d2ort, beta_poly_interkmu(rsd_b2_params_zout)),
+             (dG2ort, beta_poly_interkmu(rsd_bG2_params_zout)),
+             (d3ort, beta_poly_interkmu(rsd_b3_params_zout))]
+    if noise is not None:
+        terms.append(noise)
+    return assemble_fields(terms, los=p1.attrs['los'])
+
+class BiasSweep(object):
+    """
+    Power spectra of the HI field of polynomial_field_zout (space='real') or
+    rsd_polynomial_field_zout (space='rsd') for many sets of transfer function coefficients at
+    once, without FFTs. The field is linear in the coefficients of the polynomials, so its
+    binned power is a quadratic form in them: the spectra of the operators weighted by every
+    pair of monomials are measured once per realization (cross_power_matrix with a basis), and
+    the power spectra (and multipoles in redshift space), their derivatives and Fisher matrices
+    of arrays of parameter sets are then numpy operations. The noise enters through its
+    expectation, the bin averages of the Perr model. The polynomials are evaluated at every
+    mode, as in redshift space; the real space mocks interpolate them between the k bins of p1,
+    which differs slightly on large scales.
+
+    fields are the complex (d1, d2ort, dG2ort, d3ort), or (dz, d1, d2ort, dG2ort, dG2par, d3ort)
+    with fout for space='rsd' (binned in Nmu mu bins along los, and in poles). The parameters
+    are the coefficients of the tables names, in their order (see bestfit); the results have a
+    leading axis over the parameter sets.
+    """
+    def __init__(self, fields, space='real', fout=None, Nmu=6, poles=(0, 2), los=(0, 0, 1), kmin=0., dk=None, kmax=None):
+        self.space = space
+        if space == 'real':
+            d1, d2, dG2, d3 = fields
+            fixed, signal = [], [d1, d2, dG2, d3]
+            self.names = ['b1_poly', 'b2_poly', 'bG2_poly', 'b3_poly', 'Perr']
+        elif space == 'rsd':
+            dz, d1, d2, dG2, dG2par, d3 = fields
+            # the terms with fixed coefficients: dz - 3/7 f dG2par
+            fixed, signal = [dz, dG2par], [d1, d2, dG2, d3]
+            self.names = ['rsd_b1_poly', 'rsd_b2_poly', 'rsd_bG2_poly', 'rsd_b3_poly', 'Perr_polyfit']
+        else:
+            raise Exception("invalid space %s" % str(space))
+        self.comm = d1.pm.comm
+        self.fixed = np.array([1., -3./7.*fout] if fixed else [])
+        basis = self.basis(space)
+        self.sizes = [len(b(np.ones(1), np.ones(1))) for b in basis]
+
+        kwargs = dict(mode='1d', kmin=kmin, dk=dk, kmax=kmax) if space == 'real' else \
+                 dict(mode='2d', Nmu=Nmu, poles=poles, los=los, kmin=kmin, dk=dk, kmax=kmax)
+        res = cross_power_matrix(fixed + signal, basis=[None] * len(fixed) + basis[:4], **kwargs)
+        # bin averages of the noise monomials: spectra of the unit field with them and with 1
+        noise = cross_power_matrix([None, None], basis=[basis[4], lambda k, mu: [k**0]], pm=d1.pm, **kwargs)
+        V = d1.pm.BoxSize.prod()
+        self.P = res[0]
+        self.noise = noise[0][..., :-1, -1] / V
+        self.pkref = res[-1]
+        if len(res) == 3:
+            self.Pell = res[1]
+            self.noise_ell = noise[1][..., :-1, -1] / V
+            self.kell = self.pkref.poles['k']
+        power = self.pkref.power
+        self.k = power['k']
+        self.modes = power['modes']
+
+    @staticmethod
+    def basis(space):
+        # monomials of the transfer functions (in the order of the coefficients of their tables)
+        # and of the Perr model, as in polynomial_field_zout, rsd_polynomial_field_zout and
+        # noise_kmu_zout_term
+        if space == 'real':
+            beta = lambda k, mu: [k**0, k**2, k**4]
+            return [lambda k, mu: [k**0, k, k**2, k**4], beta, beta, beta, lambda k, mu: [k**0]]
+        beta = lambda k, mu: [k**0, k**2, k**4, (k*mu)**2, (k*mu)**4]
+        return [lambda k, mu: [k**0, k, k**2, k**4, (k*mu)**2, (k*mu)**4], beta, beta, beta,
+                lambda k, mu: [k**0, k**2, k**3, k**4, (k*mu)**2, (k*mu)**3, (k*mu)**4]]
+
+    def bestfit(self, path, zout):
+        """
+        The parameters of the best-fit tables in path at zout (interpolated in z).
+        """
+        return np.concatenate([np.atleast_1d(c) for c in bestfit_params(path, zout, self.names, comm=self.comm)])
+
+    def _split(self, params):
+        # coefficients of all the weighted operators (fixed ones first) and of the noise
+        params = np.atleast_2d(params)
+        nsignal = sum(self.sizes[:4])
+        fixed = np.broadcast_to(self.fixed, (len(params), len(self.fixed)))
+        return np.concatenate([fixed, params[:, :nsignal]], axis=1), params[:, nsignal:]
+
+    def power(self, params, poles=False):
+        """
+        P_HI of each parameter set: (nsets, Nk) in real space, (nsets, Nk, Nmu) in redshift
+        space, or the multipoles (nsets, Nell, Nk) with poles.
+        """
+        c, a = self._split(params)
+        P, noise = (self.Pell, self.noise_ell) if poles else (self.P, self.noise)
+        return np.einsum('sa,...ab,sb->s...', c, P, c) + np.einsum('...m,sm->s...', noise, a)
+
+    def derivatives(self, params, poles=False):
+        """
+        Derivatives of power(params, poles) with respect to the parameters: (nsets, nparams, ...).
+        """
+        c, a = self._split(params)
+        P, noise = (self.Pell, self.noise_ell) if poles else (self.P, self.noise)
+        dsignal = 2 * np.einsum('...ab,sb->s...a', P, c)[..., len(self.fixed):]
+        dnoise = np.broadcast_to(noise, (len(c),) + noise.shape)
+        d = np.concatenate([dsignal, dnoise], axis=-1)
+        return np.moveaxis(d, -1, 1)
+
+    def fisher(self, params, cov=None, poles=False, kmax=None):
+        """
+        Fisher matrices (nsets, nparams, nparams) of the parameters for the power spectra (or the
+        multipoles with poles) of the bins with k < kmax. cov is the covariance of the flattened
+        data vector of these bins; by default the Gaussian variance 2 P^2/modes of each bin of
+        the power spectrum, which needs poles=False.
+        """
+        d = self.derivatives(params, poles=poles)
+        kk = self.kell if poles else self.k
+        use = np.isfinite(kk) & (kk < (np.inf if kmax is None else kmax))
+        if poles:
+            use = np.broadcast_to(use, d.shape[2:])
+        d = d[:, :, use]
+        if cov is None:
+            if poles:
+                raise Exception('The covariance of the multipoles has to be given')
+            P = self.power(params)[:, use]
+            icov = self.modes[use] / (2 * P**2)
+            return np.einsum('spi,si,sqi->spq', d, icov, d)
+        return np.einsum('spi,ij,sqj->spq', d, np.linalg.inv(cov), d)
+
+    def save(self, path):
+        np.savez(path, space=self.space, names=self.names, fixed=self.fixed, sizes=self.sizes, P=self.P, noise=self.noise,
+                 k=self.k, modes=self.modes, **(dict(Pell=self.Pell, noise_ell=self.noise_ell, kell=self.kell)
+                                                 if hasattr(self, 'Pell') else {}))
+
+    @classmethod
+    def load(cls, path):
+        """
+        A BiasSweep saved with save (without its pkref).
+        """
+        self = cls.__new__(cls)
+        with np.load(path) as f:
+            for name in f.files:
+                setattr(self, name, f[name])
+        self.space, self.names, self.sizes = str(self.space), list(self.names), list(self.sizes)
+        return self
+
+class TransferFunctionFit(object):
+    """
+    Transfer functions of many catalogs (e.g. HODs) on the same orthogonalized operators, as in
+    extra/HiddenValley/measure_transfer_functions.py: beta_i = P_hO_i/P_O_iO_i in k bins, the
+    best-fit field sum_i beta_i(k) O_i with the betas interpolated linearly in k (constant
+    outside the bins), the power Perr of its residual and its cross-correlation r with the
+    catalog. The auto spectra of the operators and the bins of the modes are computed once;
+    each catalog then costs one paint, one FFT and two passes over its modes (its cross spectra
+    with the operators, then the best-fit field and its spectra), on the threads of set_threads.
+
+    operators are complex fields on one pm, e.g. (d1, d2ort, dG2ort, d3ort), binned as in
+    FFTPower(mode='1d', kmin, dk, kmax).
+    """
+    def __init__(self, operators, kmin=0., dk=None, kmax=None, compensate=True, chunksize=1024**2):
+        self.operators = operators
+        self.pm = operators[0].pm
+        self.compensate = compensate
+        P, self.pkref = cross_power_matrix(operators, kmin=kmin, dk=dk, kmax=kmax, chunksize=chunksize)
+        self.Poperators = np.diagonal(P, axis1=1, axis2=2).T
+        # the betas are interpolated between the centres of the k bins (power.coords), as the
+        # interp1d of measure_transfer_functions.py did
+        self.k = self.pkref.power.coords['k']
+        self.modes = self.pkref.power['modes']
+        dk, kedges, muedges = _power_edges(self.pm, 1, kmin, dk, kmax)
+        self.Nk = len(kedges) - 1
+        # per chunk: slice, modes in a bin, their bin, k and weight (zero at k=0)
+        self.chunks = [(sl, valid, index.astype(np.int32), k, weight * nonzero) for sl, valid, index, k, mu, weight, nonzero, _
+                       in _bin_chunks(self.pm, kedges, muedges, [0, 0, 1], chunksize)]
+
+    def _binned(self, products):
+        # power of the real products(sl, valid, k) of the modes of every chunk, in the k bins
+        def chunk(c):
+            sl, valid, index, k, weight = c
+            return np.array([np.bincount(index, weights=weight * y, minlength=self.Nk) for y in products(sl, valid, k)])
+        if _NTHREADS > 1 and len(self.chunks) > 1:
+            with ThreadPoolExecutor(_NTHREADS) as pool:
+                ysum = sum(pool.map(chunk, self.chunks))
+        else:
+            ysum = sum(map(chunk, self.chunks))
+        ysum = self.pm.comm.allreduce(ysum)
         with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return betaG2_poly_interkmu(absk, mu) * val
-
-    def rsd_filter_beta3_poly(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
+            return self.pm.BoxSize.prod() * ysum / self.modes
+
+    def fit(self, delta_h, bestfit=False):
+        """
+        Fit of the complex field delta_h. Returns a dict with the k (centres) and modes of the bins, beta
+        (N, Nk), Phh, Pbestfit, Phbestfit, Perr and r = Phbestfit/(Phh Pbestfit)^0.5, and with
+        bestfit the best-fit field.
+        """
+        ops = self.operators
+        def cross(sl, valid, k):
+            h = delta_h.value[sl].ravel()[valid]
+            return [(h * h.conj()).real] + [(h * o.value[sl].ravel()[valid].conj()).real for o in ops]
+        P = self._binned(cross)
         with np.errstate(invalid='ignore', divide='ignore'):
-            mu = sum(k3vec[i] * p1.attrs['los'][i] for i in range(3)) / absk
-        return beta3_poly_interkmu(absk, mu) * val
-
-    def beta1_poly_interkmu(k,mu):
-        return np.dot(np.array([np.ones_like(k), k, k**2, k**4, (k*mu)**2, (k*mu)**4]).T, rsd_b1_params_zout).T
-
-    def beta2_poly_interkmu(k,mu):
-        return np.dot(np.array([np.ones_like(k), k**2, k**4, (k*mu)**2, (k*mu)**4]).T, rsd_b2_params_zout).T
-
-    def betaG2_poly_interkmu(k,mu):
-        return np.dot(np.array([np.ones_like(k), k**2, k**4, (k*mu)**2, (k*mu)**4]).T, rsd_bG2_params_zout).T
-
-    def beta3_poly_interkmu(k,mu):
-        return np.dot(np.array([np.ones_like(k), k**2, k**4, (k*mu)**2, (k*mu)**4]).T, rsd_b3_params_zout).T
-
-    beta11_poly = d1.apply(rsd_filter_beta1_poly, kind='wavenumber')
-    beta11_poly[np.isnan(beta11_poly)]=0+0j
-    beta22_poly = d2ort.apply(rsd_filter_beta2_poly, kind='wavenumber')
-    beta22_poly[np.isnan(beta22_poly)]=0+0j
-    betaG2G2_poly = dG2ort.apply(rsd_filter_betaG2_poly, kind='wavenumber')
-    betaG2G2_poly[np.isnan(betaG2G2_poly)]=0+0j
-    beta33_poly = d3ort.apply(rsd_filter_beta3_poly, kind='wavenumber')
-    beta33_poly[np.isnan(beta33_poly)]=0+0j
-
-    final_field_poly = dz - 3./7.*fout*dG2par + beta11_poly + beta22_poly + betaG2G2_poly + beta33_poly
-
-    return final_field_poly
-
-def noise(zout, Nmesh, BoxSize):
+            beta = P[1:] / self.Poperators
+        use = np.isfinite(self.k) & np.all(np.isfinite(beta), axis=0)
+        kk, table = self.k[use], beta[:, use]
+
+        def fused(sl, valid, k):
+            h = delta_h.value[sl].ravel()[valid]
+            f = sum(np.interp(k, kk, b) * o.value[sl].ravel()[valid] for b, o in zip(table, ops))
+            return [(f * f.conj()).real, (h * f.conj()).real, abs(h - f)**2]
+        Pbestfit, Phbestfit, Perr = self._binned(fused)
+
+        result = dict(k=self.k, modes=self.modes, beta=beta, Phh=P[0], Pbestfit=Pbestfit, Phbestfit=Phbestfit,
+                      Perr=Perr, r=Phbestfit / (P[0] * Pbestfit)**0.5)
+        if bestfit:
+            result['bestfit'] = assemble_fields([(o, lambda k, mu, b=b: np.interp(k, kk, b)) for b, o in zip(table, ops)])
+        return result
+
+    def __call__(self, pos, bestfit=False):
+        """
+        fit of the number density of the catalog with positions pos (the part of this rank),
+        painted as ArrayCatalog(...).to_mesh(compensated=compensate); the result also has its
+        number density nbar.
+        """
+        N = self.pm.comm.allreduce(len(pos))
+        with profile_stage('paint'):
+            delta_h = paint_fields(pos, [None], self.pm, compensate=self.compensate)[0]
+        with profile_stage('fit'):
+            result = self.fit(delta_h, bestfit=bestfit)
+        result['nbar'] = N / self.pm.BoxSize.prod()
+        return result
+
+def fit_catalogs(tasks, load_operators, load_positions, save, ngroups=1, comm=None, done=None, **kwargs):
+    """
+    TransferFunctionFit of the catalogs of tasks on a pool of ngroups groups of ranks of comm
+    (see run_ensemble). Each group builds its fit once, with the complex operators returned by
+    load_operators(subcomm) on its communicator. For each task, load_positions(task, subcomm)
+    returns the positions of the part of the catalog read by this rank, and save(task, result)
+    is called on rank 0 of the group. kwargs go to TransferFunctionFit.
+    """
+    fits = []
+    def run_task(task, subcomm):
+        if not fits:
+            fits.append(TransferFunctionFit(load_operators(subcomm), **kwargs))
+        result = fits[0](load_positions(task, subcomm))
+        if subcomm.rank == 0:
+            save(task, result)
+    return run_ensemble(tasks, run_task, ngroups, comm=comm, done=done)
+
+def noise_seed(seed, zout):
+    """
+    Seed of the noise white field, derived from the IC seed and zout.
+    """
+    return int(hashlib.sha1(('noise %d %.4f' % (seed, zout)).encode()).hexdigest()[:8], 16)
 
-    noise_seed = np.random.randint(0,1000000)
+def noise_whitenoise(zout, Nmesh, BoxSize, seed=None, pm=None, comm=None):
+    """
+    Unit white noise for the stochastic term at zout, drawn once over all ranks on pm (pass the pm
+    of the signal fields so that the noise shares their communicator and layout) or on a new
+    ParticleMesh on comm. With the IC seed, the noise seed is noise_seed(seed, zout) and the field
+    is the same for any number of ranks; with seed=None a random seed is drawn on rank 0.
+    """
+    if pm is None:
+        if comm is None:
+            raise ValueError("the noise needs the pm of the signal fields or their comm")
+        pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize, comm=comm)
+    if seed is None:
+        wn_seed = pm.comm.bcast(np.random.randint(0,1000000) if pm.comm.rank == 0 else None)
+    else:
+        wn_seed = noise_seed(seed, zout)
+    return pm.generate_whitenoise(wn_seed)
 
-    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize)
-    wn = pm.generate_whitenoise(noise_seed)
+def noise(zout, Nmesh, BoxSize, seed=None, pm=None, comm=None):
 
     if zout==0:
         perr_level = 70.75
     elif zout==1:
         perr_level = 34.9
+    else:
+        raise ValueError("noise has Perr at zout=0 and 1 only, use noise_zout for zout=%s" % str(zout))
 
-    def Perr_level(k):
-        return np.ones_like(k)*perr_level
-
-    return wn.apply(lambda k, val: Perr_level(sum(ki ** 2 for ki in k)**0.5) ** 0.5 * val / val.BoxSize.prod() ** 0.5)
+    wn = noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, pm=pm, comm=comm)
 
-def noise_zout(zout, Nmesh, BoxSize, path):
+    wn.value[...] *= perr_level ** 0.5 / wn.BoxSize.prod() ** 0.5
+    return wn
 
-    noise_seed = np.random.randint(0,1000000)
+def noise_zout_term(zout, Nmesh, BoxSize, path, seed=None, pm=None, comm=None):
+    # (white noise, amplitude) with amplitude^2 = Perr/V, for assemble_fields
 
-    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize)
-    wn = pm.generate_whitenoise(noise_seed)
+    wn = noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, pm=pm, comm=comm)
 
-    z, perrz = np.loadtxt(path + "z_Perr.txt", unpack=True)
-    perr_zout = np.interp(zout, z, perrz)
-    
-    def Perr_level(k):
-        return np.ones_like(k)*perr_zout
+    perr_zout, = bestfit_params(path, zout, ['Perr'], comm=wn.pm.comm)[0]
 
-    return wn.apply(lambda k, val: Perr_level(sum(ki ** 2 for ki in k)**0.5) ** 0.5 * val / val.BoxSize.prod() ** 0.5)
+    return wn, perr_zout ** 0.5 / wn.BoxSize.prod() ** 0.5
 
-def noise_kmu(zout, Nmesh, BoxSize, axis, fout, path):
+def noise_zout(zout, Nmesh, BoxSize, path, seed=None, pm=None, comm=None):
+    wn, amplitude = noise_zout_term(zout, Nmesh, BoxSize, path, seed=seed, pm=pm, comm=comm)
+    wn.value[...] *= amplitude
+    return wn
 
-    noise_seed = np.random.randint(0,1000000)
+def noise_kmu(zout, Nmesh, BoxSize, axis, fout, path, seed=None, pm=None, comm=None):
 
-    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize)
-    wn = pm.generate_whitenoise(noise_seed)
+    wn = noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, pm=pm, comm=comm)
 
-    a0, a2, a3, a4, a22, a33, a44 = np.loadtxt(path + 'Perr_polyfit_zout_%.1f.txt'%zout, unpack=True)
+    a0, a2, a3, a4, a22, a33, a44 = bestfit_params(path, zout, ['Perr_polyfit'], comm=wn.pm.comm)[0]
     los = np.zeros(3, dtype=int)
     los[axis]=1    
     # print ('los ', los)
@@ -1864,65 +3281,38 @@ def noise_kmu(zout, Nmesh, BoxSize, axis, fout, path):
     def Perr_kmu_model(k,mu):
         return a0 + a2*k**2 + a3*k**3 + a4*k**4 + a22*(k*mu)**2 + a33*(k*mu)**3 + a44*(k*mu)**4
 
-    def Perr_kmu_function(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore',
-                         divide='ignore'):
-            mu = sum(k3vec[i] * los[i] for i in range(3)) / absk
-        return Perr_kmu_model(absk, mu)**0.5 * val / val.BoxSize.prod() ** 0.5
-
-    wn = wn.apply(Perr_kmu_function, kind='wavenumber')
-    wn[np.isnan(wn)]=0+0j
-
-    return wn
+    def Perr_kmu_function(k, mu):
+        return Perr_kmu_model(k, mu)**0.5 / wn.BoxSize.prod() ** 0.5
 
-def noise_kmu_zout(zout, Nmesh, BoxSize, axis, fout, path):
+    return scale_field(wn, Perr_kmu_function, los=los)
 
-    noise_seed = np.random.randint(0,1000000)
-
-    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize)
-    wn = pm.generate_whitenoise(noise_seed)
-    
-    # available redshifts
-    z_arr = np.array([0,0.5,1,1.5,2,3,5])
-    
-    noise_params_z = np.zeros((z_arr.size, 7))
+def noise_kmu_zout_term(zout, Nmesh, BoxSize, axis, path, seed=None, pm=None, comm=None):
+    # (white noise, amplitude(k, mu)) with amplitude^2 = Perr(k, mu)/V, for assemble_fields
 
-    assert (zout>=0) and (zout<=5)
+    wn = noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, pm=pm, comm=comm)
     
-    for iz, zi in enumerate(z_arr):
-        noise_params_z[iz,:] = np.loadtxt(path+'Perr_polyfit_zout_%.1f.txt'%zi, unpack=True)
-
-    # interpolate along redshifts and take the value at zout       
-    noise_params_zout = interp.interp1d(z_arr, noise_params_z, axis=0)(zout)
-    a0, a2, a3, a4, a22, a33, a44 = noise_params_zout
-
-    los = np.zeros(3, dtype=int)
-    los[axis]=1    
+    # interpolate along redshifts and take the value at zout
+    a0, a2, a3, a4, a22, a33, a44 = bestfit_params(path, zout, ['Perr_polyfit'], comm=wn.pm.comm)[0]
 
     def Perr_kmu_model(k,mu):
         return a0 + a2*k**2 + a3*k**3 + a4*k**4 + a22*(k*mu)**2 + a33*(k*mu)**3 + a44*(k*mu)**4
 
-    def Perr_kmu_function(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore',
-                         divide='ignore'):
-            mu = sum(k3vec[i] * los[i] for i in range(3)) / absk
-        return Perr_kmu_model(absk, mu)**0.5 * val / val.BoxSize.prod() ** 0.5
+    def Perr_kmu_function(k, mu):
+        return Perr_kmu_model(k, mu)**0.5 / wn.BoxSize.prod() ** 0.5
 
-    wn = wn.apply(Perr_kmu_function, kind='wavenumber')
-    wn[np.isnan(wn)]=0+0j
+    return wn, Perr_kmu_function
 
-    return wn
-
-def _noise_kmu_(zout, Nmesh, BoxSize, axis, fout, path):
+def noise_kmu_zout(zout, Nmesh, BoxSize, axis, fout, path, seed=None, pm=None, comm=None):
+    los = np.zeros(3, dtype=int)
+    los[axis]=1
+    wn, Perr_kmu_function = noise_kmu_zout_term(zout, Nmesh, BoxSize, axis, path, seed=seed, pm=pm, comm=comm)
+    return scale_field(wn, Perr_kmu_function, los=los)
 
-    noise_seed = np.random.randint(0,1000000)
+def _noise_kmu_(zout, Nmesh, BoxSize, axis, fout, path, seed=None, pm=None, comm=None):
 
-    pm = ParticleMesh([Nmesh,Nmesh,Nmesh], BoxSize)
-    wn = pm.generate_whitenoise(noise_seed)
+    wn = noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, pm=pm, comm=comm)
 
-    c1, c2 = np.loadtxt(path + 'perr_kmu_fit_zout_%.1f.txt'%zout, unpack=True)
+    c1, c2 = bestfit_params(path, zout, ['perr_kmu_fit'], comm=wn.pm.comm)[0]
     los = np.zeros(3, dtype=int)
     los[axis]=1    
     # print ('los ', los)
@@ -1931,69 +3321,14 @@ def _noise_kmu_(zout, Nmesh, BoxSize, axis, fout, path):
         # c1, c2 = theta
         return c1 + fout*c2*(k*mu)**2
 
-    def Perr_kmu_function(k3vec, val):
-        absk = (sum(ki**2 for ki in k3vec))**0.5
-        with np.errstate(invalid='ignore',
-                         divide='ignore'):
-            mu = sum(k3vec[i] * los[i] for i in range(3)) / absk
-        return Perr_kmu_model(absk, mu)**0.5 * val / val.BoxSize.prod() ** 0.5
+    def Perr_kmu_function(k, mu):
+        return Perr_kmu_model(k, mu)**0.5 / wn.BoxSize.prod() ** 0.5
 
-    wn = wn.apply(Perr_kmu_function, kind='wavenumber')
-    wn[np.isnan(wn)]=0+0j
+    return scale_field(wn, Perr_kmu_function, los=los)
 
-    return wn
-
-def generate_fields_new_growth(dlin, prefactor, zic, zout, comm=None, compensate=True):
-    delta_ic = dlin.copy()
-    Nmesh = delta_ic.Nmesh
-    BoxSize = delta_ic.BoxSize[0]
-    
-    pos = delta_ic.pm.generate_uniform_particle_grid(shift=0)
-    N = pos.shape[0]
-    catalog = np.empty(N, dtype=[('Position', ('f8', 3)), ('delta_1', 'f8'), ('delta_2', 'f8'), ('delta_G2', 'f8'), ('delta_3', 'f8')])
-    catalog['Position'][:] = pos[:]
-    layout = delta_ic.pm.decompose(catalog['Position']) 
-    del pos
-    
-    delta_1 = delta_ic.c2r().readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    delta_1 -= np.mean(delta_1)
-    catalog['delta_1'][:] = delta_1[:]
-    del delta_1
-    
-    catalog['delta_2'][:] = catalog['delta_1']**2
-    catalog['delta_2'][:] -= np.mean(catalog['delta_2'])
-    
-    delta_G2 = tidal_G2(FieldMesh(delta_ic)).readout(catalog['Position'], layout=layout, resampler='cic')*prefactor**2
-    catalog['delta_G2'][:] = delta_G2[:]
-    del delta_G2
-    
-    delta_3 = d3_smooth(FieldMesh(delta_ic)).readout(catalog['Position'], layout=layout, resampler='cic')**3*prefactor**3
-    catalog['delta_3'][:] = delta_3[:]
-    del delta_3
-
-    def potential_transfer_function(k, v):
-        k2 = k.normp(zeromode=1)
-        return v / (k2)
-    pot_k = delta_ic.apply(potential_transfer_function, out=Ellipsis)
-
-    displ_catalog = np.empty(N, dtype=[('displ', ('f8',3))])
-    
-    for d in range(3):
-        def force_transfer_function(k, v, d=d):
-            return k[d] * 1j * v
-        force_d = pot_k.apply(force_transfer_function).c2r(out=Ellipsis)
-        displ_catalog['displ'][:, d] = force_d.readout(catalog['Position'], layout=layout, resampler='cic')*prefactor
-    
-    catalog['Position'][:] = (catalog['Position'][:] + displ_catalog['displ'][:]) % BoxSize
-    del displ_catalog, force_d, pot_k
-    
-    catalog = ArrayCatalog(catalog, BoxSize=BoxSize * np.ones(3), Nmesh=Nmesh, comm=comm)
-    
-    d1 = catalog.to_mesh(value='delta_1', compensated=compensate).paint().r2c()
-    d2 = catalog.to_mesh(value='delta_2', compensated=compensate).paint().r2c()
-    dG2 = catalog.to_mesh(value='delta_G2', compensated=compensate).paint().r2c()
-    d3 = catalog.to_mesh(value='delta_3', compensated=compensate).paint().r2c()
-    
+def generate_fields_new_growth(dlin, prefactor, zic, zout, comm=None, compensate=True, grid_aligned=True):
+    d1, d2, dG2, d3 = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3'], prefactor, comm=comm, compensate=compensate,
+                                                grid_aligned=grid_aligned)
     return d1, d2, dG2, d3
 
 def decic(field, n=2):
@@ -2015,249 +3350,5 @@ def decic(field, n=2):
 
 
 def orthogonalize_cubics(d1, d2, dG2, d3, dg3, dG3, dGd, dS3):
-    
-    kmin = 2*np.pi/d1.BoxSize[0]/2
-    
-    p1  = FFTPower(d1, mode='1d', kmin=kmin)
-    p2  = FFTPower(d2, mode='1d', kmin=kmin)
-    pG2 = FFTPower(dG2, mode='1d', kmin=kmin)
-    p3  = FFTPower(d3, mode='1d', kmin=kmin)
-    pg3  = FFTPower(dg3, mode='1d', kmin=kmin)
-    pG3  = FFTPower(dG3, mode='1d', kmin=kmin)
-    pGd  = FFTPower(dGd, mode='1d', kmin=kmin)
-    pS3  = FFTPower(dS3, mode='1d', kmin=kmin)
-
-    p12 = FFTPower(d1, mode='1d', second=d2, kmin=kmin)
-    p1G2 = FFTPower(d1, mode='1d', second=dG2, kmin=kmin)
-    p13 = FFTPower(d1, mode='1d', second=d3, kmin=kmin)
-    p1g3 = FFTPower(d1, mode='1d', second=dg3, kmin=kmin)
-    p1G3 = FFTPower(d1, mode='1d', second=dG3, kmin=kmin)
-    p1Gd = FFTPower(d1, mode='1d', second=dGd, kmin=kmin)
-    p1S3 = FFTPower(d1, mode='1d', second=dS3, kmin=kmin)
-
-    p2G2 = FFTPower(d2, mode='1d', second=dG2, kmin=kmin)
-    p23 = FFTPower(d2, mode='1d', second=d3, kmin=kmin)
-    p2g3 = FFTPower(d2, mode='1d', second=dg3, kmin=kmin)
-    p2G3 = FFTPower(d2, mode='1d', second=dG3, kmin=kmin)
-    p2Gd = FFTPower(d2, mode='1d', second=dGd, kmin=kmin)
-    p2S3 = FFTPower(d2, mode='1d', second=dS3, kmin=kmin)
-
-    pG23 = FFTPower(dG2, mode='1d', second=d3, kmin=kmin)
-    pG2g3 = FFTPower(dG2, mode='1d', second=dg3, kmin=kmin)
-    pG2G3 = FFTPower(dG2, mode='1d', second=dG3, kmin=kmin)
-    pG2Gd = FFTPower(dG2, mode='1d', second=dGd, kmin=kmin)
-    pG2S3 = FFTPower(dG2, mode='1d', second=dS3, kmin=kmin)
-    
-    p3g3 = FFTPower(d3, mode='1d', second=dg3, kmin=kmin)
-    p3G3 = FFTPower(d3, mode='1d', second=dG3, kmin=kmin)
-    p3Gd = FFTPower(d3, mode='1d', second=dGd, kmin=kmin)
-    p3S3 = FFTPower(d3, mode='1d', second=dS3, kmin=kmin)
-
-    pg3G3 = FFTPower(dg3, mode='1d', second=dG3, kmin=kmin)
-    pg3Gd = FFTPower(dg3, mode='1d', second=dGd, kmin=kmin)
-    pg3S3 = FFTPower(dg3, mode='1d', second=dS3, kmin=kmin)
-    
-    pG3Gd = FFTPower(dG3, mode='1d', second=dGd, kmin=kmin)
-    pG3S3 = FFTPower(dG3, mode='1d', second=dS3, kmin=kmin)
-
-    pGdS3 = FFTPower(dGd, mode='1d', second=dS3, kmin=kmin)
-
-    C = np.zeros((p1.power['k'].size,8,8)) + np.nan
-
-    for i in range(8):
-        C[:,i,i] = 1.
-        
-    C[:,0,1] = p12.power['power'].real /(p1.power['power'].real*p2.power['power'].real)**0.5
-    C[:,0,2] = p1G2.power['power'].real/(p1.power['power'].real*pG2.power['power'].real)**0.5
-    C[:,0,3] = p13.power['power'].real/(p1.power['power'].real*p3.power['power'].real)**0.5
-    C[:,0,4] = p1g3.power['power'].real/(p1.power['power'].real*pg3.power['power'].real)**0.5
-    C[:,0,5] = p1G3.power['power'].real/(p1.power['power'].real*pG3.power['power'].real)**0.5
-    C[:,0,6] = p1Gd.power['power'].real/(p1.power['power'].real*pGd.power['power'].real)**0.5
-    C[:,0,7] = p1S3.power['power'].real/(p1.power['power'].real*pS3.power['power'].real)**0.5
-
-    C[:,1,2] = p2G2.power['power'].real/(p2.power['power'].real*pG2.power['power'].real)**0.5
-    C[:,1,3] = p23.power['power'].real/(p2.power['power'].real*p3.power['power'].real)**0.5
-    C[:,1,4] = p2g3.power['power'].real/(p2.power['power'].real*pg3.power['power'].real)**0.5
-    C[:,1,5] = p2G3.power['power'].real/(p2.power['power'].real*pG3.power['power'].real)**0.5
-    C[:,1,6] = p2Gd.power['power'].real/(p2.power['power'].real*pGd.power['power'].real)**0.5
-    C[:,1,7] = p2S3.power['power'].real/(p2.power['power'].real*pS3.power['power'].real)**0.5
-
-    C[:,2,3] = pG23.power['power'].real/(pG2.power['power'].real*p3.power['power'].real)**0.5
-    C[:,2,4] = pG2g3.power['power'].real/(pG2.power['power'].real*pg3.power['power'].real)**0.5
-    C[:,2,5] = pG2G3.power['power'].real/(pG2.power['power'].real*pG3.power['power'].real)**0.5
-    C[:,2,6] = pG2Gd.power['power'].real/(pG2.power['power'].real*pGd.power['power'].real)**0.5
-    C[:,2,7] = pG2S3.power['power'].real/(pG2.power['power'].real*pS3.power['power'].real)**0.5
-
-    C[:,3,4] = p3g3.power['power'].real/(p3.power['power'].real*pg3.power['power'].real)**0.5
-    C[:,3,5] = p3G3.power['power'].real/(p3.power['power'].real*pG3.power['power'].real)**0.5
-    C[:,3,6] = p3Gd.power['power'].real/(p3.power['power'].real*pGd.power['power'].real)**0.5
-    C[:,3,7] = p3S3.power['power'].real/(p3.power['power'].real*pS3.power['power'].real)**0.5
-
-    C[:,4,5] = pg3G3.power['power'].real/(pg3.power['power'].real*pG3.power['power'].real)**0.5
-    C[:,4,6] = pg3Gd.power['power'].real/(pg3.power['power'].real*pGd.power['power'].real)**0.5
-    C[:,4,7] = pg3S3.power['power'].real/(pg3.power['power'].real*pS3.power['power'].real)**0.5
-
-    C[:,5,6] = pG3Gd.power['power'].real/(pG3.power['power'].real*pGd.power['power'].real)**0.5
-    C[:,5,7] = pG3S3.power['power'].real/(pG3.power['power'].real*pS3.power['power'].real)**0.5
-
-    C[:,6,7] = pGdS3.power['power'].real/(pGd.power['power'].real*pS3.power['power'].real)**0.5
-
-    for i in range(8):
-        for j in range(i+1, 8):
-            C[:,j,i] = C[:,i,j]
-    
-    L = np.linalg.cholesky(C)
-    Linv = np.linalg.inv(L)
-
-    ratio10 = np.sqrt(p2.power['power'].real/p1.power['power'].real)
-    ratio20 = np.sqrt(pG2.power['power'].real/p1.power['power'].real)
-    ratio30 = np.sqrt(p3.power['power'].real/p1.power['power'].real)
-    ratio40 = np.sqrt(pg3.power['power'].real/p1.power['power'].real)
-    ratio50 = np.sqrt(pG3.power['power'].real/p1.power['power'].real)
-    ratio60 = np.sqrt(pGd.power['power'].real/p1.power['power'].real)
-    ratio70 = np.sqrt(pS3.power['power'].real/p1.power['power'].real)
-
-    ratio21 = np.sqrt(pG2.power['power'].real/p2.power['power'].real)
-    ratio31 = np.sqrt(p3.power['power'].real/p2.power['power'].real)
-    ratio41 = np.sqrt(pg3.power['power'].real/p2.power['power'].real)
-    ratio51 = np.sqrt(pG3.power['power'].real/p2.power['power'].real)
-    ratio61 = np.sqrt(pGd.power['power'].real/p2.power['power'].real)
-    ratio71 = np.sqrt(pS3.power['power'].real/p2.power['power'].real)
-
-    ratio32 = np.sqrt(p3.power['power'].real/pG2.power['power'].real)
-    ratio42 = np.sqrt(pg3.power['power'].real/pG2.power['power'].real)
-    ratio52 = np.sqrt(pG3.power['power'].real/pG2.power['power'].real)
-    ratio62 = np.sqrt(pGd.power['power'].real/pG2.power['power'].real)
-    ratio72 = np.sqrt(pS3.power['power'].real/pG2.power['power'].real)
-    
-    ratio43 = np.sqrt(pg3.power['power'].real/p3.power['power'].real)
-    ratio53 = np.sqrt(pG3.power['power'].real/p3.power['power'].real)
-    ratio63 = np.sqrt(pGd.power['power'].real/p3.power['power'].real)
-    ratio73 = np.sqrt(pS3.power['power'].real/p3.power['power'].real)
-    
-    ratio54 = np.sqrt(pG3.power['power'].real/pg3.power['power'].real)
-    ratio64 = np.sqrt(pGd.power['power'].real/pg3.power['power'].real)
-    ratio74 = np.sqrt(pS3.power['power'].real/pg3.power['power'].real)
-    
-    ratio65 = np.sqrt(pGd.power['power'].real/pG3.power['power'].real)
-    ratio75 = np.sqrt(pS3.power['power'].real/pG3.power['power'].real)
-
-    ratio76 = np.sqrt(pS3.power['power'].real/pGd.power['power'].real)
-
-    M10 = Linv[:,1,0]/Linv[:,1,1]*ratio10
-    M20 = Linv[:,2,0]/Linv[:,2,2]*ratio20
-    M30 = Linv[:,3,0]/Linv[:,3,3]*ratio30
-    M40 = Linv[:,4,0]/Linv[:,4,4]*ratio40
-    M50 = Linv[:,5,0]/Linv[:,5,5]*ratio50
-    M60 = Linv[:,6,0]/Linv[:,6,6]*ratio60
-    M70 = Linv[:,7,0]/Linv[:,7,7]*ratio70
-    
-    M21 = Linv[:,2,1]/Linv[:,2,2]*ratio21
-    M31 = Linv[:,3,1]/Linv[:,3,3]*ratio31
-    M41 = Linv[:,4,1]/Linv[:,4,4]*ratio41
-    M51 = Linv[:,5,1]/Linv[:,5,5]*ratio51
-    M61 = Linv[:,6,1]/Linv[:,6,6]*ratio61
-    M71 = Linv[:,7,1]/Linv[:,7,7]*ratio71
-
-    M32 = Linv[:,3,2]/Linv[:,3,3]*ratio32
-    M42 = Linv[:,4,2]/Linv[:,4,4]*ratio42
-    M52 = Linv[:,5,2]/Linv[:,5,5]*ratio52
-    M62 = Linv[:,6,2]/Linv[:,6,6]*ratio62
-    M72 = Linv[:,7,2]/Linv[:,7,7]*ratio72
-
-    M43 = Linv[:,4,3]/Linv[:,4,4]*ratio43
-    M53 = Linv[:,5,3]/Linv[:,5,5]*ratio53
-    M63 = Linv[:,6,3]/Linv[:,6,6]*ratio63
-    M73 = Linv[:,7,3]/Linv[:,7,7]*ratio73
-    
-    M54 = Linv[:,5,4]/Linv[:,5,5]*ratio54
-    M64 = Linv[:,6,4]/Linv[:,6,6]*ratio64
-    M74 = Linv[:,7,4]/Linv[:,7,7]*ratio74
-
-    M65 = Linv[:,6,5]/Linv[:,6,6]*ratio65
-    M75 = Linv[:,7,5]/Linv[:,7,7]*ratio75
-    
-    M76 = Linv[:,7,6]/Linv[:,7,7]*ratio76
-
-    kk = p1.power.coords['k']
-    
-    interkmu_M10 = interp1d_manual_k_binning(kk, M10, fill_value=[M10[0],M10[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M20 = interp1d_manual_k_binning(kk, M20, fill_value=[M20[0],M20[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M30 = interp1d_manual_k_binning(kk, M30, fill_value=[M30[0],M30[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M40 = interp1d_manual_k_binning(kk, M40, fill_value=[M40[0],M40[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M50 = interp1d_manual_k_binning(kk, M50, fill_value=[M50[0],M50[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M60 = interp1d_manual_k_binning(kk, M60, fill_value=[M60[0],M60[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M70 = interp1d_manual_k_binning(kk, M70, fill_value=[M70[0],M70[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-
-    interkmu_M21 = interp1d_manual_k_binning(kk, M21, fill_value=[M21[0],M21[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M31 = interp1d_manual_k_binning(kk, M31, fill_value=[M31[0],M31[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M41 = interp1d_manual_k_binning(kk, M41, fill_value=[M41[0],M41[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M51 = interp1d_manual_k_binning(kk, M51, fill_value=[M51[0],M51[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M61 = interp1d_manual_k_binning(kk, M61, fill_value=[M61[0],M61[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M71 = interp1d_manual_k_binning(kk, M71, fill_value=[M71[0],M71[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    
-    interkmu_M32 = interp1d_manual_k_binning(kk, M32, fill_value=[M32[0],M32[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M42 = interp1d_manual_k_binning(kk, M42, fill_value=[M42[0],M42[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M52 = interp1d_manual_k_binning(kk, M52, fill_value=[M52[0],M52[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M62 = interp1d_manual_k_binning(kk, M62, fill_value=[M62[0],M62[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M72 = interp1d_manual_k_binning(kk, M72, fill_value=[M72[0],M72[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-
-    interkmu_M43 = interp1d_manual_k_binning(kk, M43, fill_value=[M43[0],M43[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M53 = interp1d_manual_k_binning(kk, M53, fill_value=[M53[0],M53[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M63 = interp1d_manual_k_binning(kk, M63, fill_value=[M63[0],M63[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M73 = interp1d_manual_k_binning(kk, M73, fill_value=[M73[0],M73[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-
-    interkmu_M54 = interp1d_manual_k_binning(kk, M54, fill_value=[M54[0],M54[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M64 = interp1d_manual_k_binning(kk, M64, fill_value=[M64[0],M64[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M74 = interp1d_manual_k_binning(kk, M74, fill_value=[M74[0],M74[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-
-    interkmu_M65 = interp1d_manual_k_binning(kk, M65, fill_value=[M65[0],M65[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-    interkmu_M75 = interp1d_manual_k_binning(kk, M75, fill_value=[M75[0],M75[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-
-    interkmu_M76 = interp1d_manual_k_binning(kk, M76, fill_value=[M76[0],M76[-1]], Ngrid=p1.attrs['Nmesh'], L = p1.attrs['BoxSize'][0], Pkref=p1)
-
-    test = d1.apply(lambda k, v: interkmu_M10(sum(ki ** 2 for ki in k)**0.5) * v)
-    d2ort = d2+test
-
-    test = d1.apply(lambda k, v: interkmu_M20(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M21(sum(ki ** 2 for ki in k)**0.5) * v)
-    dG2ort = dG2+test+test2
-
-    test = d1.apply(lambda k, v: interkmu_M30(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M31(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M32(sum(ki ** 2 for ki in k)**0.5) * v)
-    d3ort = d3+testG2+test+test2
-
-    test = d1.apply(lambda k, v: interkmu_M40(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M41(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M42(sum(ki ** 2 for ki in k)**0.5) * v)
-    # test3 = d3.apply(lambda k, v: interkmu_M43(sum(ki ** 2 for ki in k)**0.5) * v)
-    dg3ort = dg3+test+test2+testG2#+test3
-
-    test = d1.apply(lambda k, v: interkmu_M50(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M51(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M52(sum(ki ** 2 for ki in k)**0.5) * v)
-    # test3 = d3.apply(lambda k, v: interkmu_M53(sum(ki ** 2 for ki in k)**0.5) * v)
-    # testg3 = dg3.apply(lambda k, v: interkmu_M54(sum(ki ** 2 for ki in k)**0.5) * v)
-    dG3ort = dG3+test+test2+testG2#+test3#+testg3
-
-    test = d1.apply(lambda k, v: interkmu_M60(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M61(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M62(sum(ki ** 2 for ki in k)**0.5) * v)
-    # test3 = d3.apply(lambda k, v: interkmu_M63(sum(ki ** 2 for ki in k)**0.5) * v)
-    # testg3 = dg3.apply(lambda k, v: interkmu_M64(sum(ki ** 2 for ki in k)**0.5) * v)
-    # testG3 = dG3.apply(lambda k, v: interkmu_M65(sum(ki ** 2 for ki in k)**0.5) * v)
-    dGdort = dGd+test+test2+testG2#+test3#+testg3+testG3
-
-    test = d1.apply(lambda k, v: interkmu_M70(sum(ki ** 2 for ki in k)**0.5) * v)
-    test2 = d2.apply(lambda k, v: interkmu_M71(sum(ki ** 2 for ki in k)**0.5) * v)
-    testG2 = dG2.apply(lambda k, v: interkmu_M72(sum(ki ** 2 for ki in k)**0.5) * v)
-    # test3 = d3.apply(lambda k, v: interkmu_M73(sum(ki ** 2 for ki in k)**0.5) * v)
-    # testg3 = dg3.apply(lambda k, v: interkmu_M74(sum(ki ** 2 for ki in k)**0.5) * v)
-    # testG3 = dG3.apply(lambda k, v: interkmu_M75(sum(ki ** 2 for ki in k)**0.5) * v)
-    # testG2d = dG2d.apply(lambda k, v: interkmu_M76(sum(ki ** 2 for ki in k)**0.5) * v)
-    dS3ort = dS3+test+test2+testG2#+test3#+testg3+testG3+testG2d
-
-    del test, test2, testG2#, test3
-    
-    return d2ort, dG2ort, d3ort, dg3ort, dG3ort, dGdort, dS3ort
\ No newline at end of file
+    # the cubic operators after d3 are only orthogonalized against d1, d2 and dG2
+    return tuple(orthogonalize_fields([d1, d2, dG2, d3, dg3, dG3, dGd, dS3], nbasis=3))
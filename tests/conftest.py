@@ -0,0 +1,34 @@
+# the tests import the library as the drivers do, from the root of the repository
+import os, sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# small meshes shared by the tests
+Nmesh, BoxSize, seed = 32, 100., 42
+
+def Pk(k):
+    # toy linear power spectrum
+    return 500. * (1 + (k / 0.2)**2)**-2
+
+def absmax(comm, x):
+    # max |x| over all ranks (x is the local part of a field)
+    from mpi4py import MPI
+    return comm.allreduce(float(np.abs(x).max()) if x.size else 0., op=MPI.MAX)
+
+@pytest.fixture(scope='session')
+def comm():
+    from nbodykit import CurrentMPIComm
+    return CurrentMPIComm.get()
+
+@pytest.fixture(scope='session')
+def cosmo(comm):
+    # TNG300-1, as in the drivers
+    from lib.tng_lib import TabulatedCosmology
+    return TabulatedCosmology(None, comm, h=0.6774, T0_cmb=2.725, Omega0_b=0.0486, Omega0_cdm=0.2603,
+                              m_ncdm=[], n_s=0.9667, k_pivot=0.05, A_s=2.055e-9, YHe=0.24)
+
+@pytest.fixture(scope='module')
+def dlin(comm):
+    from lib.tng_lib import get_dlin
+    return get_dlin(seed, Nmesh, BoxSize, Pk, comm)
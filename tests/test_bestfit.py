@@ -0,0 +1,50 @@
+# the table of best-fit coefficients: compiled from the text files on first use, keyed on their contents
+import os, shutil
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+import lib.tng_lib as tng_lib
+from lib.tng_lib import bestfit_table, bestfit_params, compile_bestfit_params
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+@pytest.fixture
+def data_dir(comm, tmp_path):
+    # a copy of the text files, without a compiled table
+    data_dir = comm.bcast(str(tmp_path / 'data') if comm.rank == 0 else None)
+    if comm.rank == 0:
+        for folder in ('r_space_bestfit_params', 'z_space_bestfit_params'):
+            shutil.copytree(os.path.join(data, folder), os.path.join(data_dir, folder))
+    comm.barrier()
+    yield data_dir
+    tng_lib._bestfit_tables.pop(data_dir, None)
+
+def tables(data_dir):
+    return sorted(f for f in os.listdir(data_dir) if f.endswith('.npy'))
+
+def test_table(comm, data_dir):
+    path = os.path.join(data_dir, 'r_space_bestfit_params/')
+    table = bestfit_table(path, comm)
+    ref = compile_bestfit_params(data_dir)
+    for name in ref.dtype.names:
+        assert np.array_equal(table[name], ref[name], equal_nan=True)
+    # saved once, by rank 0
+    comm.barrier()
+    assert len(tables(data_dir)) == 1
+    perr = dict(np.loadtxt(os.path.join(path, 'z_Perr.txt')))
+    assert np.isclose(bestfit_params(path, 1., ['Perr'], comm=comm)[0][0], perr[1.])
+
+def test_edited_sources(comm, data_dir):
+    path = os.path.join(data_dir, 'r_space_bestfit_params/')
+    bestfit_table(path, comm)
+    comm.barrier()
+    if comm.rank == 0:
+        with open(os.path.join(path, 'z_Perr.txt'), 'a') as f:
+            f.write('7. 100.\n')
+    comm.barrier()
+    # a new process compiles a new table from the edited files
+    tng_lib._bestfit_tables.pop(data_dir)
+    assert bestfit_table(path, comm)['z'][-1] == 7.
+    comm.barrier()
+    assert len(tables(data_dir)) == 2
@@ -0,0 +1,60 @@
+# BiasSweep against the power of the field it sweeps, and its derivatives against finite differences
+import os
+import types
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+from conftest import Nmesh, BoxSize
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+zout, kmin = 1., 2*np.pi/BoxSize/2
+
+@pytest.fixture(scope='module')
+def operators(dlin):
+    d1, d2, dG2, d3 = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3'], 0.8, verbose=False)
+    return [d1] + list(orthogonalize(d1, d2, dG2, d3))
+
+def test_power(operators):
+    path = os.path.join(data, 'r_space_bestfit_params/')
+    sweep = BiasSweep(operators, space='real', kmin=kmin)
+    b1, b2, bG2 = 1.7, 0.4, -0.3
+    params = sweep.bestfit(path, zout)
+    start = np.cumsum([0] + sweep.sizes)
+    params[start[0]], params[start[1]], params[start[2]] = b1, b2, bG2
+    # without the noise
+    params[start[4]:] = 0
+
+    # polynomial_field_cnn interpolates the polynomials between the k of p1: on a fine grid of k,
+    # this is the polynomials at every mode, as in the sweep
+    p1 = types.SimpleNamespace(power=types.SimpleNamespace(coords={'k': np.linspace(0, 2, 20001)}))
+    field = polynomial_field_cnn(*operators, path, zout, p1, b1, b2, bG2)
+    ref = FFTPower(field, mode='1d', kmin=kmin).power['power'].real
+    P = sweep.power(params)[0]
+    use = np.isfinite(ref)
+    assert use.sum() > 5
+    assert np.allclose(P[use], ref[use], rtol=1e-6, atol=0)
+
+@pytest.mark.parametrize('space', ['real', 'rsd'])
+def test_derivatives(dlin, space):
+    path = os.path.join(data, 'r_space_bestfit_params/' if space == 'real' else 'z_space_bestfit_params/')
+    if space == 'real':
+        fields = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3'], 0.8, verbose=False)
+        sweep = BiasSweep(fields, space='real', kmin=kmin)
+    else:
+        fields = generate_fields_operators(dlin, ['dz', 'd1', 'd2', 'G2', 'G2par', 'd3'], 0.8, fout=0.7, verbose=False)
+        sweep = BiasSweep(fields, space='rsd', fout=0.7, kmin=kmin)
+    params = sweep.bestfit(path, zout)[None] * np.array([[1.], [0.8]])
+    for poles in ([False, True] if space == 'rsd' else [False]):
+        d = sweep.derivatives(params, poles=poles)
+        assert d.shape[:2] == params.shape
+        # the power is quadratic in the parameters, so central differences are exact
+        h = 1e-3
+        for i in range(params.shape[1]):
+            dp = np.zeros(params.shape[1])
+            dp[i] = h
+            fd = (sweep.power(params + dp, poles=poles) - sweep.power(params - dp, poles=poles)) / (2 * h)
+            use = np.isfinite(fd)
+            scale = np.abs(fd[use]).max()
+            assert np.allclose(d[:, i][use], fd[use], rtol=0, atol=1e-8 * scale), i
@@ -0,0 +1,33 @@
+# the tabulated cosmology against CLASS, and its cache
+import os
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from nbodykit import cosmology
+from lib.tng_lib import TabulatedCosmology
+
+def test_against_class(cosmo):
+    c = cosmology.Cosmology(**dict((key, value) for key, value in cosmo.pars.items() if key != 'match'))
+    k = np.logspace(-3, 0.5, 50)
+    z = np.array([0., 0.5, 1., 3., 127.])
+    for zi in z:
+        assert np.allclose(cosmo.LinearPower(zi)(k), cosmology.LinearPower(c, zi)(k), rtol=1e-4, atol=0)
+    assert np.allclose(cosmo.scale_independent_growth_factor(z), c.scale_independent_growth_factor(z), rtol=1e-5, atol=0)
+    assert np.allclose(cosmo.scale_independent_growth_rate(z), c.scale_independent_growth_rate(z), rtol=1e-5, atol=0)
+    chi = cosmo.comoving_distance(z[1:])
+    assert np.allclose(chi, c.comoving_distance(z[1:]), rtol=1e-5, atol=0)
+    assert np.allclose(cosmo.redshift_at_distance(chi), z[1:], rtol=1e-5, atol=0)
+    with pytest.raises(Exception):
+        cosmo.scale_independent_growth_factor(2000.)
+
+def test_cache(comm, cosmo, tmp_path):
+    folder = comm.bcast(str(tmp_path) if comm.rank == 0 else None)
+    pars = dict((key, value) for key, value in cosmo.pars.items() if key != 'match')
+    first = TabulatedCosmology(folder, comm, **pars)
+    assert len([f for f in os.listdir(folder) if f.endswith('.npz')]) == 1
+    # read back from the cache, on all ranks
+    second = TabulatedCosmology(folder, comm, **pars)
+    k = np.logspace(-3, 0.5, 20)
+    assert np.array_equal(first.LinearPower(1.)(k), second.LinearPower(1.)(k))
+    assert second.scale_independent_growth_factor(1.) == first.scale_independent_growth_factor(1.)
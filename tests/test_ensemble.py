@@ -0,0 +1,21 @@
+# run_ensemble: every task not done runs once, on one group, whatever the number of ranks and groups
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import run_ensemble
+
+@pytest.mark.parametrize('ngroups', [1, 2, 3])
+def test_run_ensemble(comm, ngroups):
+    tasks = list(range(11))
+    results = run_ensemble(tasks, lambda task, subcomm: (task, subcomm.size), ngroups, comm=comm,
+                           done=lambda task: task == 3, verbose=False)
+    ran = comm.allgather(results)
+    # every rank of a group has the results of its tasks
+    for results in ran:
+        for itask, (task, size) in results:
+            assert task == tasks[itask]
+    # and every task but the done one ran
+    assert sorted(set(itask for results in ran for itask, _ in results)) == [task for task in tasks if task != 3]
+    if comm.size > 1:
+        # the dispatcher runs no task
+        assert ran[0] == []
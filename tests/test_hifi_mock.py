@@ -0,0 +1,48 @@
+# the HI mocks of the shared Lagrangian stage against hifi_mock, on real pmesh fields
+import os
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+import bigfile
+from lib.tng_lib import *
+from conftest import Nmesh, BoxSize, seed, absmax
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+paths = {'real': os.path.join(data, 'r_space_bestfit_params/'), 'rsd': os.path.join(data, 'z_space_bestfit_params/')}
+
+@pytest.fixture
+def shared_tmp(comm, tmp_path):
+    return comm.bcast(str(tmp_path) if comm.rank == 0 else None)
+
+@pytest.mark.parametrize('space', ['real', 'rsd'])
+def test_hifi_mock_zouts(comm, cosmo, space):
+    zout = 1.
+    HI_field, p1 = hifi_mock(seed, Nmesh, BoxSize, zout, cosmo, comm, space=space, axis=0, params_path=paths[space])
+    key = 'real' if space == 'real' else 0
+    out = hifi_mock_zouts(seed, Nmesh, BoxSize, [zout], cosmo, comm, axes=[0] if space == 'rsd' else [],
+                          real=space == 'real', params_paths=paths)
+    scale = absmax(comm, HI_field.value)
+    assert scale > 0
+    # the same mock, up to the rounding of the growth factor in the rescaled paint
+    assert absmax(comm, out[zout, key][0].value - HI_field.value) < 1e-4 * scale
+
+def test_lightcone(comm, cosmo, shared_tmp):
+    # one shell around the centre of the box, within the box
+    zmin, zmax = cosmo.redshift_at_distance(10.), cosmo.redshift_at_distance(45.)
+    hifi_lightcone(seed, Nmesh, BoxSize, cosmo, comm, shared_tmp, zmin=zmin, zmax=zmax, nshells=1, params_paths=paths,
+                   verbose=False)
+    with bigfile.File(os.path.join(shared_tmp, 'shell_000')) as f:
+        pos, HI = f['Position'][:], f['HI'][:]
+        zshell = f['Header'].attrs['zshell'][0]
+    assert len(HI) > 0
+
+    # the cells of the shell are those of the real space mock at the redshift of the shell
+    HI_field, p1 = hifi_mock(seed, Nmesh, BoxSize, zshell, cosmo, comm, params_path=paths['real'])
+    cells = tuple((np.rint((pos + 0.5 * BoxSize) / (BoxSize / Nmesh)).astype(int) % Nmesh).T)
+    full = fft_c2r(HI_field).preview()
+    assert np.abs(HI - full[cells]).max() < 1e-4 * np.abs(full).max()
+    # and they carry the signal, not only the noise
+    wn, amplitude = noise_zout_term(zshell, Nmesh, BoxSize, paths['real'], seed=seed, pm=HI_field.pm)
+    noise = fft_c2r(wn).preview() * amplitude
+    assert np.std(HI - noise[cells]) > 0.1 * np.std(HI)
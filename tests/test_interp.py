@@ -0,0 +1,33 @@
+# the binned transfer functions looked up by cached bin index against the original interpolator
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+from conftest import BoxSize, Nmesh
+import baseline
+
+kmin = 2*np.pi/BoxSize/2
+
+def test_1d(dlin):
+    p1 = FFTPower(dlin, mode='1d', kmin=kmin)
+    kin = p1.power['k']
+    Pin = 1 + kin + kin**2
+    kwargs = dict(fill_value=[Pin[0], Pin[-1]], Ngrid=Nmesh, L=BoxSize, Pkref=p1)
+    ref = baseline.interp1d_manual_k_binning(kin, Pin, **kwargs)
+    kg = kgrid(dlin.pm)
+    assert np.array_equal(interp1d_manual_k_binning(kin, Pin, **kwargs).on_grid(kg), ref(kg.k))
+
+@pytest.mark.parametrize('los', [[0, 0, 1], [1, 0, 0]])
+def test_2d(dlin, los):
+    Nmu = 6
+    p2 = FFTPower(dlin, mode='2d', Nmu=Nmu, los=los, kmin=kmin)
+    kin = p2.power['k'][:, Nmu//2:]
+    mu = p2.power['mu'][:, Nmu//2:]
+    Pin = 1 + kin * (1 + mu**2)
+    kwargs = dict(kind='manual_Pk_k_mu_bins', fill_value=[1., 2.], Ngrid=Nmesh, L=BoxSize, Pkref=p2)
+    ref = baseline.interp1d_manual_k_binning(kin, Pin, **kwargs)
+    kg = kgrid(dlin.pm)
+    k, mu = np.broadcast_arrays(kg.k, kg.mu(los))
+    expected = ref(k.ravel(), mu.ravel()).reshape(k.shape)
+    assert np.array_equal(interp1d_manual_k_binning(kin, Pin, **kwargs).on_grid(kg), expected, equal_nan=True)
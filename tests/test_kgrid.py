@@ -0,0 +1,37 @@
+# the cached k-grid of a ParticleMesh and apply_transfer against pmesh's apply
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+from conftest import absmax
+
+def transfer(k):
+    return 1 / (1 + (k / 0.1)**2)
+
+def test_apply_transfer(comm, dlin):
+    ref = dlin.apply(lambda k, v: transfer(sum(ki**2 for ki in k)**0.5) * v)
+    out = apply_transfer(dlin, lambda kg: transfer(kg.k))
+    scale = absmax(comm, ref.value)
+    assert scale > 0
+    assert absmax(comm, out.value - ref.value) < 1e-12 * scale
+    # in place
+    field = dlin.copy()
+    assert apply_transfer(field, lambda kg: transfer(kg.k), out=Ellipsis) is field
+    assert np.array_equal(field.value, out.value)
+
+def test_kgrid(dlin):
+    kg = kgrid(dlin.pm)
+    assert kgrid(dlin.pm) is kg
+    kvec = dlin.pm.create_coords('complex')
+    k = np.broadcast_to(sum(ki**2 for ki in kvec)**0.5, dlin.value.shape)
+    assert np.allclose(kg.k, k, rtol=1e-12, atol=0)
+    assert np.array_equal(kg.zero, k == 0)
+    assert np.all(kg.k2_nozero[k == 0] == 1)
+    # per shell of |k|
+    assert np.allclose(kg.on_shells(transfer), transfer(k), rtol=1e-12, atol=0)
+    for los in ([0, 0, 1], [1, 0, 0]):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mu = sum(kvec[i] * los[i] for i in range(3)) / k
+        assert np.allclose(kg.mu(los), mu, rtol=1e-12, atol=0, equal_nan=True)
+        assert kg.mu(los) is kg.mu(tuple(los))
@@ -0,0 +1,83 @@
+# the Lagrangian operators of the operator graph against the formulas of the original tidal_G2, Gamma3, S3 and G3
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from nbodykit.lab import FieldMesh
+from lib.tng_lib import *
+from conftest import absmax
+
+def kij_over_k2(i, j):
+    def transfer(k, v):
+        kk = sum(ki**2 for ki in k)
+        kk[kk == 0] = 1
+        return k[i] * k[j] / kk * v
+    return transfer
+
+def ki_over_k2(i):
+    def transfer(k, v):
+        kk = sum(ki**2 for ki in k)
+        kk[kk == 0] = 1
+        return k[i] * 1j / kk * v
+    return transfer
+
+def derivative(mesh, transfer):
+    return mesh.apply(transfer, mode='complex', kind='wavenumber').compute(mode='real')
+
+def baseline(delta):
+    # the operators as the original code computed them, with nbodykit's apply
+    d = delta.compute(mode='real')
+    pairs = [(i, j) for i in range(3) for j in range(i, 3)]
+    dij = {(i, j): derivative(delta, kij_over_k2(i, j)) for i, j in pairs}
+    get = lambda i, j: dij[min(i, j), max(i, j)]
+    K2 = d * 0
+    for i, j in pairs:
+        K2 += (1. if i == j else 2.) * dij[i, j]**2
+    G2 = K2 - d**2
+    G2mesh = FieldMesh(G2)
+
+    Gamma3 = 8./21. * d * G2
+    for i, j in pairs:
+        Kij = dij[i, j] - d/3 if i == j else dij[i, j]
+        Gamma3 -= (1. if i == j else 2.) * 4./7. * Kij * derivative(G2mesh, kij_over_k2(i, j))
+
+    S3 = d * 0
+    for i in range(3):
+        S3 += derivative(G2mesh, ki_over_k2(i)) * derivative(delta, lambda k, v, i=i: k[i] * 1j * v)
+    S3 *= -3./14.
+
+    G3 = -d**3/2
+    for i in range(3):
+        for j in range(3):
+            for l in range(3):
+                G3 -= get(i, j) * get(i, l) * get(j, l)
+    G3 -= G3.cmean()
+    G3 += 3/2 * K2 * d
+    return {'G2': G2, 'Gamma3': Gamma3, 'S3': S3, 'G3': G3, 'G2par': derivative(G2mesh, kij_over_k2(2, 2))}
+
+def test_operators(comm, dlin):
+    delta = FieldMesh(dlin)
+    refs = baseline(delta)
+    fields = {'G2': tidal_G2(delta), 'Gamma3': Gamma3(delta), 'S3': S3(delta), 'G3': G3(delta),
+              'G2par': tidal_G2_par(FieldMesh(refs['G2']))}
+    graph = compute_lagrangian_operators(dlin, ['G2', 'Gamma3', 'S3', 'G3', 'G2par'], cubic_filter=lambda k, v: v)
+    for name, ref in refs.items():
+        scale = absmax(comm, ref.value)
+        assert scale > 0
+        assert absmax(comm, fields[name].value - ref.value) < 1e-10 * scale, name
+        assert absmax(comm, graph[name].value - ref.value) < 1e-10 * scale, name
+
+def test_plan(comm, dlin):
+    operators = ['d1', 'd2', 'G2', 'd3', 'Gamma3', 'S3', 'G3', 'G2par']
+    plan = plan_lagrangian_operators(operators, dlin.pm)
+    # the FFTs of the plan are those done
+    with Profiler(comm, verbose=False):
+        with profile_stage('operators') as record:
+            compute_lagrangian_operators(dlin, operators, verbose=True)
+    assert record['nfft'] == plan['nfft']
+    # every mesh of a rank fits in the bytes per mesh of the plan
+    assert plan['peak_real'] + plan['peak_complex'] == plan['peak_fields']
+    for type in ('real', 'complex'):
+        nbytes = max(comm.allgather(dlin.pm.create(type=type).value.nbytes))
+        assert plan['peak_bytes_per_rank'] >= plan['peak_fields'] * nbytes
+    assert plan['peak_bytes'] >= plan['peak_fields'] * np.prod(dlin.pm.Nmesh) * dlin.value.real.itemsize
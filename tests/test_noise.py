@@ -0,0 +1,41 @@
+# the noise fields: seeded from the IC seed, the same for any number of ranks, with the Perr of the tables
+import os
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from mpi4py import MPI
+from pmesh.pm import ParticleMesh
+from lib.tng_lib import *
+from conftest import Nmesh, BoxSize, seed
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'r_space_bestfit_params/')
+
+def test_whitenoise_ranks(comm):
+    # the local part of the noise of comm is the same part of the noise drawn on a single rank
+    zout = 1.
+    wn = fft_c2r(noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, comm=comm))
+    full = fft_c2r(noise_whitenoise(zout, Nmesh, BoxSize, seed=seed, comm=MPI.COMM_SELF))
+    # (up to the rounding of the FFTs, which depend on the decomposition)
+    assert np.allclose(wn.value, full.value[wn.slices], rtol=0, atol=1e-12 * np.abs(full.value).max())
+    # and depends on the seed and the redshift
+    for other in [noise_whitenoise(zout, Nmesh, BoxSize, seed=seed + 1, comm=comm),
+                  noise_whitenoise(zout + 0.5, Nmesh, BoxSize, seed=seed, comm=comm)]:
+        assert not np.allclose(fft_c2r(other).value, wn.value)
+
+def test_noise_levels(comm):
+    pm = ParticleMesh([Nmesh] * 3, BoxSize, comm=comm)
+    wn = noise_whitenoise(1., Nmesh, BoxSize, seed=seed, pm=pm)
+    perr = dict(np.loadtxt(os.path.join(path, 'z_Perr.txt')))
+    wn_zout, amplitude = noise_zout_term(1., Nmesh, BoxSize, path, seed=seed, pm=pm)
+    assert np.array_equal(wn_zout.value, wn.value)
+    assert np.isclose(amplitude, (perr[1.] / BoxSize**3)**0.5)
+    assert np.allclose(noise(1., Nmesh, BoxSize, seed=seed, pm=pm).value, wn.value * (34.9 / BoxSize**3)**0.5)
+
+def test_noise_errors(comm):
+    # no tabulated Perr in noise
+    with pytest.raises(ValueError):
+        noise(0.5, Nmesh, BoxSize, seed=seed, comm=comm)
+    # no pm nor comm to draw the noise on
+    with pytest.raises(ValueError):
+        noise_zout(1., Nmesh, BoxSize, path, seed=seed)
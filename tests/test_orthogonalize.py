@@ -0,0 +1,29 @@
+# orthogonalize_fields against the original per-bin M coefficient orthogonalizations, on real pmesh fields
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+from conftest import absmax
+import baseline
+
+@pytest.fixture(scope='module')
+def operators(dlin):
+    return generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3', 'Gamma3'], 0.8, verbose=False)
+
+def assert_fields_close(fields, refs, rtol=1e-10):
+    assert len(fields) == len(refs)
+    for field, ref in zip(fields, refs):
+        scale = absmax(ref.pm.comm, ref.value)
+        assert scale > 0
+        assert absmax(ref.pm.comm, field.value - ref.value) < rtol * scale
+
+def test_orthogonalize(operators):
+    d1, d2, dG2, d3, dg3 = operators
+    assert_fields_close(orthogonalize(d1, d2, dG2, d3), baseline.orthogonalize(d1, d2, dG2, d3))
+    assert_fields_close(orthogonalize_gamma3(d1, d2, dG2, d3, dg3), baseline.orthogonalize_gamma3(d1, d2, dG2, d3, dg3))
+
+@pytest.mark.parametrize('axis', [0, 2])
+def test_orthogonalize_rsd(operators, axis):
+    d1, d2, dG2, d3, dg3 = operators
+    assert_fields_close(orthogonalize_rsd(d1, d2, dG2, d3, 6, axis=axis), baseline.orthogonalize_rsd(d1, d2, dG2, d3, 6, axis=axis))
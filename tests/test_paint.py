@@ -0,0 +1,33 @@
+# paint_fields against nbodykit's painting, on real pmesh fields
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from nbodykit.lab import ArrayCatalog
+from pmesh.pm import ParticleMesh
+from lib.tng_lib import paint_fields
+from conftest import Nmesh, BoxSize, absmax
+
+def particles(comm, N=20000, seed=42):
+    # the same particles whatever the number of ranks, split between them
+    rng = np.random.RandomState(seed)
+    pos, weight = rng.uniform(0, BoxSize, size=(N, 3)), rng.normal(size=N)
+    sl = slice(N * comm.rank // comm.size, N * (comm.rank + 1) // comm.size)
+    return pos[sl], weight[sl]
+
+@pytest.mark.parametrize('compensate', [True, False])
+def test_paint_fields(compensate):
+    pm = ParticleMesh(Nmesh=[Nmesh] * 3, BoxSize=BoxSize, dtype='f4')
+    # the real fields of a 3D mesh are padded (PFFT_PADDED_R2C), so their value is not contiguous
+    assert not pm.create(type='real').value.flags.c_contiguous
+    pos, weight = particles(pm.comm)
+    fields = paint_fields(pos, [weight, None], pm, compensate=compensate)
+
+    data = np.empty(len(pos), dtype=[('Position', ('f8', 3)), ('w', 'f8')])
+    data['Position'], data['w'] = pos, weight
+    cat = ArrayCatalog(data, BoxSize=BoxSize, Nmesh=Nmesh, comm=pm.comm)
+    for field, value in zip(fields, ['w', 'Value']):
+        ref = cat.to_mesh(value=value, resampler='cic', compensated=compensate).paint(mode='real').r2c()
+        scale = absmax(pm.comm, ref.value)
+        assert scale > 0
+        assert absmax(pm.comm, field.value - ref.value) < 1e-5 * scale
@@ -0,0 +1,47 @@
+# the HI fields assembled in one pass against the original polynomial fields, between tabulated redshifts
+import os
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+from conftest import BoxSize, absmax
+import baseline
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+zout, kmin = 1.25, 2*np.pi/BoxSize/2
+
+def assert_close(comm, field, ref):
+    scale = absmax(comm, ref.value)
+    assert scale > 0
+    assert absmax(comm, field.value - ref.value) < 1e-10 * scale
+
+def test_real(comm, dlin):
+    path = os.path.join(data, 'r_space_bestfit_params/')
+    d1, d2, dG2, d3 = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3'], 0.8, verbose=False)
+    fields = [d1] + list(orthogonalize(d1, d2, dG2, d3))
+    p1 = FFTPower(d1, mode='1d', kmin=kmin)
+    assert_close(comm, polynomial_field_zout(*fields, path, zout, p1), baseline.polynomial_field_zout(*fields, path, zout, p1))
+
+def test_assemble_noise(comm, dlin):
+    # a (field, beta) term is added as beta * field
+    path = os.path.join(data, 'r_space_bestfit_params/')
+    wn, amplitude = noise_zout_term(zout, dlin.Nmesh[0], BoxSize, path, seed=1, pm=dlin.pm)
+    field = assemble_fields([(dlin, lambda k, mu: 1 + k), (wn, amplitude)])
+    ref = apply_transfer(dlin, lambda kg: 1 + kg.k)
+    ref.value[...] += amplitude * wn.value
+    assert_close(comm, field, ref)
+
+@pytest.mark.parametrize('axis', [0, 2])
+def test_rsd(comm, dlin, axis):
+    path = os.path.join(data, 'z_space_bestfit_params/')
+    fout, Nmu = 0.7, 6
+    dz, d1, d2, dG2, dG2par, d3 = generate_fields_operators(dlin, ['dz', 'd1', 'd2', 'G2', 'G2par', 'd3'], 0.8, fout=fout,
+                                                            axis=axis, verbose=False)
+    d2, dG2, d3 = orthogonalize_rsd(d1, d2, dG2, d3, Nmu, axis=axis)
+    los = [0, 0, 0]
+    los[axis] = 1
+    p1 = FFTPower(d1, mode='2d', Nmu=Nmu, los=los, kmin=kmin)
+    fields = [dz, d1, d2, dG2, dG2par, d3]
+    assert_close(comm, rsd_polynomial_field_zout(*fields, path, zout, p1, fout),
+                 baseline.rsd_polynomial_field_zout(*fields, path, zout, p1, fout))
@@ -0,0 +1,29 @@
+# the spectra of cross_power_matrix against FFTPower, on real pmesh fields
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from nbodykit.lab import FFTPower
+from lib.tng_lib import *
+from conftest import BoxSize
+
+@pytest.mark.parametrize('mode', ['1d', '2d'])
+def test_cross_power_matrix(dlin, mode):
+    d1, d2, dG2 = generate_fields_operators(dlin, ['d1', 'd2', 'G2'], 0.8, verbose=False)
+    fields = [d1, d2, dG2]
+    kw = dict(mode=mode, kmin=np.pi / BoxSize, los=[1, 0, 0])
+    if mode == '2d':
+        kw.update(Nmu=4, poles=[0, 2])
+        P, Pell, pkref = cross_power_matrix(fields, **kw)
+    else:
+        P, pkref = cross_power_matrix(fields, **kw)
+    # auto spectra and one cross spectrum
+    for i, j in [(0, 0), (1, 1), (2, 2), (0, 2)]:
+        ref = FFTPower(fields[i], second=fields[j] if j != i else None, **kw)
+        assert np.allclose(P[..., i, j], ref.power['power'].real, rtol=1e-8, equal_nan=True)
+        assert np.allclose(P[..., j, i], P[..., i, j], equal_nan=True)
+        for iell, ell in enumerate(kw.get('poles', [])):
+            assert np.allclose(Pell[iell, :, i, j], ref.poles['power_%d' % ell].real, rtol=1e-8,
+                               atol=1e-8 * np.nanmax(np.abs(Pell)), equal_nan=True)
+    assert np.allclose(pkref.power['k'], ref.power['k'], equal_nan=True)
+    assert np.array_equal(pkref.power['modes'], ref.power['modes'])
@@ -0,0 +1,28 @@
+# the single precision mock against the double precision one
+import os
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+from conftest import Nmesh, BoxSize, seed
+
+data = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+def test_dlin(comm):
+    Pk = lambda k: 500. * (1 + (k / 0.2)**2)**-2
+    d8 = get_dlin(seed, Nmesh, BoxSize, Pk, comm)
+    d4 = get_dlin(seed, Nmesh, BoxSize, Pk, comm, dtype='f4')
+    assert d4.value.dtype == np.complex64
+    assert np.allclose(d4.value, d8.value, rtol=0, atol=1e-5 * np.abs(d8.value).max())
+
+@pytest.mark.parametrize('space', ['real', 'rsd'])
+def test_precision_report(comm, cosmo, space):
+    path = os.path.join(data, 'r_space_bestfit_params/' if space == 'real' else 'z_space_bestfit_params/')
+    report = precision_report(seed, Nmesh, BoxSize, 1., cosmo, comm, space=space, verbose=False, params_path=path)
+    use = np.isfinite(report['dev'])
+    assert use.sum() > 5
+    assert np.abs(report['dev'][use]).max() < 1e-3
+    assert np.nanmax(report['one_minus_r']) < 1e-4
+    if space == 'rsd':
+        assert np.nanmax(np.abs(report['dev_quadrupole'])) < 1e-3
@@ -0,0 +1,39 @@
+# the stage records of the Profiler and the files it saves
+import json
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+
+def test_profiler(comm, dlin, tmp_path):
+    path = comm.bcast(str(tmp_path / 'profile.json') if comm.rank == 0 else None)
+    profile = Profiler(comm, verbose=False)
+    with profile:
+        with profile_stage('outer') as outer:
+            with profile_stage('inner') as inner:
+                fft_r2c(fft_c2r(dlin))
+                profile_count('exchange_bytes', 10)
+            FFTPower(dlin, mode='1d')
+    # the counts of a stage include those of the stages inside it, FFTs of nbodykit too
+    assert inner['nfft'] == 2 and inner['depth'] == 1
+    assert outer['nfft'] >= 3 and outer['depth'] == 0
+    assert inner['exchange_bytes'] == outer['exchange_bytes'] == 10
+    assert outer['wall'] >= inner['wall'] > 0
+    # nothing is recorded or counted outside a Profiler
+    with profile_stage('none') as record:
+        fft_c2r(dlin)
+    assert record is None
+    assert [r['stage'] for r in profile.records] == ['inner', 'outer']
+
+    profile.save(path)
+    if comm.rank == 0:
+        with open(path) as f:
+            saved = json.load(f)
+        assert saved['nranks'] == comm.size
+        assert [entry['stage'] for entry in saved['stages']] == ['inner', 'outer']
+        assert saved['stages'][0]['nfft']['max'] == 2
+        assert len(saved['records']) == 2 * comm.size
+        with open(path + '.trace.json') as f:
+            trace = json.load(f)
+        assert len([event for event in trace['traceEvents'] if event['ph'] == 'X']) == 2 * comm.size
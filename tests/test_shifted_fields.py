@@ -0,0 +1,63 @@
+# shifted fields against the displaced Lagrangian grid painted by nbodykit, on real pmesh fields
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from nbodykit.lab import ArrayCatalog
+from lib.tng_lib import *
+from conftest import Nmesh, BoxSize, absmax
+
+operators = ['dz', 'd1', 'd2', 'G2', 'G2par', 'd3']
+
+def assert_fields_close(fields, refs, rtol=1e-5):
+    for field, ref in zip(fields, refs):
+        scale = absmax(ref.pm.comm, ref.value)
+        assert scale > 0
+        assert absmax(ref.pm.comm, field.value - ref.value) < rtol * scale
+
+def reference(dlin, prefactor, fout=None, axis=2):
+    # the particles of the local slab of the Lagrangian grid, weighted and displaced as in
+    # generate_fields_operators (means over the particles of the rank), painted by nbodykit
+    meshes = compute_lagrangian_operators(dlin, ['psi0', 'psi1', 'psi2', 'd1', 'G2', 'G2par', 'd3'], axis=axis)
+    col = {name: mesh.value.flatten() * prefactor**LAGRANGIAN_OPERATORS[name] for name, mesh in meshes.items()}
+    rsd_factor = np.ones(3)
+    if fout is not None:
+        rsd_factor[axis] = 1 + fout
+    q = dlin.pm.generate_uniform_particle_grid(shift=0)
+    col['d1'] -= col['d1'].mean()
+    col['d2'] = col['d1']**2
+    col['d2'] -= col['d2'].mean()
+
+    data = np.empty(len(q), dtype=[('Position', ('f8', 3))] + [(name, 'f8') for name in operators[1:]])
+    data['Position'] = (q + np.array([col['psi%d' % d] * rsd_factor[d] for d in range(3)]).T) % BoxSize
+    for name in operators[1:]:
+        data[name] = col[name]
+    cat = ArrayCatalog(data, BoxSize=BoxSize, Nmesh=Nmesh, comm=dlin.pm.comm)
+    fields = []
+    for name in operators:
+        field = cat.to_mesh(value='Value' if name == 'dz' else name, resampler='cic', compensated=True).paint(mode='real').r2c()
+        if name == 'dz':
+            field.csetitem([0, 0, 0], 0)
+        fields.append(field)
+    return fields
+
+@pytest.mark.parametrize('paint_group, grid_aligned', [(None, True), (1, True), (None, False)])
+def test_generate_fields_operators(dlin, paint_group, grid_aligned):
+    fields = generate_fields_operators(dlin, operators, 0.8, fout=0.6, paint_group=paint_group, grid_aligned=grid_aligned,
+                                       verbose=False)
+    assert_fields_close(fields, reference(dlin, 0.8, fout=0.6))
+
+def test_streamed(dlin):
+    # 2 slabs of 5 weights per chunk, so the local slabs are painted in several chunks
+    budget = 2 * (2 * (3 + 5) * 8) * Nmesh**2
+    fields = generate_fields_operators(dlin, operators, 0.8, fout=0.6, verbose=False)
+    streamed = generate_fields_operators(dlin, operators, 0.8, fout=0.6, memory_budget=budget, verbose=False)
+    assert_fields_close(streamed, fields)
+    assert_fields_close(streamed, reference(dlin, 0.8, fout=0.6))
+
+def test_generate_fields_los(dlin, cosmo):
+    zic, zout = 127, 1.
+    fields = generate_fields_los(dlin, cosmo, zic, zout, axes=(0, 2), real=True, verbose=False)
+    assert_fields_close(fields['real'], generate_fields_new(dlin, cosmo, zic, zout))
+    for axis in (0, 2):
+        assert_fields_close(fields[axis], generate_fields_rsd_new(dlin, cosmo, zic, zout, axis=axis))
@@ -0,0 +1,53 @@
+# StageCache on real pmesh fields: hits, misses, LRU eviction and entries lost to other groups
+import os, shutil
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from lib.tng_lib import *
+
+@pytest.fixture
+def root(comm, tmp_path):
+    return comm.bcast(str(tmp_path / 'cache') if comm.rank == 0 else None)
+
+def test_stage(comm, dlin, root):
+    cache = StageCache(root, comm, verbose=False)
+    calls = []
+    def compute():
+        calls.append(1)
+        return [dlin, fft_c2r(dlin)]
+    first = cache.stage('dlin', compute, seed=1)
+    second = cache.stage('dlin', compute, seed=1)
+    assert len(calls) == 1
+    for a, b in zip(first, second):
+        assert type(a) is type(b) and np.array_equal(a.value, b.value)
+    # other parameters are another entry
+    cache.stage('dlin', compute, seed=2)
+    assert len(calls) == 2
+
+def test_eviction(comm, dlin, root):
+    cache = StageCache(root, comm, verbose=False)
+    cache.save(cache.key('a'), [dlin])
+    size = cache._read_index()[cache.key('a')]['size'] if comm.rank == 0 else None
+    cache.max_bytes = 2.5 * comm.bcast(size)
+    cache.save(cache.key('b'), [dlin])
+    # a is used again, so b is the least recently used one when c comes
+    assert cache.load(cache.key('a')) is not None
+    cache.save(cache.key('c'), [dlin])
+    assert cache.load(cache.key('b')) is None
+    assert cache.load(cache.key('a')) is not None and cache.load(cache.key('c')) is not None
+
+def test_lost_entries(comm, dlin, root):
+    cache = StageCache(root, comm, verbose=False)
+    for name in ('evicted', 'broken'):
+        cache.save(cache.key(name), [dlin])
+    if comm.rank == 0:
+        # removed by another group, and cut short
+        shutil.rmtree(os.path.join(root, cache.key('evicted')))
+        shutil.rmtree(os.path.join(root, cache.key('broken'), 'Field0'))
+    comm.barrier()
+    for name in ('evicted', 'broken'):
+        assert cache.load(cache.key(name)) is None
+        # and computed again
+        fields = cache.stage(name, lambda: [dlin])
+        assert np.array_equal(cache.load(cache.key(name))[0].value, fields[0].value)
@@ -0,0 +1,29 @@
+# threaded FFTs and painting give the fields of a single thread
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+import lib.tng_lib as tng_lib
+from lib.tng_lib import *
+from conftest import absmax
+
+@pytest.fixture
+def threads():
+    previous = tng_lib._NTHREADS
+    yield
+    set_threads(previous)
+
+def run(dlin):
+    real = fft_c2r(dlin)
+    return [real, fft_r2c(real)] + list(generate_fields_operators(dlin, ['d1', 'd2', 'G2'], 0.8, verbose=False))
+
+def test_threads(comm, dlin, threads):
+    set_threads(1)
+    refs = run(dlin)
+    assert set_threads(4) == 4
+    for field, ref in zip(run(dlin), refs):
+        assert type(field) is type(ref)
+        scale = absmax(comm, ref.value)
+        assert scale > 0
+        # up to the order of the sums
+        assert absmax(comm, field.value - ref.value) < 1e-10 * scale
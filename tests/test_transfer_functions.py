@@ -0,0 +1,49 @@
+# TransferFunctionFit against the FFTPower path of measure_transfer_functions.py, on real pmesh fields
+import numpy as np
+import pytest
+pytest.importorskip('pmesh')
+pytest.importorskip('nbodykit')
+from nbodykit.lab import ArrayCatalog, FFTPower
+from scipy.interpolate import interp1d
+from lib.tng_lib import *
+from conftest import Nmesh, BoxSize, seed
+
+def test_transfer_function_fit(comm, dlin):
+    d1, d2, dG2, d3 = generate_fields_operators(dlin, ['d1', 'd2', 'G2', 'd3'], 0.8, verbose=False)
+    d2, dG2, d3 = orthogonalize(d1, d2, dG2, d3)
+    kmin = np.pi / BoxSize
+
+    # a catalog tracing d1: uniform particles kept with a probability growing with d1
+    real = fft_c2r(d1).preview()
+    rng = np.random.RandomState(seed + comm.rank)
+    pos = rng.uniform(0, BoxSize, size=(20000, 3))
+    cells = tuple((pos / (BoxSize / Nmesh)).astype(int).T)
+    pos = pos[rng.uniform(size=len(pos)) < np.clip(0.5 + real[cells], 0, 1)]
+
+    result = TransferFunctionFit([d1, d2, dG2, d3], kmin=kmin)(pos)
+
+    # the previous measure_transfer_functions.py
+    cat = ArrayCatalog({'Position': pos}, BoxSize=BoxSize, Nmesh=Nmesh, comm=comm)
+    delta_h = cat.to_mesh(resampler='cic', compensated=True).paint(mode='real') - 1.0
+    ph_fin = FFTPower(delta_h, mode='1d', kmin=kmin)
+    kk = ph_fin.power.coords['k']
+    final_field = None
+    for i, field in enumerate([d1, d2, dG2, d3]):
+        ph_field = FFTPower(delta_h, mode='1d', second=field, kmin=kmin)
+        beta = ph_field.power['power'].real / FFTPower(field, mode='1d', kmin=kmin).power['power'].real
+        assert np.allclose(result['beta'][i], beta, rtol=1e-4)
+        inter = interp1d(kk, beta, kind='linear', fill_value=(beta[0], beta[-1]), bounds_error=False)
+        term = field.apply(lambda k, v: inter(sum(ki ** 2 for ki in k)**0.5) * v)
+        final_field = term if final_field is None else final_field + term
+    perr = FFTPower(delta_h.r2c() - final_field, mode='1d', kmin=kmin)
+    phbestfit = FFTPower(delta_h, mode='1d', second=final_field, kmin=kmin)
+    pbestfit = FFTPower(final_field, mode='1d', kmin=kmin)
+    rhbestfit = phbestfit.power['power'].real/(ph_fin.power['power'].real*pbestfit.power['power'].real)**0.5
+
+    assert np.allclose(result['k'], kk)
+    assert np.allclose(result['Phh'], ph_fin.power['power'].real, rtol=1e-4)
+    assert np.allclose(result['Perr'], perr.power['power'].real, rtol=1e-4)
+    assert np.allclose(result['Phbestfit'], phbestfit.power['power'].real, rtol=1e-4)
+    assert np.allclose(result['Pbestfit'], pbestfit.power['power'].real, rtol=1e-4)
+    assert np.allclose(result['r'], rhbestfit, rtol=1e-4)
+    assert np.isclose(result['nbar'], comm.allreduce(len(pos)) / BoxSize**3)